@@ -1,11 +1,82 @@
+# Import asynccontextmanager so we can describe startup/shutdown work as a single "lifespan" function.
+from contextlib import asynccontextmanager
 # Import the FastAPI class from the fastapi package. FastAPI is a modern web framework for building APIs with Python.
 from fastapi import FastAPI
 # Import the routers (collections of endpoints) for health and vms from the app.routers package.
-from app.routers import health, vms, networks
+from app.routers import (
+    health, vms, networks, jobs, pool, metrics, debug,
+    nodes as nodes_router, events as events_router, reclaim as reclaim_router, storage as storage_router,
+    balloon as balloon_router,
+)
+# Import the libvirt connection pool helpers so pooled connections are closed cleanly on shutdown.
+from app.services.libvirt_client import close_pools
+# Import the event-fed VM inventory cache (started/stopped with the app).
+from app.services import inventory
+# Import the background job runner so its worker pool is shut down with the app.
+from app.services import jobs as job_runner
+# Import the disk overlay staging pool (used by the qemu-img disk backend only).
+from app.services import staging
+# Import the storage service (registered base images for the staging pool).
+from app.services import storage
+# Import the registry of hypervisor nodes (libvirt URIs) that VMs can be placed on.
+from app.services import nodes
+# Import the background per-VM stats collector behind /metrics and /vms/{name}/stats.
+from app.services import stats
+# Import the auto-balloon controller that moves memory between idle and busy VMs.
+from app.services import balloon
+# Import the latency instrumentation (request middleware and libvirt call timers).
+from app.services import timings
+# Import the event bus behind GET /events (lifecycle, lease and job events).
+from app.services import events
+# Import the background removal queue for deleted VMs' disks.
+from app.services import reclaim
+# Import the bounded thread pool that async routes use for blocking libvirt calls.
+from app.services import executor
+from app.services.vm_create import DISK_BACKEND
+
+
+# Code before `yield` runs when the server starts; code after it runs when the server stops.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Time every libvirt call made by any service (see GET /debug/timings).
+    timings.install_libvirt()
+    # Read the node list, then start one background thread per node that mirrors
+    # libvirt's domain list in memory.
+    node_list = nodes.load()
+    for node in node_list:
+        inventory.start(node["uri"])
+    # Publish their domain events, and job progress, on GET /events.
+    events.start(node_list)
+    # With the qemu-img disk backend, keep ready-made overlays so creates can skip `qemu-img create`.
+    # (Pool volumes are made by libvirt in one call and need no staging.)
+    if DISK_BACKEND == "qemu-img":
+        staging.start([img["path"] for img in storage.images()])
+    # Start the workers that remove deleted VMs' files in the background.
+    reclaim.start()
+    # Start sampling CPU / memory / disk / network stats of all running VMs.
+    stats.start()
+    # Resize running VMs' memory balloons to their use (only with KVM_ORCH_BALLOON=dry-run or on).
+    balloon.start()
+    yield
+    balloon.stop()
+    stats.stop()
+    events.stop()
+    reclaim.stop()
+    staging.stop()
+    job_runner.shutdown()
+    executor.shutdown()
+    inventory.stop_all()
+    # Close all pooled libvirt connections.
+    close_pools()
+    # Put the untimed libvirt methods back (an app started again in this process installs them anew).
+    timings.uninstall_libvirt()
+
 
 # Create an instance of the FastAPI application.
 # The 'title' argument sets the name that will appear in the API docs (Swagger UI).
-app = FastAPI(title="KVM Orchestrator")
+app = FastAPI(title="KVM Orchestrator", lifespan=lifespan)
+# Time every request per route (p50/p95/p99 at GET /debug/timings).
+app.add_middleware(timings.TimingMiddleware)
 
 # Include the health router, which adds all endpoints defined in app/routers/health.py to the app.
 app.include_router(health.router)
@@ -13,3 +84,21 @@ app.include_router(health.router)
 app.include_router(vms.router)
 # Include the networks router, which adds all endpoints defined in app/routers/networks.py to the app.
 app.include_router(networks.router)
+# Include the jobs router, which adds the background job status endpoints from app/routers/jobs.py.
+app.include_router(jobs.router)
+# Include the pool router, which adds the disk staging pool status endpoint from app/routers/pool.py.
+app.include_router(pool.router)
+# Include the nodes router, which adds the hypervisor node registry endpoints from app/routers/nodes.py.
+app.include_router(nodes_router.router)
+# Include the metrics router, which adds the Prometheus /metrics endpoint from app/routers/metrics.py.
+app.include_router(metrics.router)
+# Include the debug router, which adds the latency report at /debug/timings from app/routers/debug.py.
+app.include_router(debug.router)
+# Include the events router, which adds the live event stream (SSE and WebSocket) from app/routers/events.py.
+app.include_router(events_router.router)
+# Include the reclaim router, which adds the storage reclamation status endpoints from app/routers/reclaim.py.
+app.include_router(reclaim_router.router)
+# Include the storage router, which adds the storage pool and base image endpoints from app/routers/storage.py.
+app.include_router(storage_router.router)
+# Include the balloon router, which adds the auto-balloon controller report from app/routers/balloon.py.
+app.include_router(balloon_router.router)
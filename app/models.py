@@ -1,13 +1,17 @@
 # Import BaseModel and Field from Pydantic. Pydantic is used for data validation and settings management using Python type annotations.
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
 # Import Optional from typing, which allows a field to be None (not required).
-from typing import Optional
+# Literal restricts a field to a fixed set of values.
+from typing import Literal, Optional
+import re
+# Known guest OS variants (one domain XML template each).
+from app.services.domain_xml import OS_VARIANTS
 
-# Define a data model for creating a new VM. This model is used to validate and document the expected input for VM creation endpoints.
-# (Referenced in app/routers/vms.py and app/services/vm_create.py)
-class CreateVm(BaseModel):
-    # The name of the VM. Must be 1-32 characters, letters, numbers, or dashes only.
-    name: str = Field(pattern=r"^[a-zA-Z0-9-]{1,32}$")
+# Allowed VM names: 1-32 letters, numbers or dashes.
+VM_NAME_PATTERN = r"^[a-zA-Z0-9-]{1,32}$"
+
+# Settings shared by every way of creating VMs (single create and batch create).
+class VmSettings(BaseModel):
     # Number of virtual CPUs for the VM. Default is 2.
     vcpus: int = 2
     # Amount of memory (in megabytes) for the VM. Default is 2048 MB (2 GB).
@@ -18,9 +22,217 @@ class CreateVm(BaseModel):
     network: str = "default"          # libvirt network name
     # SSH public key to inject into the VM for remote access. Optional; if not provided, no key is injected.
     ssh_pubkey: Optional[str] = None  # user’s ~/.ssh/id_rsa.pub
+    # How cloud-init data reaches the VM: "iso" (CD-ROM, the default) or "vfat" (small raw disk labelled CIDATA).
+    seed_format: Literal["iso", "vfat"] = "iso"
+    # Guest OS variant; picks the domain XML template (see OS_VARIANTS in app/services/domain_xml.py).
+    os_variant: str = "ubuntu22.04"
+    # Free-form labels stored in the domain metadata; used by selectors (e.g. bulk actions on tag "web").
+    tags: list[str] = []
+    # Node (see GET /nodes) to create the VM on; by default the scheduler picks one.
+    node: Optional[str] = None
+    # Registered base image (see GET /storage/images) the disk is an overlay of; None = the default image.
+    image: Optional[str] = None
+    # Storage pool (see GET /storage/pools) for the disk; by default the preferred or emptiest pool with room.
+    pool: Optional[str] = None
+    # Disk preallocation: "off" (thin), "metadata" (qcow2 tables written up front) or "falloc" (space reserved).
+    # Only with the qemu-img disk backend; storage pool overlays are always thin.
+    preallocation: Literal["off", "metadata", "falloc"] = "off"
+    # qcow2 cluster size in KiB (a power of two, 1-2048); None = qemu's default (64).
+    cluster_size_kb: Optional[int] = None
+    # Headroom for later changes (PATCH /vms/{name}/resources): vCPUs can be hot-plugged up to
+    # max_vcpus and the memory balloon can grow to max_memory_mb. None = no headroom.
+    max_vcpus: Optional[int] = None
+    max_memory_mb: Optional[int] = None
+
+    @model_validator(mode="after")
+    def _check_maximums(self):
+        if self.max_vcpus is not None and self.max_vcpus < self.vcpus:
+            raise ValueError("max_vcpus must be at least vcpus")
+        if self.max_memory_mb is not None and self.max_memory_mb < self.memory_mb:
+            raise ValueError("max_memory_mb must be at least memory_mb")
+        return self
+
+    @field_validator("os_variant")
+    @classmethod
+    def _check_os_variant(cls, value):
+        if value not in OS_VARIANTS:
+            raise ValueError(f"unknown os_variant '{value}' (known: {', '.join(sorted(OS_VARIANTS))})")
+        return value
+
+    @field_validator("cluster_size_kb")
+    @classmethod
+    def _check_cluster_size(cls, value):
+        if value is not None and (value < 1 or value > 2048 or value & (value - 1)):
+            raise ValueError("cluster_size_kb must be a power of two between 1 and 2048")
+        return value
+
+# Define a data model for creating a new VM. This model is used to validate and document the expected input for VM creation endpoints.
+# (Referenced in app/routers/vms.py and app/services/vm_create.py)
+class CreateVm(VmSettings):
+    # The name of the VM. Must be 1-32 characters, letters, numbers, or dashes only.
+    name: str = Field(pattern=VM_NAME_PATTERN)
+
+# Data model for creating many VMs in one call (POST /vms/batch).
+# Either list the VMs in `vms`, or give `count` plus a `name_pattern` such as "worker-{n:02d}"
+# (n runs from `start`); pattern VMs all use the settings in `template`.
+class BatchCreateVm(BaseModel):
+    vms: list[CreateVm] = []
+    count: int = Field(default=0, ge=0, le=500)
+    name_pattern: Optional[str] = None
+    start: int = 1
+    template: VmSettings = VmSettings()
+    # How many VMs are provisioned at the same time.
+    concurrency: int = Field(default=5, ge=1, le=50)
+
+    @model_validator(mode="after")
+    def _check(self):
+        if self.count and not self.name_pattern:
+            raise ValueError("count needs a name_pattern, e.g. 'worker-{n:02d}'")
+        if self.name_pattern and "{n" not in self.name_pattern:
+            raise ValueError("name_pattern must contain {n}")
+        try:
+            names = [spec.name for spec in self.specs()]
+        except (ValidationError, KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"name_pattern does not produce valid VM names: {e}")
+        if not names:
+            raise ValueError("nothing to create: give vms or count + name_pattern")
+        dupes = sorted({n for n in names if names.count(n) > 1})
+        if dupes:
+            raise ValueError(f"duplicate VM names in batch: {', '.join(dupes)}")
+        return self
+
+    def specs(self) -> list[CreateVm]:
+        """All VMs of the batch as CreateVm specs (pattern names are validated like single creates)."""
+        generated = [
+            CreateVm(name=self.name_pattern.format(n=n), **self.template.model_dump())
+            for n in range(self.start, self.start + self.count)
+        ] if self.count else []
+        return list(self.vms) + generated
+
+# Data model for cloning an existing VM (POST /vms/{name}/clone).
+# Either list the new names in `names`, or give `count` plus a `name_pattern` such as "worker-{n:02d}"
+# (n runs from `start`). Clones are linked: their disks are qcow2 overlays of the source's disks.
+class CloneVm(BaseModel):
+    names: list[str] = []
+    count: int = Field(default=0, ge=0, le=500)
+    name_pattern: Optional[str] = None
+    start: int = 1
+    # Give each clone a new NoCloud seed so cloud-init sets its hostname and a new machine-id.
+    # Without it clones keep the source's hostname and machine-id (and may get the same DHCP address).
+    fresh_seed: bool = True
+    # Extra SSH public key for the clones (only with fresh_seed).
+    ssh_pubkey: Optional[str] = None
+    # Tags for the clones; None copies the source's tags.
+    tags: Optional[list[str]] = None
+    # Start the clones once defined (false = define only).
+    power_on: bool = True
+    # How many clones are defined and started at the same time.
+    concurrency: int = Field(default=10, ge=1, le=50)
+
+    @model_validator(mode="after")
+    def _check(self):
+        if self.count and not self.name_pattern:
+            raise ValueError("count needs a name_pattern, e.g. 'worker-{n:02d}'")
+        if self.name_pattern and "{n" not in self.name_pattern:
+            raise ValueError("name_pattern must contain {n}")
+        try:
+            names = self.clone_names()
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"name_pattern does not produce valid VM names: {e}")
+        if not names:
+            raise ValueError("nothing to clone: give names or count + name_pattern")
+        bad = [n for n in names if not re.match(VM_NAME_PATTERN, n)]
+        if bad:
+            raise ValueError(f"invalid VM names: {', '.join(bad[:5])} (letters, numbers and dashes, up to 32)")
+        dupes = sorted({n for n in names if names.count(n) > 1})
+        if dupes:
+            raise ValueError(f"duplicate VM names: {', '.join(dupes)}")
+        return self
+
+    def clone_names(self) -> list[str]:
+        """All names to create: `names` first, then the pattern names."""
+        generated = [self.name_pattern.format(n=n) for n in range(self.start, self.start + self.count)] if self.count else []
+        return list(self.names) + generated
+
+# Data model for changing a VM's size (PATCH /vms/{name}/resources). Only the fields that are set change.
+# memory_mb moves the balloon and vcpus hot-plugs/unplugs vCPUs, both up to the VM's maximums;
+# max_memory_mb / max_vcpus change those maximums, which only takes effect at the next boot.
+class VmResources(BaseModel):
+    memory_mb: Optional[int] = Field(default=None, ge=128)
+    vcpus: Optional[int] = Field(default=None, ge=1)
+    max_memory_mb: Optional[int] = Field(default=None, ge=128)
+    max_vcpus: Optional[int] = Field(default=None, ge=1)
+    # Apply to the running VM (live) and/or to its saved definition, used from the next boot (config).
+    live: bool = True
+    config: bool = True
+    # Auto-balloon policy for this VM (see app/services/balloon.py): let the controller move its
+    # memory, and the bounds it may move it within (None = KVM_ORCH_BALLOON_FLOOR_MB / the maximum).
+    auto_balloon: Optional[bool] = None
+    balloon_min_mb: Optional[int] = Field(default=None, ge=128)
+    balloon_max_mb: Optional[int] = Field(default=None, ge=128)
+
+    @model_validator(mode="after")
+    def _check(self):
+        if not self.live and not self.config:
+            raise ValueError("set live, config or both")
+        if all(v is None for v in (self.memory_mb, self.vcpus, self.max_memory_mb, self.max_vcpus,
+                                   self.auto_balloon, self.balloon_min_mb, self.balloon_max_mb)):
+            raise ValueError("nothing to change")
+        if None not in (self.memory_mb, self.max_memory_mb) and self.memory_mb > self.max_memory_mb:
+            raise ValueError("memory_mb must be at most max_memory_mb")
+        if None not in (self.vcpus, self.max_vcpus) and self.vcpus > self.max_vcpus:
+            raise ValueError("vcpus must be at most max_vcpus")
+        if None not in (self.balloon_min_mb, self.balloon_max_mb) and self.balloon_min_mb > self.balloon_max_mb:
+            raise ValueError("balloon_min_mb must be at most balloon_max_mb")
+        return self
+
+    def changes_size(self) -> bool:
+        return any(v is not None for v in (self.memory_mb, self.vcpus, self.max_memory_mb, self.max_vcpus))
 
 class NetworkCreate(BaseModel):
     # This class defines the data structure for creating a new network.
     # It inherits from BaseModel, which provides validation and serialization.
     name: str  # The name of the network to create
     bridge: str  # The name of the Linux bridge to bind the network to
+
+# Data model for registering a hypervisor node (POST /nodes).
+class NodeCreate(BaseModel):
+    name: str = Field(pattern=r"^[a-zA-Z0-9._-]{1,64}$")
+    uri: str                          # libvirt URI, e.g. qemu+ssh://root@kvm2/system
+
+# Picks a set of VMs by name, pattern, state or tag (bulk actions in POST /vms/actions, filters of GET /vms).
+# Every field that is set must match (they are ANDed); `names` matches any of the listed names.
+# An empty selector matches nothing unless `all` is true, so a typo can't stop the whole fleet.
+class VmSelector(BaseModel):
+    names: list[str] = []
+    prefix: Optional[str] = None     # name starts with this
+    glob: Optional[str] = None       # shell-style, e.g. "web-*"
+    regex: Optional[str] = None      # Python regex, must match the whole name
+    state: Optional[str] = None      # e.g. "running", "shutoff" (see STATE_MAP)
+    tag: Optional[str] = None        # VM must carry this tag
+    active: Optional[bool] = None    # running/paused (true) or shut off (false)
+    all: bool = False
+
+    @model_validator(mode="after")
+    def _check(self):
+        if self.regex is not None:
+            try:
+                re.compile(self.regex)
+            except re.error as e:
+                raise ValueError(f"invalid regex: {e}")
+        return self
+
+# Data model for a lifecycle action on many VMs (POST /vms/actions).
+class VmAction(BaseModel):
+    action: Literal["start", "shutdown", "destroy", "reboot", "delete"]
+    selector: VmSelector
+    # How many VMs are acted on at the same time.
+    concurrency: int = Field(default=10, ge=1, le=100)
+    # shutdown only: wait until each VM is shut off, for at most `deadline` seconds,
+    # and force it off (destroy) if it is still running then and `escalate` is true.
+    # With wait the action always runs as a background job (202 + job id).
+    wait: bool = False
+    deadline: int = Field(default=60, ge=1, le=3600)
+    escalate: bool = False
+    # delete only: zero storage-pool volumes before removing them (see app/services/reclaim.py).
+    wipe: bool = False
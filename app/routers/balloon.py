@@ -0,0 +1,22 @@
+# The auto-balloon controller (app/services/balloon.py): its settings, and what it did
+# (or, in dry-run mode, would have done) to every managed VM in its last round.
+from fastapi import APIRouter
+from app.services import balloon
+from app.services.executor import run_blocking
+
+router = APIRouter(prefix="/balloon", tags=["balloon"])
+
+
+# Settings and the report of the last round (null until the first round has run).
+@router.get("/")
+async def balloon_status():
+    controller = balloon.get()
+    return {**balloon.settings(), "last_run": controller.report() if controller else None}
+
+
+# Run one round now and return its report. By default nothing is resized (a dry run), so this
+# also previews the policy while the controller is off; ?dry_run=false resizes the VMs.
+@router.post("/run")
+async def balloon_run(dry_run: bool = True):
+    controller = balloon.get() or balloon.Controller(mode="dry-run" if dry_run else "on")
+    return await run_blocking(controller.run_once, not dry_run)
@@ -0,0 +1,19 @@
+# Latency numbers for API routes, libvirt calls and external commands (app/services/timings.py).
+from fastapi import APIRouter
+from app.services import timings
+
+router = APIRouter(prefix="/debug", tags=["debug"])
+
+
+# Count, error rate and p50/p95/p99/max latency per route, libvirt method and command,
+# slowest (by total time) first.
+@router.get("/timings")
+async def get_timings():
+    return {"enabled": timings.TIMINGS_ENABLED, "slow_call_ms": timings.SLOW_CALL_MS, **timings.snapshot()}
+
+
+# Start counting from zero again (e.g. before a load test).
+@router.delete("/timings")
+async def reset_timings():
+    timings.reset()
+    return {"message": "timings reset"}
@@ -0,0 +1,136 @@
+# Live event stream: domain lifecycle, define/undefine, DHCP leases and job progress
+# (see app/services/events.py for where each event comes from).
+#
+#   GET /events                      Server-Sent Events (text/event-stream), e.g. curl -N or EventSource
+#   GET /events?type=lifecycle,job   only these event types
+#   GET /events?vm=web-1,web-2       only events about these VMs
+#   Last-Event-ID: 42                (header, or ?last_event_id=42) resume after event 42
+#   WS  /events/ws                   the same stream as JSON text messages over a WebSocket
+#
+# Each SSE message carries `id:` (for resuming), `event:` (the type) and `data:` (the JSON event).
+# If the events since Last-Event-ID are no longer all in memory a "reset" event is sent first;
+# re-read GET /vms to resync. A client that falls too far behind gets an "overflow" event and
+# is disconnected; reconnecting with its last id picks up where it left off.
+import asyncio
+import json
+import os
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+from app.services import events
+from app.services.events import OVERFLOW
+
+# Seconds between keep-alive comments on an idle SSE stream (keeps proxies from closing it).
+EVENT_KEEPALIVE = float(os.environ.get("KVM_ORCH_EVENT_KEEPALIVE", "15"))
+
+router = APIRouter(prefix="/events", tags=["events"])
+
+
+# Helper: turn "a,b" query values into a set (None = no filter), rejecting unknown types.
+def _filters(type: Optional[str], vm: Optional[str]) -> tuple[Optional[set], Optional[set]]:
+    types = {t.strip() for t in type.split(",") if t.strip()} if type else None
+    if types:
+        unknown = types - set(events.EVENT_TYPES)
+        if unknown:
+            raise ValueError(f"unknown event type(s) {sorted(unknown)}; use {', '.join(events.EVENT_TYPES)}")
+    vms = {v.strip() for v in vm.split(",") if v.strip()} if vm else None
+    return types or None, vms or None
+
+
+def _last_id(value: Optional[str]) -> Optional[int]:
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"bad event id '{value}'")
+
+
+def _sse(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+
+@router.get("")
+async def event_stream(request: Request, type: Optional[str] = None, vm: Optional[str] = None,
+                       last_event_id: Optional[str] = None):
+    try:
+        types, vms = _filters(type, vm)
+        last_id = _last_id(request.headers.get("last-event-id") or last_event_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def stream():
+        sub, missed, complete = events.bus.subscribe(types, vms, last_id)
+        try:
+            # Tell EventSource clients how long to wait before reconnecting.
+            yield "retry: 2000\n\n"
+            if not complete:
+                yield f"event: reset\ndata: {json.dumps({'last_event_id': last_id})}\n\n"
+            for event in missed:
+                yield _sse(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), EVENT_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is OVERFLOW:
+                    yield "event: overflow\ndata: {}\n\n"
+                    return
+                yield _sse(event)
+        finally:
+            events.bus.unsubscribe(sub)
+
+    # X-Accel-Buffering: no keeps nginx from buffering the stream.
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# Same stream over a WebSocket, for clients that prefer one. Filters and the id to resume
+# after are query parameters: /events/ws?type=job&vm=web-1&last_event_id=42
+@router.websocket("/ws")
+async def event_socket(websocket: WebSocket, type: Optional[str] = None, vm: Optional[str] = None,
+                       last_event_id: Optional[str] = None):
+    try:
+        types, vms = _filters(type, vm)
+        last_id = _last_id(last_event_id)
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+    await websocket.accept()
+    sub, missed, complete = events.bus.subscribe(types, vms, last_id)
+    # Notice a client that closes the socket even while no events are flowing.
+    closed = asyncio.ensure_future(_wait_closed(websocket))
+    try:
+        if not complete:
+            await websocket.send_json({"type": "reset", "last_event_id": last_id})
+        for event in missed:
+            await websocket.send_json(event)
+        while not closed.done():
+            getter = asyncio.ensure_future(sub.queue.get())
+            await asyncio.wait({getter, closed}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                break
+            event = getter.result()
+            if event is OVERFLOW:
+                await websocket.send_json(OVERFLOW)
+                await websocket.close(code=1013)
+                break
+            await websocket.send_json(event)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        closed.cancel()
+        events.bus.unsubscribe(sub)
+
+
+async def _wait_closed(websocket: WebSocket) -> None:
+    # We don't expect messages from the client; read until it disconnects.
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
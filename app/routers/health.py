@@ -8,13 +8,13 @@ router = APIRouter()
 # Define a GET endpoint at the root path ("/") of this router.
 # The 'tags' argument is used for grouping endpoints in the API docs (Swagger UI).
 @router.get("/", tags=["health"])
-def root():
+async def root():
     # When someone visits this endpoint, return a simple message confirming the API is running.
     return {"message": "It works!"}
 
 # Define a GET endpoint at "/status" for health checks.
 # This is useful for monitoring if your API is up and running.
 @router.get("/status", tags=["health"])
-def status():
+async def status():
     # Return a status message indicating the service is healthy.
     return {"status": "healthy"}
@@ -0,0 +1,19 @@
+from typing import Optional
+from fastapi import APIRouter, HTTPException  # Import FastAPI tools for routing and error handling
+from app.services import jobs  # Background job registry (app/services/jobs.py)
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])  # Create a router for job status endpoints
+
+@router.get("/")
+async def list_jobs(status: Optional[str] = None, kind: Optional[str] = None):
+    # Endpoint to list known jobs, newest first; optionally filter by status (queued/running/succeeded/failed) or kind
+    items = sorted(jobs.list_jobs(status=status, kind=kind), key=lambda j: j.seq, reverse=True)
+    return {"jobs": [j.as_dict() for j in items]}
+
+@router.get("/{job_id}")
+async def get_job(job_id: str):
+    # Endpoint to get the stage, progress, result and error of one job
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"job '{job_id}' not found")  # Unknown or expired job id
+    return job.as_dict()
@@ -0,0 +1,20 @@
+# Prometheus scrape endpoint. The text is rendered by the background collector in
+# app/services/stats.py after every sample, so a scrape is just a copy of a cached string.
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from app.services import stats
+
+router = APIRouter(tags=["metrics"])
+
+# Content type of the Prometheus text exposition format.
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    collector = stats.get()
+    if collector is None:
+        text = "# stats collector disabled (KVM_ORCH_STATS_INTERVAL=0)\n"
+    else:
+        text = collector.prometheus()
+    return PlainTextResponse(text, media_type=PROMETHEUS_CONTENT_TYPE)
@@ -1,46 +1,65 @@
 from fastapi import APIRouter, HTTPException  # Import FastAPI tools for routing and error handling
 from app.models import NetworkCreate  # Import the model for network creation requests
+from typing import Optional
 from app.services.network_libvirt import network_list, network_ensure, network_delete, nic_attach, nic_detach  # Import network functions
+from app.services import nodes  # Node registry: ?node=<name> picks the hypervisor (default: the first node)
+from app.services.executor import run_blocking  # Blocking libvirt calls run on a dedicated bounded pool
 
 router = APIRouter(prefix="/networks", tags=["networks"])  # Create a router for network-related endpoints
 
+def _uri(node: Optional[str]) -> str:
+    # Translate the ?node= query parameter into that node's libvirt URI
+    try:
+        return nodes.uri_for(node)
+    except nodes.UnknownNode:
+        raise HTTPException(status_code=404, detail=f"node '{node}' not found")
+
 @router.get("/")
-def list_networks():
-    # Endpoint to list all networks
-    return {"networks": network_list()}
+async def list_networks(node: Optional[str] = None, leases: bool = True):
+    # Endpoint to list all networks with bridge, forward mode and DHCP ranges (cached, see network_list),
+    # plus lease counts and DHCP range utilization (?leases=false skips those)
+    return {"networks": await run_blocking(network_list, _uri(node), leases)}
 
 @router.post("/")
-def create_network(spec: NetworkCreate):
+async def create_network(spec: NetworkCreate, node: Optional[str] = None):
     # Endpoint to create a new network using the provided specification
+    uri = _uri(node)
     try:
-        network_ensure(spec.name, spec.bridge)  # Ensure the network exists and is started
+        await run_blocking(network_ensure, spec.name, spec.bridge, uri)  # Ensure the network exists and is started
         return {"message": f"network '{spec.name}' bound to bridge '{spec.bridge}'"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))  # Return error if something goes wrong
 
 @router.delete("/{name}")
-def delete_network(name: str):
+async def delete_network(name: str, node: Optional[str] = None):
     # Endpoint to delete a network by its name
+    uri = _uri(node)
     try:
-        network_delete(name)  # Delete the specified network
+        await run_blocking(network_delete, name, uri)  # Delete the specified network
         return {"message": f"network '{name}' deleted"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))  # Return error if something goes wrong
 
 @router.post("/attach")
-def attach(vm: str, network: str):
-    # Endpoint to attach a VM to a network
+async def attach(vm: str, network: str):
+    # Endpoint to attach a VM to a network (on whichever node the VM lives)
+    node = await run_blocking(nodes.locate, vm)
+    if node is None:
+        raise HTTPException(status_code=404, detail=f"VM '{vm}' not found")
     try:
-        nic_attach(vm, network)  # Attach the network interface to the VM
+        await run_blocking(nic_attach, vm, network, node["uri"])  # Attach the network interface to the VM
         return {"message": f"attached {vm} to {network}"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))  # Return error if something goes wrong
 
 @router.post("/detach")
-def detach(vm: str, mac: str):
+async def detach(vm: str, mac: str):
     # Endpoint to detach a network interface from a VM using its MAC address
+    node = await run_blocking(nodes.locate, vm)
+    if node is None:
+        raise HTTPException(status_code=404, detail=f"VM '{vm}' not found")
     try:
-        nic_detach(vm, mac)  # Detach the network interface from the VM
+        await run_blocking(nic_detach, vm, mac, node["uri"])  # Detach the network interface from the VM
         return {"message": f"detached {mac} from {vm}"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))  # Return error if something goes wrong
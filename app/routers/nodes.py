@@ -0,0 +1,68 @@
+# Endpoints for the hypervisor node registry (app/services/nodes.py).
+from fastapi import APIRouter, HTTPException
+from app.models import NodeCreate
+from app.services import nodes
+from app.services.executor import run_blocking
+
+router = APIRouter(prefix="/nodes", tags=["nodes"])
+
+
+# List registered nodes. ?capacity=true also reports free memory / vCPUs / storage per node
+# (queried from all nodes in parallel).
+@router.get("/")
+async def list_nodes(capacity: bool = False):
+    items = nodes.list_nodes()
+    if not capacity:
+        return {"nodes": items}
+    caps, errors = await run_blocking(nodes.fan_out, nodes.capacity, items)
+    for node in items:
+        node["capacity"] = caps.get(node["name"])
+        if node["name"] in errors:
+            node["error"] = errors[node["name"]]
+    return {"nodes": items}
+
+
+# Show where the scheduler would put a VM of this size, with the score of every node.
+@router.get("/schedule")
+async def preview_schedule(vcpus: int = 2, memory_mb: int = 2048, disk_gb: int = 10):
+    try:
+        node, candidates = await run_blocking(nodes.schedule, vcpus, memory_mb, disk_gb)
+    except nodes.NoCapacity as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {"node": node["name"], "candidates": candidates}
+
+
+# One node with its current capacity.
+@router.get("/{name}")
+async def get_node(name: str):
+    try:
+        node = nodes.get_node(name)
+    except nodes.UnknownNode:
+        raise HTTPException(status_code=404, detail=f"node '{name}' not found")
+    try:
+        node["capacity"] = await run_blocking(nodes.capacity, node)
+    except Exception as e:
+        node["error"] = str(e)
+    return node
+
+
+# Register a node. We connect once to make sure the URI works.
+@router.post("/", status_code=201)
+async def add_node(spec: NodeCreate):
+    try:
+        return await run_blocking(nodes.add_node, spec.name, spec.uri)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"can't connect to {spec.uri}: {e}")
+
+
+# Remove a node from the registry (its VMs are left alone).
+@router.delete("/{name}")
+async def remove_node(name: str):
+    try:
+        # Rewrites the registry file and stops the node's inventory (joins its thread): off the loop.
+        await run_blocking(nodes.remove_node, name)
+    except nodes.UnknownNode:
+        raise HTTPException(status_code=404, detail=f"node '{name}' not found")
+    return {"message": f"node '{name}' removed"}
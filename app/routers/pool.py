@@ -0,0 +1,9 @@
+from fastapi import APIRouter  # Import FastAPI routing tools
+from app.services import staging  # Pre-staged disk overlay pool (app/services/staging.py)
+
+router = APIRouter(prefix="/pool", tags=["pool"])  # Create a router for the staging pool status
+
+@router.get("/")
+async def pool_status():
+    # Endpoint to show ready overlays per base image and size, plus hit/miss counters
+    return staging.status()
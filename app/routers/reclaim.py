@@ -0,0 +1,18 @@
+# Status of the background storage reclamation queue (app/services/reclaim.py):
+# files of deleted VMs waiting to be removed, how many bytes that is, and what failed.
+from fastapi import APIRouter
+from app.services import reclaim
+
+router = APIRouter(prefix="/reclaim", tags=["reclaim"])
+
+
+# Pending items and bytes, running count, totals so far and the most recent failures.
+@router.get("/")
+async def reclaim_status():
+    return reclaim.status()
+
+
+# Queue every failed item again (e.g. after fixing permissions or defining a storage pool).
+@router.post("/retry")
+async def retry_failed():
+    return {"queued": reclaim.retry_failed()}
@@ -0,0 +1,37 @@
+# Endpoints for storage pools and base images (app/services/storage.py).
+from typing import Optional
+from fastapi import APIRouter, HTTPException
+from app.services import nodes, storage
+from app.services.executor import run_blocking
+
+router = APIRouter(prefix="/storage", tags=["storage"])
+
+
+# Active storage pools of every node (or ?node=) with capacity, allocation and free space in GiB,
+# whether disks can go there, and their place in the KVM_ORCH_STORAGE_POOLS preference list.
+# Numbers come from a short-lived cache; ?refresh=true asks libvirt again.
+@router.get("/pools")
+async def list_pools(node: Optional[str] = None, refresh: bool = False):
+    try:
+        targets = [nodes.get_node(node)] if node else nodes.list_nodes()
+    except nodes.UnknownNode:
+        raise HTTPException(status_code=404, detail=f"Node '{node}' not found")
+    found, errors = await run_blocking(nodes.fan_out, lambda n: storage.pools(n["uri"], refresh), targets)
+    gib = lambda b: round(b / 1024 ** 3, 1)
+    items = []
+    for target in targets:
+        for pool in found.get(target["name"], []):
+            items.append({
+                "node": target["name"],
+                **{k: v for k, v in pool.items() if k not in ("capacity", "allocation", "available")},
+                "capacity_gb": gib(pool["capacity"]),
+                "allocation_gb": gib(pool["allocation"]),
+                "available_gb": gib(pool["available"]),
+            })
+    return {"pools": items, "preference": storage.STORAGE_POOLS, "errors": errors}
+
+
+# Base images new VMs can use (the `image` field of POST /vms).
+@router.get("/images")
+async def list_images():
+    return {"images": storage.images()}
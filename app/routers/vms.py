@@ -1,50 +1,115 @@
 # Import FastAPI's APIRouter for organizing endpoints and HTTPException for error handling.
 # (FastAPI docs: https://fastapi.tiangolo.com/tutorial/bigger-applications/)
-from fastapi import APIRouter, HTTPException
+from typing import Optional
+import libvirt
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import ValidationError
 # Import the CreateVm model (defines the expected structure for VM creation requests) from app/models.py.
-from app.models import CreateVm
-# Import the create_vm function (handles VM creation logic) from app/services/vm_create.py.
-from app.services.vm_create import create_vm
+from app.models import CreateVm, BatchCreateVm, CloneVm, VmAction, VmResources, VmSelector
+# Import the provision_vm pipeline (disk, cloud-init, domain, DHCP wait) from app/services/vm_create.py.
+from app.services.vm_create import DISK_BACKEND, provision_vm, provision_batch
+# Linked clones of existing VMs (app/services/clone.py).
+from app.services.clone import clone_vms
+# Live memory / vCPU changes (app/services/resources.py).
+from app.services import resources
+# Background job registry (bounded worker pool + status tracking) from app/services/jobs.py.
+from app.services import jobs
 # Import VM lifecycle functions from app/services/libvirt_client.py.
 from app.services.libvirt_client import (
-    list_vms, get_vm_info, vm_start, vm_shutdown, vm_destroy, vm_delete,
-    get_vm_macs,  # <- added 08112025
+    vm_start, vm_shutdown, vm_destroy, vm_delete,
 )
+# Read paths (list/get) are served from the event-fed inventory cache in app/services/inventory.py.
+from app.services.inventory import get_vm_info
+# Node registry: which hypervisor a VM lives on (app/services/nodes.py).
+from app.services import nodes
+# Registered base images for new disks (app/services/storage.py).
+from app.services import storage
+# Filtered, projected and paginated VM listing across all nodes (app/services/listing.py).
+from app.services import listing
+# Fleet-wide actions on selector-matched VMs from app/services/actions.py.
+from app.services.actions import run_action
+from app.services.selectors import is_empty
+# Per-VM performance history from the background collector (app/services/stats.py).
+from app.services import stats
+# Event-driven IP lookup (guest agent, DHCP leases, ARP) from app/services/addresses.py.
+from app.services.addresses import wait_for_vm_ip
+# Handlers are `async def`; blocking libvirt calls run on a dedicated bounded pool (app/services/executor.py).
+from app.services.executor import run_blocking
 
 
-import subprocess, re, time # Added on 08102025
-
 # Create a router for all VM-related endpoints. All routes here will be prefixed with '/vms' and tagged as 'vms' in docs.
 router = APIRouter(prefix="/vms", tags=["vms"])
 
 
+# Helper: find the node a VM lives on, or answer 404.
+async def _locate(name: str) -> dict:
+    node = await run_blocking(nodes.locate, name)
+    if node is None:
+        raise HTTPException(status_code=404, detail=f"VM '{name}' not found")
+    return node
+
+
 
-# List all virtual machines.
-# Calls list_vms() from app/services/libvirt_client.py and returns a JSON list of VMs.
+# List virtual machines on all nodes.
+# Served from every node's inventory cache (live libvirt fallback); each VM carries the name of its "node".
+#   ?details=true             also vcpus and memory (or pick exactly what you need with ?fields=name,state,tags)
+#   ?state=running&active=true&prefix=web-&regex=web-[0-9]+&tag=prod   server-side filters (all must match)
+#   ?limit=100&cursor=...     pagination; follow "next_cursor" until it is null
+#   ?format=ndjson            (or Accept: application/x-ndjson) stream one JSON object per line as each
+#                             node answers, for a fast first byte on very large fleets
+# Nodes that can't be reached are listed under "errors".
 @router.get("/")
-def get_vms():
-    return {"vms": list_vms()}
+async def get_vms(request: Request, details: bool = False, fields: Optional[str] = None,
+                  state: Optional[str] = None, active: Optional[bool] = None, prefix: Optional[str] = None,
+                  regex: Optional[str] = None, tag: Optional[str] = None,
+                  limit: Optional[int] = Query(default=None, ge=1, le=5000), cursor: Optional[str] = None,
+                  format: Optional[str] = Query(default=None, pattern="^(json|ndjson)$")):
+    try:
+        wanted = listing.parse_fields(fields, details)
+        selector = VmSelector(state=state, active=active, prefix=prefix, regex=regex, tag=tag)
+    except (ValueError, ValidationError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if format == "ndjson" or "application/x-ndjson" in request.headers.get("accept", ""):
+        if cursor:
+            raise HTTPException(status_code=400, detail="cursor is not supported with ndjson; use limit or filters")
+        return StreamingResponse(listing.stream_ndjson(wanted, selector, limit), media_type="application/x-ndjson")
+
+    try:
+        vms, next_cursor, errors = await run_blocking(listing.list_page, wanted, selector, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    result = {"vms": vms}
+    if limit is not None:
+        result["next_cursor"] = next_cursor
+    if errors:
+        result["errors"] = errors
+    # Plain dicts of JSON types: skip FastAPI's per-item jsonable_encoder pass (costly for big fleets).
+    return JSONResponse(result)
 
 
 
 # Get information about a specific VM by name.
-# Calls get_vm_info() from app/services/libvirt_client.py.
+# Calls get_vm_info() from app/services/inventory.py (cached, live libvirt fallback).
 @router.get("/{name}")
-def get_vm(name: str):
-    info = get_vm_info(name)
+async def get_vm(name: str):
+    node = await _locate(name)
+    info = await run_blocking(get_vm_info, name, uri=node["uri"])
     if not info:
         # If the VM is not found, return a 404 error.
         raise HTTPException(status_code=404, detail=f"VM '{name}' not found")
-    return info
+    return {**info, "node": node["name"]}
 
 
 
 # Start a specific VM by name.
 # Calls vm_start() from app/services/libvirt_client.py.
 @router.post("/{name}/start")
-def start_vm(name: str):
+async def start_vm(name: str):
+    uri = (await _locate(name))["uri"]
     try:
-        vm_start(name)
+        await run_blocking(vm_start, name, uri)
         return {"message": f"VM '{name}' started"}
     except Exception as e:
         # If something goes wrong, return a 400 error with the error message.
@@ -55,9 +120,10 @@ def start_vm(name: str):
 # Gracefully shut down a specific VM by name.
 # Calls vm_shutdown() from app/services/libvirt_client.py.
 @router.post("/{name}/shutdown")
-def shutdown_vm(name: str):
+async def shutdown_vm(name: str):
+    uri = (await _locate(name))["uri"]
     try:
-        vm_shutdown(name)
+        await run_blocking(vm_shutdown, name, uri)
         return {"message": f"VM '{name}' shutdown signaled"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -67,143 +133,241 @@ def shutdown_vm(name: str):
 # Force-stop (destroy) a specific VM by name.
 # Calls vm_destroy() from app/services/libvirt_client.py.
 @router.post("/{name}/destroy")
-def destroy_vm(name: str):
+async def destroy_vm(name: str):
+    uri = (await _locate(name))["uri"]
     try:
-        vm_destroy(name)
+        await run_blocking(vm_destroy, name, uri)
         return {"message": f"VM '{name}' force-stopped"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
-# Create a new VM using the provided specification.
-# Expects a JSON body matching the CreateVm model (see app/models.py).
-# Calls create_vm() from app/services/vm_create.py, which handles disk, cloud-init, and libvirt domain creation.
-@router.post("/")
-def create_vm_endpoint(spec: CreateVm):
-    # 1) Reject duplicate names early
-    if get_vm_info(spec.name) is not None:
-        raise HTTPException(status_code=409, detail=f"VM '{spec.name}' already exists")
+# Helper: a pinned node must exist (400 otherwise); None means "let the scheduler pick".
+def _check_node(name: Optional[str]) -> None:
+    if name is not None:
+        try:
+            nodes.get_node(name)
+        except nodes.UnknownNode:
+            raise HTTPException(status_code=400, detail=f"unknown node '{name}'")
 
-    # 2) Create the VM (non-blocking)
-    create_vm(
-        name=spec.name,
-        vcpus=spec.vcpus,
-        memory_mb=spec.memory_mb,
-        disk_gb=spec.disk_gb,
-        network=spec.network,
-        ssh_pubkey=spec.ssh_pubkey,
-    )
+# Helper: the base image must be registered (400 otherwise); None means the default image.
+def _check_image(name: Optional[str]) -> None:
+    try:
+        storage.image_path(name)
+    except storage.UnknownImage:
+        raise HTTPException(status_code=400, detail=f"unknown base image '{name}' (see GET /storage/images)")
 
-    # 3) Poll DHCP by MAC (more reliable than hostname)
-    macs = get_vm_macs(spec.name)
-    ip = _wait_for_ip(macs=macs, network=spec.network, timeout=120, interval=2)
+# Helper: libvirt can't preallocate a pool volume that has a backing store, so with the default
+# "pool" disk backend only thin disks can be made (400 otherwise).
+def _check_preallocation(preallocation: str) -> None:
+    if preallocation != "off" and DISK_BACKEND != "qemu-img":
+        raise HTTPException(status_code=400, detail=f"preallocation '{preallocation}' needs KVM_ORCH_DISK_BACKEND=qemu-img; "
+                                                    "storage pool overlays are always thin")
 
-    return {"message": f"VM '{spec.name}' created", "name": spec.name, "ip": ip}
+# Create a new VM using the provided specification.
+# Expects a JSON body matching the CreateVm model (see app/models.py).
+# The create pipeline (disk, cloud-init, libvirt domain, DHCP wait) runs as a background job
+# via provision_vm() in app/services/vm_create.py. By default we answer 202 with the job id;
+# follow progress at GET /jobs/{id}. Pass ?wait=true to block until the VM has an IP (old behaviour).
+@router.post("/", status_code=202)
+async def create_vm_endpoint(spec: CreateVm, response: Response, wait: bool = False):
+    # 1) Reject duplicate names early (existing domain on any node; a create already in flight is
+    #    caught when the job is queued, in the same step that reserves the name)
+    if await run_blocking(nodes.locate, spec.name) is not None:
+        raise HTTPException(status_code=409, detail=f"VM '{spec.name}' already exists")
+    _check_node(spec.node)
+    _check_image(spec.image)
+    _check_preallocation(spec.preallocation)
 
-def _wait_for_ip(macs: list[str], network: str = "default", timeout: int = 120, interval: int = 2) -> str | None:
-    """
-    Poll `virsh net-dhcp-leases <network>` and match leases by MAC addresses.
-    Return IPv4 string or None if not found within timeout.
-    """
-    macs = [m.lower() for m in (macs or [])]
-    deadline = time.time() + timeout
-    ip_re = re.compile(r"(\d+\.\d+\.\d+\.\d+)/\d+")
-    while time.time() < deadline:
-        try:
-            out = subprocess.check_output(["virsh", "net-dhcp-leases", network], text=True)
-            for line in out.splitlines():
-                line_l = line.lower()
-                if any(mac in line_l for mac in macs):
-                    m = ip_re.search(line)
-                    if m:
-                        return m.group(1)
-        except subprocess.CalledProcessError:
-            pass
-        time.sleep(interval)
-    return None
+    # 2) Queue the pipeline on the bounded job pool
+    try:
+        job = jobs.submit_unique("create_vm", provision_vm, spec, target=spec.name, names=[spec.name])
+    except jobs.NameInUse:
+        raise HTTPException(status_code=409, detail=f"VM '{spec.name}' already exists")
+    if wait:
+        # 3a) Wait for the job without holding a thread, then return the final result
+        await job.wait_async()
+        if job.status == "failed":
+            raise HTTPException(status_code=500, detail=job.error)
+        response.status_code = 200
+        return {"message": f"VM '{spec.name}' created", "name": spec.name, "node": job.result["node"],
+                "ip": job.result["ip"], "job_id": job.id}
+
+    # 3b) Return immediately
+    return {"message": f"VM '{spec.name}' creation queued", "name": spec.name, "job_id": job.id, "job": job.as_dict()}
+
+# Create many VMs in one call: a list of specs, or count + name pattern (see BatchCreateVm in app/models.py).
+# Runs as one "create_batch" job with up to `concurrency` VMs provisioned in parallel; each VM is an item
+# with its own status, and failures don't stop the others. 202 + job id by default, ?wait=true to block.
+@router.post("/batch", status_code=202)
+async def create_vms_batch(batch: BatchCreateVm, response: Response, wait: bool = False):
+    specs = batch.specs()
+    for spec in specs:
+        _check_node(spec.node)
+        _check_image(spec.image)
+        _check_preallocation(spec.preallocation)
+    # Names already taken (or being created) fail as items instead of rejecting the whole batch.
+    # The free ones are reserved for this job as it is queued.
+    exists = lambda name: nodes.locate(name) is not None
+    job = jobs.submit_unique("create_batch", provision_batch, specs, batch.concurrency,
+                             names=[spec.name for spec in specs], skip_taken=True, exists=exists)
+    if wait:
+        await job.wait_async()
+        response.status_code = 200
+        return job.as_dict()
+    return {"message": f"batch of {len(specs)} VMs queued", "job_id": job.id, "job": job.as_dict()}
+
+# Make linked clones of an existing VM (see CloneVm in app/models.py and app/services/clone.py):
+# the source is frozen with a disk-only snapshot and every clone gets qcow2 overlays of its disks,
+# a new name, UUID and MACs, and (by default) a fresh cloud-init seed. Clones go on the source's node.
+# Runs as one "clone_vm" job; 202 + job id by default, ?wait=true to block until all clones are defined.
+@router.post("/{name}/clone", status_code=202)
+async def clone_vm_endpoint(name: str, spec: CloneVm, response: Response, wait: bool = False):
+    node = await _locate(name)
+    names = spec.clone_names()
+    existing = [n for n, node_of in zip(names, await run_blocking(lambda: [nodes.locate(n) for n in names])) if node_of]
+    if existing:
+        raise HTTPException(status_code=409, detail=f"VMs already exist: {', '.join(existing)}")
+    try:
+        job = jobs.submit_unique("clone_vm", clone_vms, name, node, spec, target=name, names=names)
+    except jobs.NameInUse as e:
+        raise HTTPException(status_code=409, detail=f"VMs already exist: {e}")
+    if wait:
+        await job.wait_async()
+        if job.status == "failed":
+            raise HTTPException(status_code=500, detail=job.error)
+        response.status_code = 200
+        return job.as_dict()
+    return {"message": f"{len(names)} clones of '{name}' queued", "job_id": job.id, "job": job.as_dict()}
+
+# Start / shutdown / destroy / reboot every VM matched by a selector (see VmAction in app/models.py).
+# Runs up to `concurrency` VMs at a time and answers with one result per VM.
+# Pass ?background=true to get a job id right away instead (202, follow it at GET /jobs/{id}).
+# A shutdown with wait=true always runs as a job: it can take up to `deadline` (an hour) and must
+# not hold the blocking pool that every other request shares.
+@router.post("/actions")
+async def vm_actions(req: VmAction, response: Response, background: bool = False):
+    if is_empty(req.selector):
+        raise HTTPException(status_code=400, detail="empty selector; set names/glob/regex/state/tag or all=true")
+    if background or (req.action == "shutdown" and req.wait):
+        job = jobs.submit("vm_action", run_action, req, target=req.action)
+        response.status_code = 202
+        return {"message": f"{req.action} queued", "job_id": job.id, "job": job.as_dict()}
+    return await run_blocking(run_action, None, req)
+
+# Delete every VM matched by the selector in the query string, e.g.
+#   DELETE /vms/?prefix=test-        DELETE /vms/?names=a,b,c        DELETE /vms/?glob=ci-*&state=shutoff
+# Same filters as GET /vms plus names / glob; all=true matches every VM. The whole selector can also
+# be passed as JSON: ?selector={"tag":"ci","state":"shutoff"} (see VmSelector). Domains are undefined
+# up to `concurrency` at a time and their files queued for background removal (GET /reclaim).
+# ?background=true answers 202 with a job id instead.
+@router.delete("/")
+async def delete_vms(response: Response, selector: Optional[str] = None,
+                     names: Optional[str] = None, glob: Optional[str] = None,
+                     prefix: Optional[str] = None, regex: Optional[str] = None, state: Optional[str] = None,
+                     active: Optional[bool] = None, tag: Optional[str] = None, all: bool = False,
+                     concurrency: int = Query(default=10, ge=1, le=100), wipe: bool = False,
+                     background: bool = False):
+    try:
+        if selector is not None:
+            chosen = VmSelector.model_validate_json(selector)
+        else:
+            chosen = VmSelector(names=names.split(",") if names else [], glob=glob, prefix=prefix, regex=regex,
+                                state=state, active=active, tag=tag, all=all)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await vm_actions(VmAction(action="delete", selector=chosen, concurrency=concurrency, wipe=wipe),
+                            response, background)
 
 # Delete a VM by name.
-# Calls vm_delete() from app/services/libvirt_client.py, which stops, undefines, and removes all storage for the VM.
+# Calls vm_delete() from app/services/libvirt_client.py, which stops and undefines the VM right away
+# and queues its disks, seed and NVRAM for removal in the background (see GET /reclaim).
 @router.delete("/{name}")
-def delete_vm(name: str):
+async def delete_vm(name: str, wipe: bool = False):
+    uri = (await _locate(name))["uri"]
     try:
-        vm_delete(name)
-        return {"message": f"VM '{name}' deleted"}
+        queued = await run_blocking(vm_delete, name, uri, wipe)
+        return {"message": f"VM '{name}' deleted", **queued}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 
 @router.get("/{name}/ip")
-def vm_ip(name: str, network: str = "default", timeout: int = 5):
+async def vm_ip(name: str, network: str = "default", timeout: int = Query(default=5, ge=0, le=300),
+                wait: Optional[int] = Query(default=None, ge=0, le=300)):
     """
-    Return the VM's IPv4 address. This function tries two methods:
-    1. Use the guest agent (virsh domifaddr) to get the IP from inside the VM.
-    2. If that fails, look up the IP in the DHCP leases by matching the VM's MAC address.
-    The `timeout` parameter controls how long to wait for each method.
+    Return the VM's IPv4 address, asking libvirt directly (no virsh subprocesses):
+    1. The in-memory DHCP lease index for the VM's networks (app/services/leases.py).
+    2. dom.interfaceAddresses() with the guest agent, DHCP lease and ARP sources.
+    `wait` makes this a long-poll: the request is held until an address appears or
+    `wait` seconds pass, woken by guest-agent/lifecycle events and lease changes.
+    `timeout` is the older name for the same thing and is used when `wait` is not given.
+    Both are capped at 300 seconds so a client can't hold a request (and its event listeners) open forever.
     """
-    # Try to get the IP address using the guest agent (domifaddr) first.
-    # This method asks the VM directly (if the guest agent is running inside the VM).
-    ip = _ip_via_domifaddr(name, timeout=timeout)
-    if ip:
-        # If we got an IP from the guest agent, return it with the source info.
-        return {"name": name, "ip": ip, "source": "guest-agent"}
-
-    # If the guest agent method didn't work, try to get the IP from DHCP leases.
-    # First, get the list of MAC addresses for this VM.
-    macs = get_vm_macs(name)
-    # Now, try to find the IP by looking up the MAC addresses in the DHCP leases.
-    ip = _ip_via_dhcp(macs=macs, network=network, timeout=timeout)
+    uri = (await _locate(name))["uri"]
+    try:
+        ip, source = await wait_for_vm_ip(name, timeout=wait if wait is not None else timeout, network=network, uri=uri)
+    except libvirt.libvirtError:
+        # The VM doesn't exist (or libvirt can't find it).
+        raise HTTPException(status_code=404, detail=f"VM '{name}' not found")
     if ip:
-        # If we found an IP in the DHCP leases, return it with the source info.
-        return {"name": name, "ip": ip, "source": "dhcp-leases"}
+        # Return the IP with where it came from (guest-agent, dhcp-leases or arp).
+        return {"name": name, "ip": ip, "source": source}
 
-    # If neither method worked, return a 404 error saying no IP was found.
+    # If no method found an address in time, return a 404 error saying no IP was found.
     raise HTTPException(status_code=404, detail=f"No IP found for {name}")
-# Helper function to get IP via guest agent (domifaddr).
-def _ip_via_domifaddr(name: str, timeout: int = 5) -> str | None:
-    """
-    Try to get the VM's IP address using the guest agent (virsh domifaddr).
-    This function will keep trying for up to `timeout` seconds.
-    Returns the IP address as a string if found, or None if not found.
-    """
-    deadline = time.time() + timeout  # Calculate the time when we should stop trying.
-    ip_re = re.compile(r"(\d+\.\d+\.\d+\.\d+)/\d+")  # Regex to match IPv4 addresses like 192.168.1.10/24
-    while time.time() < deadline:
-        try:
-            # Run the command: virsh domifaddr <name> to get the VM's network info from the guest agent.
-            out = subprocess.check_output(["virsh", "domifaddr", name], text=True)
-            # Search the output for an IPv4 address using the regex.
-            m = ip_re.search(out)
-            if m:
-                # If we found an IP address, return just the IP part (not the /24 subnet).
-                return m.group(1)
-        except subprocess.CalledProcessError:
-            # If the command fails (e.g., guest agent not running), just ignore and try again.
-            pass
-        # Wait 1 second before trying again (so we don't spam the system).
-        time.sleep(1)
-    # If we never found an IP, return None.
-    return None
-
-def _ip_via_dhcp(macs: list[str], network: str = "default", timeout: int = 5) -> str | None:
-    """
-    Poll virsh net-dhcp-leases and match leases by MAC addresses.
-    """
-    macs = [m.lower() for m in (macs or [])]
-    deadline = time.time() + timeout
-    ip_re = re.compile(r"(\d+\.\d+\.\d+\.\d+)/\d+")
-    while time.time() < deadline:
-        try:
-            out = subprocess.check_output(["virsh", "net-dhcp-leases", network], text=True)
-            for line in out.splitlines():
-                line_l = line.lower()
-                if any(mac in line_l for mac in macs):
-                    m = ip_re.search(line)
-                    if m:
-                        return m.group(1)
-        except subprocess.CalledProcessError:
-            pass
-        time.sleep(1)
-    return None
 
 
+
+# Recent performance of a VM: CPU %, memory, disk IOPS / bytes per second and network bytes per second,
+# one point per collector interval, plus avg/max over the window (e.g. ?window=30s, 5m, 1h).
+# Served from the collector's in-memory ring buffer; no libvirt calls.
+@router.get("/{name}/stats")
+async def vm_stats(name: str, window: str = "5m"):
+    try:
+        seconds = stats.parse_window(window)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"bad window '{window}', use e.g. 90s, 5m or 1h")
+    node = await _locate(name)
+    collector = stats.get()
+    if collector is None:
+        raise HTTPException(status_code=503, detail="stats collector disabled (KVM_ORCH_STATS_INTERVAL=0)")
+    points = collector.series(node["name"], name, seconds)
+    return {
+        "name": name,
+        "node": node["name"],
+        "window_seconds": seconds,
+        "interval_seconds": collector.interval,
+        "summary": stats.summarize(points),
+        "points": points,
+    }
+
+
+
+# Memory and vCPUs of a VM: current and maximum, of the running VM ("live", null when shut off)
+# and of its definition used from the next boot ("config"), plus its auto-balloon policy.
+@router.get("/{name}/resources")
+async def vm_resources(name: str):
+    uri = (await _locate(name))["uri"]
+    try:
+        return await run_blocking(resources.get_resources, name, uri)
+    except libvirt.libvirtError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+# Resize a VM without recreating it (see VmResources in app/models.py), e.g.
+#   {"memory_mb": 4096}                       balloon to 4 GiB, now and from the next boot
+#   {"vcpus": 4, "config": false}             hot-plug to 4 vCPUs until the next boot
+#   {"max_memory_mb": 16384}                  more headroom, from the next boot
+#   {"auto_balloon": true, "balloon_min_mb": 1024}   let the balloon controller manage it
+# Answers with the new sizes (as GET). 400 if the change is outside the VM's maximums,
+# 409 if libvirt or the guest refuses it (e.g. no balloon driver, vCPU unplug declined).
+@router.patch("/{name}/resources")
+async def patch_vm_resources(name: str, req: VmResources):
+    uri = (await _locate(name))["uri"]
+    try:
+        return await run_blocking(resources.set_resources, name, req, uri)
+    except resources.ResourceError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except libvirt.libvirtError as e:
+        raise HTTPException(status_code=409, detail=str(e))
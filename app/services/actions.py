@@ -0,0 +1,134 @@
+# app/services/actions.py
+#
+# Fleet-wide lifecycle actions: start / shutdown / destroy / reboot every VM matched by a
+# selector (see app/services/selectors.py) on every node, with at most `concurrency` VMs in flight.
+# Each VM gets its own result so one failure doesn't hide the others.
+#
+# Graceful shutdown can optionally wait until the VM is really off. The wait listens for
+# the libvirt "stopped" lifecycle event through the inventory (app/services/inventory.py)
+# instead of polling; only when the inventory isn't running do we poll once a second.
+# VMs still running at the deadline can be forced off (escalate to destroy).
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
+
+import libvirt
+
+from app.models import VmAction
+from app.services import inventory, nodes
+from app.services.libvirt_client import connection, vm_delete, vm_destroy, vm_reboot, vm_shutdown, vm_start
+from app.services.selectors import select_vms
+
+log = logging.getLogger(__name__)
+
+# How often the event-driven wait re-checks the state anyway, in case an event was missed.
+EVENT_RECHECK = 5.0
+# Poll interval when no inventory (and so no events) is available.
+POLL_INTERVAL = 1.0
+
+
+def _is_off(name: str, uri: Optional[str] = None) -> bool:
+    with connection(uri) as conn:
+        try:
+            return conn.lookupByName(name).isActive() != 1
+        except libvirt.libvirtError:
+            return True  # transient VM that went away when it stopped
+
+
+def wait_for_shutoff(name: str, timeout: float, uri: Optional[str] = None) -> bool:
+    """Block until the VM is shut off or `timeout` seconds pass. Returns True if it is off."""
+    stopped = threading.Event()
+
+    def on_event(kind, vm_name, uuid, detail):
+        if kind == "lifecycle" and vm_name == name and detail["event"] == libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            stopped.set()
+
+    # Subscribe before the first check so a stop in between can't be missed.
+    subscribed = inventory.add_listener(on_event, uri)
+    try:
+        deadline = time.monotonic() + timeout
+        while not stopped.is_set():
+            if _is_off(name, uri):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            stopped.wait(min(remaining, EVENT_RECHECK if subscribed else POLL_INTERVAL))
+        return True
+    finally:
+        if subscribed:
+            inventory.remove_listener(on_event, uri)
+
+
+def _act(req: VmAction, node: dict, vm: dict) -> dict:
+    name, uri = vm["name"], node["uri"]
+    result = {"name": name, "node": node["name"], "ok": True, "result": None, "error": None}
+    started = time.monotonic()
+    try:
+        if req.action == "start":
+            vm_start(name, uri)  # no-op for running VMs
+            result["result"] = "started"
+        elif req.action in ("shutdown", "destroy") and vm["state"] == "shutoff":
+            result["result"] = "already shut off"
+        elif req.action == "destroy":
+            vm_destroy(name, uri)
+            result["result"] = "destroyed"
+        elif req.action == "reboot":
+            vm_reboot(name, uri)
+            result["result"] = "reboot signaled"
+        elif req.action == "delete":
+            # Fast: undefine now, files are removed by the reclamation workers.
+            queued = vm_delete(name, uri, wipe=req.wipe)
+            result["result"] = f"deleted ({len(queued['reclaim'])} files, {queued['pending_bytes']} bytes queued)"
+        else:
+            vm_shutdown(name, uri)
+            result["result"] = "shutdown signaled"
+            if req.wait:
+                if wait_for_shutoff(name, req.deadline, uri):
+                    result["result"] = "shut off"
+                elif req.escalate:
+                    vm_destroy(name, uri)
+                    result["result"] = f"destroyed (still running after {req.deadline}s)"
+                else:
+                    result["ok"] = False
+                    result["error"] = f"still running after {req.deadline}s"
+    except Exception as e:
+        # One VM failing (libvirt error, reclaim refusing a file, ...) must not lose the results of the rest.
+        if not isinstance(e, libvirt.libvirtError):
+            log.exception("%s of VM %s failed", req.action, name)
+        result["ok"] = False
+        result["error"] = str(e)
+    result["seconds"] = round(time.monotonic() - started, 2)
+    return result
+
+
+def run_action(job, req: VmAction) -> dict:
+    """
+    Apply req.action to every VM matched by req.selector on all nodes. `job` may be None (inline
+    call); when given, its progress is updated as VMs finish. Returns a summary plus per-VM results.
+    """
+    matched, errors = nodes.fan_out(lambda node: select_vms(req.selector, node["uri"]))
+    vms = [(node, vm) for node in nodes.list_nodes() for vm in matched.get(node["name"], [])]
+    results = []
+    if vms:
+        with ThreadPoolExecutor(max_workers=min(req.concurrency, len(vms)),
+                                thread_name_prefix=f"vm-{req.action}") as pool:
+            futures = [pool.submit(_act, req, node, vm) for node, vm in vms]
+            for future in as_completed(futures):
+                results.append(future.result())
+                if job is not None:
+                    job.update(f"{req.action} ({len(results)}/{len(vms)} done)", int(100 * len(results) / len(vms)))
+    results.sort(key=lambda r: (r["name"], r["node"]))
+    failed = sum(1 for r in results if not r["ok"])
+    summary = {
+        "action": req.action,
+        "matched": len(vms),
+        "succeeded": len(results) - failed,
+        "failed": failed,
+        "results": results,
+    }
+    if errors:
+        summary["errors"] = errors  # nodes we couldn't select on
+    return summary
@@ -0,0 +1,92 @@
+# VM IP address lookup without subprocesses or sleep loops.
+#
+# find_vm_ip() (app/services/libvirt_client.py) asks libvirt directly through
+# dom.interfaceAddresses() using the guest agent, DHCP lease and ARP sources.
+# wait_for_vm_ip() turns that into an async long-poll: it checks once, then awaits an
+# asyncio.Event that is set by
+#   - guest-agent and lifecycle events for the VM (from the inventory event thread), and
+#   - changes in the shared DHCP lease index of the VM's networks (app/services/leases.py),
+# and only re-checks when one of those fires.
+import asyncio
+from typing import Optional
+
+from app.services import inventory, leases
+from app.services.executor import run_blocking
+from app.services.libvirt_client import find_vm_ip, get_vm_macs, cached_facts
+
+# The agent sends no event when the guest finishes configuring its NIC, so unless
+# we know the agent is disconnected we also re-ask libvirt with a backoff starting
+# at AGENT_RECHECK_MIN and capped at AGENT_RECHECK_MAX seconds (much rarer than the
+# old one-fork-per-second loop; events and lease changes still wake us at once).
+AGENT_RECHECK_MIN = 0.5
+AGENT_RECHECK_MAX = 5.0
+
+
+async def wait_for_vm_ip(name: str, timeout: float, network: Optional[str] = None,
+                         uri: Optional[str] = None) -> tuple[Optional[str], Optional[str]]:
+    """
+    Return (ip, source) for the VM, waiting up to `timeout` seconds for one to appear.
+    Returns (None, None) on timeout. Raises libvirt.libvirtError if the VM doesn't exist.
+    A coroutine: while waiting it holds no thread; libvirt calls run on the blocking pool.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    wake = asyncio.Event()
+    ask_agent = True                  # ask libvirt once up front, then when the agent/state changes
+    agent = {"connected": None}       # None = unknown, else last agent lifecycle state
+
+    # The listeners below are called from the inventory and lease poller threads,
+    # so they hand over to the event loop instead of touching `wake` directly.
+    def wake_up():
+        loop.call_soon_threadsafe(wake.set)
+
+    def on_domain_event(kind, dom_name, uuid, detail):
+        nonlocal ask_agent
+        if dom_name != name or kind not in ("agent", "lifecycle"):
+            return
+        if kind == "agent":
+            agent["connected"] = detail["connected"]
+        ask_agent = True
+        wake_up()
+
+    # MACs and networks come from the inventory cache when it is running.
+    facts = cached_facts(name, uri)
+    macs = facts["macs"] if facts else await run_blocking(get_vm_macs, name, uri)
+    networks = list((facts or {}).get("networks") or [])  # a copy: the facts are shared with the cache
+    if network and network not in networks:
+        networks.append(network)
+    indexes = [leases.get_index(n, uri) for n in networks]
+
+    inventory.add_listener(on_domain_event, uri)
+    for index in indexes:
+        index.add_listener(wake_up)
+    try:
+        recheck = AGENT_RECHECK_MIN
+        while True:
+            # 1) In-memory DHCP lease index: no libvirt call at all.
+            for index in indexes:
+                ip = index.find_ip(macs)
+                if ip:
+                    return ip, "dhcp-leases"
+            # 2) Ask libvirt (agent, then lease, then ARP) only when something changed.
+            if ask_agent:
+                ask_agent = False
+                ip, source = await run_blocking(find_vm_ip, name, uri)
+                if ip:
+                    return ip, source
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None, None
+            # Agent up (or unknown) but no address yet: also re-ask with backoff.
+            backoff = agent["connected"] is not False
+            try:
+                await asyncio.wait_for(wake.wait(), min(remaining, recheck) if backoff else remaining)
+            except asyncio.TimeoutError:
+                if backoff:
+                    ask_agent = True
+                    recheck = min(recheck * 2, AGENT_RECHECK_MAX)
+            wake.clear()
+    finally:
+        inventory.remove_listener(on_domain_event, uri)
+        for index in indexes:
+            index.remove_listener(wake_up)
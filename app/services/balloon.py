@@ -0,0 +1,277 @@
+# app/services/balloon.py
+#
+# Auto-balloon controller: move memory from idle guests to busy ones, so more VMs fit on a node.
+#
+# Guests are created with headroom (CreateVm max_memory_mb) and run with less. Every
+# KVM_ORCH_BALLOON_INTERVAL seconds one thread asks each node for the balloon counters of all
+# running VMs in a single getAllDomainStats(VIR_DOMAIN_STATS_BALLOON) call (the same counters
+# dom.memoryStats() returns: actual, unused, available, usable, swap_in) and decides per VM:
+#   - shrink: more than KVM_ORCH_BALLOON_HIGH_FREE of its memory is free, so give some back
+#     (at most KVM_ORCH_BALLOON_STEP_MB per round, never below the VM's floor);
+#   - grow:   less than KVM_ORCH_BALLOON_LOW_FREE is free, or the guest is swapping, so give it
+#     more (up to its ceiling, and only what the node has free above KVM_ORCH_HOST_RESERVED_MB);
+#   - hold:   anything in between.
+# Both aim for KVM_ORCH_BALLOON_TARGET_FREE free memory. "Free" is the guest's usable memory
+# (what it can get without swapping, page cache included) or, on older guests, its unused memory.
+#
+# Per-VM bounds come from the VM's policy (PATCH /vms/{name}/resources: auto_balloon,
+# balloon_min_mb, balloon_max_mb); without one the floor is KVM_ORCH_BALLOON_FLOOR_MB and the
+# ceiling the VM's maximum memory. With KVM_ORCH_BALLOON_SCOPE=opt-in (the default) only VMs
+# with auto_balloon=true are managed; with "all" every running VM is, unless it opted out.
+#
+# KVM_ORCH_BALLOON=dry-run runs the same loop but only reports what it would do (GET /balloon).
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import libvirt
+
+from app.services import nodes
+from app.services.libvirt_client import balloon_policy, cached_facts, connection
+
+log = logging.getLogger(__name__)
+
+# "off" (default), "dry-run" (decide and report only) or "on" (decide and resize).
+BALLOON_MODE = os.environ.get("KVM_ORCH_BALLOON", "off")
+# Seconds between rounds.
+BALLOON_INTERVAL = float(os.environ.get("KVM_ORCH_BALLOON_INTERVAL", "30"))
+# "opt-in": only VMs with auto_balloon=true; "all": every running VM that hasn't opted out.
+BALLOON_SCOPE = os.environ.get("KVM_ORCH_BALLOON_SCOPE", "opt-in")
+# Smallest size a VM is shrunk to when its policy sets no balloon_min_mb.
+BALLOON_FLOOR_MB = int(os.environ.get("KVM_ORCH_BALLOON_FLOOR_MB", "512"))
+# Share of a guest's memory we aim to leave free, and the band outside which we act.
+BALLOON_TARGET_FREE = float(os.environ.get("KVM_ORCH_BALLOON_TARGET_FREE", "0.25"))
+BALLOON_LOW_FREE = float(os.environ.get("KVM_ORCH_BALLOON_LOW_FREE", "0.10"))
+BALLOON_HIGH_FREE = float(os.environ.get("KVM_ORCH_BALLOON_HIGH_FREE", "0.40"))
+# Most memory taken from one VM per round; guests hand memory back gradually.
+BALLOON_STEP_MB = int(os.environ.get("KVM_ORCH_BALLOON_STEP_MB", "1024"))
+
+MODES = ("off", "dry-run", "on")
+# Changes smaller than this aren't worth a balloon move.
+MIN_CHANGE_KIB = 64 * 1024
+# Seconds between the guest's balloon stats updates, asked for when a VM reports none yet.
+STATS_PERIOD = 5
+
+
+# ----- the policy -----
+def decide(sample: dict, floor_kib: int, ceiling_kib: int, swapping: bool = False) -> dict:
+    """
+    What to do with one VM. `sample` has "current" and "free" in KiB ("free" None when the guest
+    reports no balloon stats). Returns {"action": grow|shrink|hold|skip, "reason", "target_kib"}.
+    """
+    current, free = sample["current"], sample["free"]
+    hold = lambda reason: {"action": "hold", "reason": reason, "target_kib": current}
+    if free is None:
+        return {"action": "skip", "reason": "no balloon stats from the guest (virtio balloon driver missing?)",
+                "target_kib": current}
+    ceiling_kib = max(ceiling_kib, floor_kib)
+    free = min(free, current)  # counters are sampled at different times and can disagree
+    used = current - free
+    ideal = int(used / (1 - BALLOON_TARGET_FREE))
+    free_share = free / current if current else 0.0
+
+    if current < floor_kib:
+        target, reason = floor_kib, "below its floor"
+    elif current > ceiling_kib:
+        target, reason = ceiling_kib, "above its ceiling"
+    elif swapping or free_share < BALLOON_LOW_FREE:
+        # Under pressure: straight to the target share, at least one step while it swaps.
+        target = max(ideal, current + BALLOON_STEP_MB * 1024) if swapping else ideal
+        target = min(target, ceiling_kib)
+        reason = "guest is swapping" if swapping else f"only {free_share:.0%} free"
+    elif free_share > BALLOON_HIGH_FREE:
+        target = max(ideal, current - BALLOON_STEP_MB * 1024, floor_kib)
+        reason = f"{free_share:.0%} free"
+    else:
+        return hold(f"{free_share:.0%} free")
+
+    if abs(target - current) < MIN_CHANGE_KIB:
+        return hold(f"{reason}, but already at its bound" if target in (floor_kib, ceiling_kib) else reason)
+    return {"action": "grow" if target > current else "shrink", "reason": reason, "target_kib": target}
+
+
+def _managed(policy: Optional[dict]) -> bool:
+    if BALLOON_SCOPE == "all":
+        return policy is None or policy["enabled"]
+    return policy is not None and policy["enabled"]
+
+
+class Controller:
+    """Runs the balloon policy over every node every `interval` seconds."""
+
+    def __init__(self, mode: str = BALLOON_MODE, interval: float = BALLOON_INTERVAL):
+        self.mode = mode
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._swap_in: dict[tuple, int] = {}   # (node, vm) -> swap_in counter of the last round
+        self._report: Optional[dict] = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="balloon-controller", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.run_once(apply=self.mode == "on")
+            except Exception:
+                log.exception("balloon round failed")
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def _node_round(self, node: dict, apply: bool) -> list[dict]:
+        decisions = []
+        with connection(node["uri"]) as conn:
+            records = conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_BALLOON,
+                                             libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+            # Memory the node can hand out to growing guests this round.
+            budget = conn.getFreeMemory() // 1024 - nodes.HOST_RESERVED_MB * 1024
+            for dom, record in records:
+                name = dom.name()
+                facts = cached_facts(name, node["uri"])
+                policy = facts["balloon"] if facts is not None else balloon_policy(dom)
+                if not _managed(policy):
+                    continue
+                free = record.get("balloon.usable", record.get("balloon.unused"))
+                if free is None:
+                    try:
+                        # The guest only reports stats when asked to; they show up next round.
+                        dom.setMemoryStatsPeriod(STATS_PERIOD, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+                    except libvirt.libvirtError:
+                        pass
+                key = (node["name"], name)
+                swap_in = record.get("balloon.swap_in")
+                with self._lock:
+                    prev = self._swap_in.get(key)
+                    if swap_in is not None:
+                        self._swap_in[key] = swap_in
+                swapping = swap_in is not None and prev is not None and swap_in > prev
+                maximum = record.get("balloon.maximum")
+                if maximum is None:
+                    # Older libvirt leaves it out of the stats; without a real maximum the
+                    # ceiling would be 0 and the VM would be shrunk to its floor.
+                    try:
+                        maximum = dom.maxMemory()
+                    except libvirt.libvirtError:
+                        continue
+                floor = (policy or {}).get("min_mb") or BALLOON_FLOOR_MB
+                ceiling = min(((policy or {}).get("max_mb") or maximum // 1024) * 1024, maximum)
+                sample = {"current": record.get("balloon.current", 0), "free": free}
+                decisions.append((dom, {"node": node["name"], "vm": name, **sample,
+                                        **decide(sample, floor * 1024, ceiling, swapping),
+                                        "floor_kib": floor * 1024, "ceiling_kib": ceiling}))
+
+            running = {(node["name"], dom.name()) for dom, _ in records}
+            with self._lock:
+                for key in [k for k in self._swap_in if k[0] == node["name"] and k not in running]:
+                    del self._swap_in[key]
+
+            # Shrinks first (they never need the budget), then the guests with the least free memory.
+            decisions.sort(key=lambda d: (d[1]["action"] != "shrink", (d[1]["free"] or 0) / max(d[1]["current"], 1)))
+            for dom, d in decisions:
+                if d["action"] == "grow":
+                    wanted = d["target_kib"] - d["current"]
+                    if wanted > budget:
+                        if budget < MIN_CHANGE_KIB:
+                            d.update(action="hold", target_kib=d["current"], reason=d["reason"] + "; node has no memory to spare")
+                            continue
+                        d.update(target_kib=d["current"] + budget, reason=d["reason"] + "; limited by node free memory")
+                    budget -= d["target_kib"] - d["current"]
+                d["applied"] = False
+                if apply and d["action"] in ("grow", "shrink"):
+                    try:
+                        dom.setMemoryFlags(d["target_kib"], libvirt.VIR_DOMAIN_AFFECT_LIVE)
+                        d["applied"] = True
+                    except libvirt.libvirtError as e:
+                        d["error"] = str(e)
+                        log.warning("resizing %s to %d MiB failed: %s", d["vm"], d["target_kib"] // 1024, e)
+        return [d for _, d in decisions]
+
+    def run_once(self, apply: bool = False) -> dict:
+        """One round over all nodes. Resizes VMs only if `apply`. Returns (and keeps) the report."""
+        started = time.monotonic()
+        results, errors = nodes.fan_out(lambda node: self._node_round(node, apply))
+        vms = []
+        for node_name in sorted(results):
+            for d in results[node_name]:
+                vms.append({
+                    "node": d["node"],
+                    "vm": d["vm"],
+                    "action": d["action"],
+                    "reason": d["reason"],
+                    "current_mb": d["current"] // 1024,
+                    "target_mb": d["target_kib"] // 1024,
+                    "free_mb": d["free"] // 1024 if d["free"] is not None else None,
+                    "floor_mb": d["floor_kib"] // 1024,
+                    "ceiling_mb": d["ceiling_kib"] // 1024,
+                    "applied": d["applied"],
+                    **({"error": d["error"]} if "error" in d else {}),
+                })
+        moved = lambda action: sum(v["target_mb"] - v["current_mb"] for v in vms if v["action"] == action)
+        report = {
+            "mode": self.mode,
+            "applied": apply,
+            "finished_at": time.time(),
+            "seconds": round(time.monotonic() - started, 4),
+            "vms": vms,
+            "totals": {
+                **{action: sum(1 for v in vms if v["action"] == action) for action in ("grow", "shrink", "hold", "skip")},
+                "reclaim_mb": -moved("shrink"),
+                "grow_mb": moved("grow"),
+            },
+            "errors": errors,
+        }
+        with self._lock:
+            self._report = report
+        return report
+
+    def report(self) -> Optional[dict]:
+        with self._lock:
+            return self._report
+
+
+_controller: Optional[Controller] = None
+
+
+def start() -> Optional[Controller]:
+    global _controller
+    if BALLOON_MODE not in MODES:
+        log.warning("unknown KVM_ORCH_BALLOON=%r (use one of %s); balloon controller off", BALLOON_MODE, ", ".join(MODES))
+        return None
+    if BALLOON_MODE == "off" or BALLOON_INTERVAL <= 0:
+        return None
+    if _controller is None:
+        _controller = Controller()
+        _controller.start()
+    return _controller
+
+
+def stop() -> None:
+    global _controller
+    if _controller is not None:
+        _controller.stop()
+        _controller = None
+
+
+def get() -> Optional[Controller]:
+    return _controller
+
+
+def settings() -> dict:
+    return {
+        "mode": BALLOON_MODE if _controller is not None else "off",
+        "interval_seconds": BALLOON_INTERVAL,
+        "scope": BALLOON_SCOPE,
+        "floor_mb": BALLOON_FLOOR_MB,
+        "target_free": BALLOON_TARGET_FREE,
+        "low_free": BALLOON_LOW_FREE,
+        "high_free": BALLOON_HIGH_FREE,
+        "step_mb": BALLOON_STEP_MB,
+    }
@@ -0,0 +1,295 @@
+# app/services/clone.py
+#
+# Linked clones of an existing VM (POST /vms/{name}/clone).
+#
+# A full create boots a fresh cloud image and lets cloud-init install packages, which takes
+# minutes. A clone starts from a VM that is already set up (a "golden" VM):
+#   1. freeze the source: an external disk-only snapshot moves the source onto new qcow2
+#      overlays, so its current disk files never change again (quiesced through the guest
+#      agent when the source is running and has one). The overlays are created as pool
+#      volumes first and handed to libvirt with REUSE_EXT;
+#   2. give every clone qcow2 overlays backed by the frozen files (app/services/storage.py).
+#      Only metadata is written, so this takes milliseconds whatever the disk size;
+#   3. copy the source's domain XML with a new name, UUID, MACs and disk paths, optionally with
+#      a fresh NoCloud seed (new hostname and machine-id), then define and start it.
+# The source is frozen once per call however many clones it makes, and the clones are made in
+# parallel. Every call adds one layer to the source's backing chain. Frozen files and the
+# source's read-only/shareable disks are shared by the source and its clones, so each clone
+# records the files it owns in its metadata and deleting it removes only those.
+import logging
+import os
+import secrets
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from xml.sax.saxutils import quoteattr
+
+import libvirt
+from lxml import etree
+
+from app.services import inventory, nocloud, reclaim, storage
+from app.services.domain_xml import seed_disk_xml
+from app.services.libvirt_client import (
+    DISKS_NS, DISKS_PREFIX, METADATA_NS, connection, disks_xml, domain_facts, tags_xml,
+)
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_source_locks: dict[tuple[str, str], threading.Lock] = {}   # (uri, source) -> held while freezing
+
+
+class CloneError(Exception):
+    """The source VM can't be cloned (e.g. a disk that isn't a file)."""
+
+
+def _source_lock(uri: str, source: str) -> threading.Lock:
+    with _lock:
+        return _source_locks.setdefault((uri, source), threading.Lock())
+
+
+def _is_seed(path: Optional[str], source: str) -> bool:
+    return bool(path) and os.path.basename(path).startswith(f"{source}-seed.")
+
+
+def source_disks(xml: str, source: str) -> tuple[list[dict], str]:
+    """
+    The writable disks of the source that clones need their own overlay of
+    ([{"dev", "path", "format"}], in domain order), and the format of its seed ("iso" or "vfat").
+    Read-only and shareable disks are left shared.
+    """
+    disks, seed_format = [], "iso"
+    for disk in etree.fromstring(xml.encode()).findall("devices/disk"):
+        source_el, target, driver = disk.find("source"), disk.find("target"), disk.find("driver")
+        path = source_el.get("file") if source_el is not None else None
+        if _is_seed(path, source):
+            seed_format = "iso" if disk.get("device") == "cdrom" else "vfat"
+            continue
+        if disk.get("device") != "disk" or disk.find("readonly") is not None or disk.find("shareable") is not None:
+            continue
+        if disk.get("type") != "file" or not path:
+            raise CloneError(f"disk {target.get('dev')} is a {disk.get('type')} disk; only file disks can be cloned")
+        disks.append({"dev": target.get("dev"), "path": path,
+                      "format": driver.get("type", "raw") if driver is not None else "raw"})
+    if not disks:
+        raise CloneError("the source VM has no writable file disk to clone")
+    return disks, seed_format
+
+
+def snapshot_xml(overlays: dict[str, str], other_devs: list[str]) -> str:
+    """External disk-only snapshot: `overlays` maps disk target -> new overlay path."""
+    items = [f"<disk name='{dev}' snapshot='external' type='file'><driver type='qcow2'/>"
+             f"<source file={quoteattr(path)}/></disk>" for dev, path in overlays.items()]
+    items += [f"<disk name='{dev}' snapshot='no'/>" for dev in other_devs]
+    return (f"<domainsnapshot><name>clone-{uuid.uuid4().hex[:8]}</name><disks>"
+            + "".join(items) + "</disks></domainsnapshot>")
+
+
+def _freeze(source: str, uri: str, xml: str, disks: list[dict], active: bool) -> list[dict]:
+    """
+    Move the source onto new overlays so the files in `disks` stop changing. Returns the frozen
+    disks with the pool and size their clone overlays use ({"dev", "path", "format", "pool", "capacity"}).
+    """
+    frozen, created = [], []
+    tag = uuid.uuid4().hex[:8]
+    try:
+        for d in disks:
+            vol = storage.volume_of(d["path"], uri)
+            if vol is None:
+                # Not in a pool: take the size from the image and put the overlays in the usual pool.
+                with connection(uri) as conn:
+                    capacity = conn.lookupByName(source).blockInfo(d["dev"], 0)[0]  # [capacity, allocation, physical]
+                vol = {"pool": storage.choose_pool(0, uri)["name"], "capacity": capacity}
+            top = storage.create_overlay(f"{source}-{tag}-{d['dev']}.qcow2", vol["pool"], vol["capacity"],
+                                         d["path"], uri=uri, backing_format=d["format"])
+            created.append(top["path"])
+            frozen.append({**d, **vol, "top": top["path"]})
+
+        all_devs = [t.get("dev") for t in etree.fromstring(xml.encode()).findall("devices/disk/target")]
+        snap = snapshot_xml({f["dev"]: f["top"] for f in frozen}, [d for d in all_devs if d not in {f["dev"] for f in frozen}])
+        flags = (libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REUSE_EXT
+                 | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA)
+        with connection(uri) as conn:
+            dom = conn.lookupByName(source)
+            if not active:
+                dom.snapshotCreateXML(snap, flags)
+            else:
+                flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+                try:
+                    # Ask the guest agent to flush and freeze the filesystems around the snapshot.
+                    dom.snapshotCreateXML(snap, flags | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_QUIESCE)
+                except libvirt.libvirtError as e:
+                    log.info("quiesced snapshot of %s failed (%s); taking a crash-consistent one", source, e)
+                    dom.snapshotCreateXML(snap, flags)
+    except Exception:
+        if created:
+            with connection(uri) as conn:
+                reclaim.enqueue(conn, created, vm=source, uri=uri)
+        raise
+    _move_owned_disks(source, uri, xml, frozen, active)
+    return frozen
+
+
+def _move_owned_disks(source: str, uri: str, xml: str, frozen: list[dict], active: bool) -> None:
+    """
+    A source that is itself a clone lists the files it owns in its metadata. After the freeze
+    it runs on the new overlays and the old files back the new clones, so swap them in the list:
+    deleting the source must remove the overlays, never the frozen files.
+    """
+    owned = domain_facts(xml)["owned"]
+    if owned is None:
+        return
+    frozen_paths = {f["path"] for f in frozen}
+    paths = [p for p in owned if p not in frozen_paths] + [f["top"] for f in frozen]
+    flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG | (libvirt.VIR_DOMAIN_AFFECT_LIVE if active else 0)
+    with connection(uri) as conn:
+        conn.lookupByName(source).setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, disks_xml(paths),
+                                              DISKS_PREFIX, DISKS_NS, flags)
+    inventory.refresh(source, uri)  # libvirt sends no event for config-only metadata
+
+
+def _random_mac(used: set) -> str:
+    while True:
+        mac = "52:54:00:" + ":".join(f"{b:02x}" for b in secrets.token_bytes(3))
+        if mac not in used:
+            used.add(mac)
+            return mac
+
+
+def clone_xml(xml: str, source: str, name: str, disks: dict[str, str], seed_path: Optional[str] = None,
+              seed_format: str = "iso", tags: Optional[list[str]] = None, used_macs: Optional[set] = None) -> str:
+    """
+    The source's (inactive) domain XML turned into the clone's: new name, UUID and MACs, its
+    own disk overlays (`disks` maps target -> path), the source's seed swapped for `seed_path`
+    (or dropped), no NVRAM file (libvirt makes a fresh one), the list of files it owns in its
+    metadata and, if given, new tags.
+    """
+    root = etree.fromstring(xml.encode())
+    root.find("name").text = name
+    uuid_el = root.find("uuid")
+    if uuid_el is None:
+        uuid_el = etree.SubElement(root, "uuid")
+    uuid_el.text = str(uuid.uuid4())
+    for entry in root.findall("sysinfo/system/entry[@name='uuid']"):
+        entry.getparent().remove(entry)
+    used_macs = used_macs if used_macs is not None else set()
+    for mac in root.findall("devices/interface/mac"):
+        mac.set("address", _random_mac(used_macs))
+    devices = root.find("devices")
+    seed_at = None  # where the new seed goes: in place of the source's, else after the last disk
+    for disk in devices.findall("disk"):
+        source_el = disk.find("source")
+        dev = disk.find("target").get("dev")
+        if dev in disks:
+            source_el.set("file", disks[dev])
+            driver = disk.find("driver")
+            if driver is None:
+                driver = etree.SubElement(disk, "driver", name="qemu")
+            driver.set("type", "qcow2")
+            for backing in disk.findall("backingStore"):
+                disk.remove(backing)  # libvirt reads the chain from the new overlay
+        elif source_el is not None and _is_seed(source_el.get("file"), source):
+            seed_at = devices.index(disk)
+            devices.remove(disk)
+    for nvram in root.findall("os/nvram"):
+        nvram.getparent().remove(nvram)
+    metadata = root.find("metadata")
+    if metadata is None:
+        metadata = etree.SubElement(root, "metadata")
+    for old in metadata.findall(f"{{{DISKS_NS}}}disks"):
+        metadata.remove(old)  # the source may itself be a clone
+    metadata.append(etree.fromstring(disks_xml(list(disks.values()) + ([seed_path] if seed_path else []))))
+    if tags is not None:
+        for old in metadata.findall(f"{{{METADATA_NS}}}tags"):
+            metadata.remove(old)
+        if tags:
+            metadata.append(etree.fromstring(tags_xml(tags)))
+    if seed_path:
+        if seed_at is None:
+            seed_at = max((devices.index(d) + 1 for d in devices.findall("disk")), default=0)
+        devices.insert(seed_at, etree.fromstring(seed_disk_xml(seed_path, seed_format)))
+    return etree.tostring(root).decode()
+
+
+def _clone_one(name: str, source: str, uri: str, xml: str, frozen: list[dict], seed_format: str,
+               spec, used_macs: set) -> dict:
+    # A deleted VM of the same name may still have its files queued for removal; let that finish first.
+    if not reclaim.wait_for(name, uri):
+        raise RuntimeError(f"files of a deleted VM named '{name}' are still being removed; try again later")
+    created = []
+    try:
+        disks = {}
+        for i, f in enumerate(frozen):
+            vol_name = f"{name}.qcow2" if i == 0 else f"{name}-{f['dev']}.qcow2"
+            disks[f["dev"]] = storage.create_overlay(vol_name, f["pool"], f["capacity"], f["path"],
+                                                     uri=uri, backing_format=f["format"])["path"]
+            created.append(disks[f["dev"]])
+        seed_path = None
+        if spec.fresh_seed:
+            ext = "iso" if seed_format == "iso" else "img"
+            # Into the pool of the first disk, so it is on the clone's node (which may be remote).
+            seed = nocloud.seed_image(nocloud.clone_seed_files(name, spec.ssh_pubkey), seed_format)
+            seed_path = storage.upload_volume(f"{name}-seed.{ext}", frozen[0]["pool"], seed, uri)["path"]
+            created.append(seed_path)
+        with _lock:  # used_macs is shared by the parallel clones
+            domain = clone_xml(xml, source, name, disks, seed_path, seed_format, spec.tags, used_macs)
+        with connection(uri) as conn:
+            dom = conn.defineXML(domain)
+            if spec.power_on:
+                try:
+                    dom.createWithFlags(0)
+                except libvirt.libvirtError:
+                    dom.undefine()
+                    raise
+    except Exception:
+        if created:
+            with connection(uri) as conn:
+                reclaim.enqueue(conn, created, vm=name, uri=uri)
+        raise
+    return {"disks": list(disks.values()), "seed": seed_path}
+
+
+# Clone pipeline run as a background job (see app/services/jobs.py): freeze the source once,
+# then make the clones, up to spec.concurrency at a time. A failed clone is reported in the
+# result and the rest carry on. `node` is the source's node; clones go on the same node.
+def clone_vms(job, source: str, node: dict, spec) -> dict:
+    uri = node["uri"]
+    names = spec.clone_names()
+    job.update(stage="freezing", progress=5)
+    with _source_lock(uri, source):
+        with connection(uri) as conn:
+            dom = conn.lookupByName(source)
+            xml = dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)
+            active = dom.isActive() == 1
+        disks, seed_format = source_disks(xml, source)
+        frozen = _freeze(source, uri, xml, disks, active)
+
+    job.update(stage="cloning", progress=20)
+    used_macs = set(domain_facts(xml)["macs"])  # never hand out the source's MACs
+    total, done = len(names), [0]
+
+    def one(name):
+        try:
+            result = {"name": name, "ok": True, **_clone_one(name, source, uri, xml, frozen, seed_format, spec, used_macs)}
+        except Exception as e:
+            log.warning("cloning %s as %s failed: %s", source, name, e)
+            result = {"name": name, "ok": False, "error": str(e)}
+        with _lock:
+            done[0] += 1
+            count = done[0]
+        job.update(stage=f"cloning ({count}/{total} done)", progress=20 + count * 80 // total)
+        return result
+
+    with ThreadPoolExecutor(max_workers=min(spec.concurrency, total), thread_name_prefix=f"clone-{job.id[:8]}") as pool:
+        clones = list(pool.map(one, names))
+    failed = [c["name"] for c in clones if not c["ok"]]
+    return {
+        "source": source,
+        "node": node["name"],
+        "frozen": [f["path"] for f in frozen],
+        "total": total,
+        "succeeded": total - len(failed),
+        "failed": failed,
+        "clones": clones,
+    }
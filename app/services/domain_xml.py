@@ -0,0 +1,140 @@
+# Domain XML templates for new VMs, so we can define domains through libvirt
+# directly instead of forking `virt-install` (and loading its osinfo database)
+# for every create.
+#
+# Each OS variant has a few settings (machine type, osinfo id, ...). The first
+# time a variant is used, those are baked into a string.Template that only has
+# the per-VM placeholders left; the compiled template is cached and reused.
+import os
+from functools import lru_cache
+from string import Template
+from typing import Optional
+from xml.sax.saxutils import escape, quoteattr
+
+from app.services.libvirt_client import tags_xml
+
+# libvirt domain type: "kvm" on real hosts. The test:/// driver only accepts "test".
+DOMAIN_TYPE = os.environ.get("KVM_ORCH_DOMAIN_TYPE", "kvm")
+
+# Per-variant settings. "osinfo" is recorded in the domain metadata like virt-install does.
+OS_VARIANTS = {
+    "ubuntu22.04": {"machine": "q35", "osinfo": "http://ubuntu.com/ubuntu/22.04"},
+    "ubuntu24.04": {"machine": "q35", "osinfo": "http://ubuntu.com/ubuntu/24.04"},
+    "debian12": {"machine": "q35", "osinfo": "http://debian.org/debian/12"},
+    "generic": {"machine": "pc", "osinfo": None},
+}
+DEFAULT_OS_VARIANT = "ubuntu22.04"
+
+_DOMAIN = """\
+<domain type='$domain_type'>
+  <name>$${name}</name>
+  <metadata>$osinfo_metadata$${tags_metadata}
+  </metadata>
+  <memory unit='MiB'>$${max_memory_mb}</memory>
+  <currentMemory unit='MiB'>$${memory_mb}</currentMemory>
+  <vcpu placement='static' current='$${vcpus}'>$${max_vcpus}</vcpu>
+  <os>
+    <type arch='x86_64' machine='$machine'>hvm</type>
+    <boot dev='hd'/>
+  </os>
+  <features>
+    <acpi/>
+    <apic/>
+  </features>
+  <cpu mode='host-passthrough' check='none'/>
+  <clock offset='utc'/>
+  <on_poweroff>destroy</on_poweroff>
+  <on_reboot>restart</on_reboot>
+  <on_crash>destroy</on_crash>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2' cache='none' discard='unmap'/>
+      <source file=$${disk_path}/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    $${seed_disk}
+    <interface type='network'>
+      <source network=$${network}/>
+      <model type='virtio'/>
+    </interface>
+    <serial type='pty'>
+      <target port='0'/>
+    </serial>
+    <console type='pty'>
+      <target type='serial' port='0'/>
+    </console>
+    <channel type='unix'>
+      <target type='virtio' name='org.qemu.guest_agent.0'/>
+    </channel>
+    <memballoon model='virtio'>
+      <!-- guest memory stats every 10 s, for the auto-balloon controller (app/services/balloon.py) -->
+      <stats period='10'/>
+    </memballoon>
+    <rng model='virtio'>
+      <backend model='random'>/dev/urandom</backend>
+    </rng>
+  </devices>
+</domain>
+"""
+
+_OSINFO_METADATA = """
+    <libosinfo:libosinfo xmlns:libosinfo="http://libosinfo.org/xmlns/libvirt/domain/1.0">
+      <libosinfo:os id="$osinfo"/>
+    </libosinfo:libosinfo>"""
+
+# The cloud-init seed: a read-only CD-ROM for ISO seeds, a second virtio disk for vfat seeds.
+_SEED_CDROM = """<disk type='file' device='cdrom'>
+      <driver name='qemu' type='raw'/>
+      <source file=$path/>
+      <target dev='sda' bus='sata'/>
+      <readonly/>
+    </disk>"""
+_SEED_VFAT = """<disk type='file' device='disk'>
+      <driver name='qemu' type='raw'/>
+      <source file=$path/>
+      <target dev='vdb' bus='virtio'/>
+    </disk>"""
+
+
+@lru_cache(maxsize=None)
+def template_for(os_variant: str) -> Template:
+    """Compile (once) the domain template for an OS variant, leaving only per-VM placeholders."""
+    try:
+        variant = OS_VARIANTS[os_variant]
+    except KeyError:
+        raise ValueError(f"unknown os_variant '{os_variant}' (known: {', '.join(sorted(OS_VARIANTS))})")
+    metadata = Template(_OSINFO_METADATA).substitute(osinfo=variant["osinfo"]) if variant["osinfo"] else ""
+    # First pass fills variant settings; "$$" placeholders survive as "$" for the per-VM pass.
+    return Template(Template(_DOMAIN).substitute(
+        domain_type=DOMAIN_TYPE,
+        machine=variant["machine"],
+        osinfo_metadata=metadata,
+    ))
+
+
+def seed_disk_xml(seed_path: str, seed_format: str = "iso") -> str:
+    """The <disk> element that attaches a cloud-init seed image (also used for clones)."""
+    return Template(_SEED_CDROM if seed_format == "iso" else _SEED_VFAT).substitute(path=quoteattr(seed_path))
+
+
+def render_domain(*, name: str, vcpus: int, memory_mb: int, disk_path: str, network: str,
+                  seed_path: Optional[str] = None, seed_format: str = "iso",
+                  os_variant: str = DEFAULT_OS_VARIANT, tags: Optional[list[str]] = None,
+                  max_vcpus: Optional[int] = None, max_memory_mb: Optional[int] = None) -> str:
+    """
+    Return the domain XML for one VM. Values are XML-escaped here.
+    max_vcpus / max_memory_mb (default: no headroom) are what vCPU hotplug and the memory
+    balloon can grow the VM to later (PATCH /vms/{name}/resources).
+    """
+    seed_disk = seed_disk_xml(seed_path, seed_format) if seed_path else ""
+    return template_for(os_variant).substitute(
+        name=escape(name),
+        vcpus=int(vcpus),
+        memory_mb=int(memory_mb),
+        max_vcpus=int(max_vcpus or vcpus),
+        max_memory_mb=int(max_memory_mb or memory_mb),
+        disk_path=quoteattr(disk_path),
+        network=quoteattr(network),
+        seed_disk=seed_disk,
+        tags_metadata=("\n    " + tags_xml(tags)) if tags else "",
+    )
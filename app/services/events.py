@@ -0,0 +1,308 @@
+# app/services/events.py
+#
+# Event bus behind GET /events (Server-Sent Events) and the /events/ws WebSocket.
+#
+# Sources, all pushed as they happen (nothing here polls libvirt for domain state):
+# - "lifecycle", "defined", "undefined": libvirt domain lifecycle callbacks, taken from the
+#   per-node inventory threads (app/services/inventory.py) that already subscribe to them.
+# - "lease": a new DHCP lease on one of a node's networks, from the shared lease index
+#   (app/services/leases.py). libvirt has no lease event, so the index pollers only run
+#   while at least one client is subscribed to lease events.
+# - "job": a background job changed status or stage (app/services/jobs.py).
+#
+# Every event gets an increasing integer id and is kept in a bounded ring buffer, so a client
+# that reconnects with Last-Event-ID gets everything it missed (as long as it is still in
+# the buffer). Clients get their own bounded asyncio queue; the libvirt and job threads hand
+# events over with loop.call_soon_threadsafe, so publishing never blocks on a slow client.
+import asyncio
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+import libvirt
+
+from app.services import inventory, jobs
+from app.services.leases import get_index
+from app.services.libvirt_client import connection
+
+log = logging.getLogger(__name__)
+
+# How many past events are kept for clients resuming with Last-Event-ID.
+EVENT_HISTORY = int(os.environ.get("KVM_ORCH_EVENT_HISTORY", "5000"))
+# Events a single client may fall behind by before it is disconnected (it can resume).
+SUBSCRIBER_QUEUE = int(os.environ.get("KVM_ORCH_EVENT_QUEUE", "1000"))
+
+EVENT_TYPES = ("lifecycle", "defined", "undefined", "lease", "job")
+
+# libvirt lifecycle event numbers -> names (VIR_DOMAIN_EVENT_*).
+LIFECYCLE_NAMES = {
+    libvirt.VIR_DOMAIN_EVENT_DEFINED: "defined",
+    libvirt.VIR_DOMAIN_EVENT_UNDEFINED: "undefined",
+    libvirt.VIR_DOMAIN_EVENT_STARTED: "started",
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: "suspended",
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: "resumed",
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: "stopped",
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: "shutdown",
+    getattr(libvirt, "VIR_DOMAIN_EVENT_PMSUSPENDED", 7): "pmsuspended",
+    getattr(libvirt, "VIR_DOMAIN_EVENT_CRASHED", 8): "crashed",
+}
+
+# Put on a client's queue when it fell too far behind; the stream ends after it.
+OVERFLOW = {"type": "overflow"}
+
+
+class Subscription:
+    """One connected client: its filters and the queue its events are delivered on."""
+
+    def __init__(self, loop, types: Optional[set] = None, vms: Optional[set] = None):
+        self.loop = loop
+        self.types = types      # None = every type
+        self.vms = vms          # None = every VM (job events match on their target)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE)
+        self.closed = False
+
+    def wants(self, event: dict) -> bool:
+        if self.types is not None and event["type"] not in self.types:
+            return False
+        return self.vms is None or event.get("vm") in self.vms
+
+    def wants_leases(self) -> bool:
+        return self.types is None or "lease" in self.types
+
+    def _deliver(self, event: dict) -> None:
+        # Runs on the subscriber's event loop.
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Too slow: drop the backlog and tell the client to resume from its last id.
+            self.closed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(OVERFLOW)
+
+
+class EventBus:
+    def __init__(self, history: int = EVENT_HISTORY):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._history: deque = deque(maxlen=history)
+        self._subs: list[Subscription] = []
+
+    # ----- publishing (any thread) -----
+    def publish(self, type: str, vm: Optional[str] = None, node: Optional[str] = None, **data) -> dict:
+        with self._lock:
+            event = {"id": next(self._ids), "type": type, "time": round(time.time(), 3),
+                     "node": node, "vm": vm, "data": data}
+            self._history.append(event)
+            subs = self._subs
+        for sub in subs:
+            if sub.wants(event):
+                try:
+                    sub.loop.call_soon_threadsafe(sub._deliver, event)
+                except RuntimeError:
+                    pass  # the client's loop is gone; unsubscribe() will clean up
+        return event
+
+    # ----- subscribing (event loop) -----
+    def subscribe(self, types: Optional[set] = None, vms: Optional[set] = None,
+                  last_id: Optional[int] = None) -> tuple[Subscription, list[dict], bool]:
+        """
+        Register a client. Returns (subscription, missed events since last_id, complete) where
+        complete is False if some of the missed events already fell out of the history.
+        Replay and registration happen under one lock, so no event is lost or sent twice.
+        """
+        sub = Subscription(asyncio.get_running_loop(), types, vms)
+        with self._lock:
+            missed, complete = [], True
+            if last_id is not None:
+                if self._history and self._history[0]["id"] > last_id + 1:
+                    complete = False
+                newest = self._history[-1]["id"] if self._history else 0
+                if last_id > newest:
+                    complete = False  # id from before a restart
+                else:
+                    missed = [e for e in self._history if e["id"] > last_id and sub.wants(e)]
+            self._subs = self._subs + [sub]
+        if sub.wants_leases():
+            _lease_watch_acquire()
+        return sub, missed, complete
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            if sub not in self._subs:
+                return
+            self._subs = [s for s in self._subs if s is not sub]
+        sub.closed = True
+        if sub.wants_leases():
+            _lease_watch_release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "subscribers": len(self._subs),
+                "history": len(self._history),
+                "oldest_id": self._history[0]["id"] if self._history else None,
+                "newest_id": self._history[-1]["id"] if self._history else None,
+            }
+
+
+bus = EventBus()
+publish = bus.publish
+
+
+# ----- domain events (from the inventory threads) -----
+_node_listeners: dict[str, tuple] = {}    # node name -> (inventory listener, uri)
+
+
+def _domain_listener(node_name: str):
+    def on_event(kind, name, uuid, detail):
+        if kind != "lifecycle":
+            return
+        event = LIFECYCLE_NAMES.get(detail["event"], str(detail["event"]))
+        if event in ("defined", "undefined"):
+            publish(event, vm=name, node=node_name, uuid=uuid, detail=detail["detail"])
+        else:
+            publish("lifecycle", vm=name, node=node_name, uuid=uuid, event=event, detail=detail["detail"])
+    return on_event
+
+
+def watch_node(node: dict) -> None:
+    """Publish the domain events of a node (its inventory must be running)."""
+    fn = _domain_listener(node["name"])
+    if inventory.add_listener(fn, node["uri"]):
+        _node_listeners[node["name"]] = (fn, node["uri"])
+    with _lease_lock:
+        _watched_nodes[node["name"]] = node
+        watching = _lease_users > 0
+    if watching:
+        _start_lease_watch([node])
+
+
+def unwatch_node(node: dict) -> None:
+    entry = _node_listeners.pop(node["name"], None)
+    if entry is not None:
+        inventory.remove_listener(entry[0], entry[1])
+    with _lease_lock:
+        _watched_nodes.pop(node["name"], None)
+        for key in [k for k in _lease_watches if k[0] == node["name"]]:
+            _unwatch_lease(key)
+
+
+# ----- job events -----
+def _on_job(job) -> None:
+    publish("job", vm=job.target, job_id=job.id, kind=job.kind, status=job.status,
+            stage=job.stage, progress=job.progress, error=job.error)
+
+
+# ----- DHCP lease events -----
+# Lease pollers are started for every active network of every watched node when the first
+# lease subscriber arrives, and released again when the last one leaves. Listing a node's
+# networks talks to libvirt (slow or unreachable nodes), so it runs on a background thread,
+# never on the event loop and never under _lease_lock.
+_lease_lock = threading.Lock()
+_lease_users = 0
+_lease_watches: dict[tuple, tuple] = {}   # (node, network) -> (index, listener)
+_watched_nodes: dict[str, dict] = {}      # node name -> node dict, set by watch_node()
+
+
+def _mac_owner(uri: str, mac: str) -> Optional[str]:
+    inv = inventory.get(uri)
+    if inv is None:
+        return None
+    for details, facts in inv.records():
+        if mac in facts.get("macs", ()):
+            return details["name"]
+    return None
+
+
+def _lease_listener(node: dict, network: str, index):
+    # Leases that already exist when we start watching are not news. If the index hasn't
+    # been fetched yet, its first refresh only sets this baseline.
+    seen = None
+    if index.refreshed_at:
+        seen = {(mac, lease["ip"]) for mac, items in index.snapshot().items() for lease in items}
+
+    def on_change():
+        nonlocal seen
+        leases = [lease for items in index.snapshot().values() for lease in items]
+        if seen is not None:
+            for lease in leases:
+                if (lease["mac"], lease["ip"]) not in seen:
+                    publish("lease", vm=_mac_owner(node["uri"], lease["mac"]), node=node["name"],
+                            network=network, mac=lease["mac"], ip=lease["ip"], hostname=lease["hostname"],
+                            expirytime=lease["expirytime"])
+        seen = {(lease["mac"], lease["ip"]) for lease in leases}
+    return on_change
+
+
+def _watch_node_leases(node: dict) -> None:
+    try:
+        with connection(node["uri"]) as conn:
+            networks = [n.name() for n in conn.listAllNetworks(libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE)]
+    except libvirt.libvirtError as e:
+        log.warning("can't list networks on %s for lease events: %s", node["name"], e)
+        return
+    with _lease_lock:
+        # The last subscriber may have left, or the node been removed, while we were listing.
+        if not _lease_users or node["name"] not in _watched_nodes:
+            return
+        for network in networks:
+            key = (node["name"], network)
+            if key in _lease_watches:
+                continue
+            index = get_index(network, node["uri"])
+            fn = _lease_listener(node, network, index)
+            index.add_listener(fn)
+            _lease_watches[key] = (index, fn)
+
+
+def _start_lease_watch(node_list: list[dict]) -> None:
+    def run():
+        for node in node_list:
+            _watch_node_leases(node)
+    threading.Thread(target=run, name="lease-watch", daemon=True).start()
+
+
+def _unwatch_lease(key) -> None:
+    # Called with _lease_lock held.
+    index, fn = _lease_watches.pop(key)
+    index.remove_listener(fn)
+
+
+def _lease_watch_acquire() -> None:
+    global _lease_users
+    with _lease_lock:
+        _lease_users += 1
+        first = _lease_users == 1
+        node_list = list(_watched_nodes.values())
+    if first:
+        _start_lease_watch(node_list)
+
+
+def _lease_watch_release() -> None:
+    global _lease_users
+    with _lease_lock:
+        _lease_users -= 1
+        if _lease_users == 0:
+            for key in list(_lease_watches):
+                _unwatch_lease(key)
+
+
+# ----- lifecycle (called from the FastAPI lifespan in app/main.py) -----
+def start(node_list: list[dict]) -> None:
+    jobs.add_listener(_on_job)
+    for node in node_list:
+        watch_node(node)
+
+
+def stop() -> None:
+    jobs.remove_listener(_on_job)
+    for node in list(_watched_nodes.values()):
+        unwatch_node(node)
+    _watched_nodes.clear()
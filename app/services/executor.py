@@ -0,0 +1,27 @@
+# app/services/executor.py
+#
+# Dedicated, bounded thread pool for blocking work started from async route handlers
+# (libvirt RPCs, file reads). The routers are `async def`, so they don't use anyio's
+# shared thread pool at all: cheap endpoints such as /status answer on the event loop
+# right away, and blocking calls queue here instead of starving everything else.
+# Long-running work (VM creates, batch jobs) runs on the job pool in app/services/jobs.py.
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads for blocking calls from request handlers. Keep it at or above KVM_ORCH_POOL_SIZE
+# so every pooled libvirt connection can be busy at once.
+BLOCKING_WORKERS = int(os.environ.get("KVM_ORCH_BLOCKING_WORKERS", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) on the blocking pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+def shutdown() -> None:
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,352 @@
+# In-memory domain inventory kept up to date by libvirt events.
+#
+# A background thread holds one dedicated libvirt connection, subscribes to
+# domain lifecycle (start/stop/define/undefine) and device events, and keeps a
+# dictionary of every domain keyed by UUID (with a name -> UUID index).
+# Reads on /vms and /vms/{name} are then answered from memory instead of
+# asking libvirt on every request. Other services can also subscribe to the
+# same events (add_listener) instead of polling, e.g. guest-agent connects.
+# Network lifecycle events are passed on to listeners too (for the network cache).
+# When the connection drops we reconnect and rebuild the whole inventory.
+import logging
+import os
+import queue
+import threading
+from typing import Optional
+
+import libvirt
+from app.services.libvirt_client import (
+    LIBVIRT_URI, DETAIL_STATS, KEEPALIVE_INTERVAL, KEEPALIVE_COUNT,
+    get_conn, ensure_event_loop, domain_facts, _stats_details,
+    list_vms as _live_list_vms, get_vm_info as _live_get_vm_info,
+)
+
+log = logging.getLogger(__name__)
+
+# Set KVM_ORCH_INVENTORY=0 to disable the cache and always query libvirt live.
+INVENTORY_ENABLED = os.environ.get("KVM_ORCH_INVENTORY", "1") != "0"
+# Seconds to wait before reconnecting after the event connection fails.
+RECONNECT_DELAY = float(os.environ.get("KVM_ORCH_INVENTORY_RECONNECT", "5"))
+
+# Fields returned by the summary view; everything else in a record is "details" or facts.
+SUMMARY_FIELDS = ("name", "uuid", "state", "active")
+DETAIL_FIELDS = SUMMARY_FIELDS + ("vcpus", "memory_kib_max", "memory_kib_cur")
+
+# Marker put on the work queue to ask the worker to reconnect and resync everything.
+_RESYNC = object()
+
+
+class Inventory:
+    """Event-fed cache of all domains on one libvirt URI."""
+
+    def __init__(self, uri: str):
+        self.uri = uri
+        self._lock = threading.Lock()
+        self._by_uuid: dict[str, dict] = {}   # uuid -> record (details + XML facts)
+        self._by_name: dict[str, str] = {}    # name -> uuid
+        self._work = queue.Queue()            # UUIDs to refresh, or _RESYNC
+        self._ready = threading.Event()       # set once a full sync has completed
+        self._stop = threading.Event()
+        self._conn = None
+        self._callback_ids = []
+        self._network_callback_ids = []
+        self._thread = None
+        self._listeners = []                  # fn(kind, name, uuid, detail) called on every event
+        self.generation = 0                   # bumped on every full resync (events may have been missed)
+
+    # ----- lifecycle -----
+    def start(self) -> None:
+        ensure_event_loop()
+        self._thread = threading.Thread(target=self._run, name=f"inventory[{self.uri}]", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._work.put(_RESYNC)  # wake the worker
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    # ----- event listeners -----
+    def add_listener(self, fn) -> None:
+        """
+        Call fn(kind, name, uuid, detail) for every domain event on this URI.
+        kind is "lifecycle", "device" or "agent", or "network" for network lifecycle
+        events (name and uuid are then the network's). Listeners run on the libvirt
+        event loop thread, so they must return quickly (set a flag, notify, enqueue).
+        """
+        with self._lock:
+            self._listeners = self._listeners + [fn]
+
+    def remove_listener(self, fn) -> None:
+        with self._lock:
+            self._listeners = [f for f in self._listeners if f != fn]
+
+    def _emit(self, kind: str, dom, detail: dict) -> None:
+        for fn in self._listeners:
+            try:
+                fn(kind, dom.name(), dom.UUIDString(), detail)
+            except Exception:
+                log.exception("inventory listener failed")
+
+    # ----- reads (no libvirt calls) -----
+    def list_vms(self, details: bool = False) -> list[dict]:
+        fields = DETAIL_FIELDS if details else SUMMARY_FIELDS
+        with self._lock:
+            records = list(self._by_uuid.values())
+        return [_project(r, fields) for r in records]
+
+    def get_vm(self, name: str) -> Optional[dict]:
+        record = self._record(name)
+        return _project(record, DETAIL_FIELDS) if record else None
+
+    def records(self) -> list[tuple[dict, dict]]:
+        """(details, facts) for every domain; used by selectors that filter on tags."""
+        with self._lock:
+            records = list(self._by_uuid.values())
+        return [(_project(r, DETAIL_FIELDS), r["facts"]) for r in records]
+
+    def facts(self, name: str) -> Optional[dict]:
+        """XML-derived facts for a domain: macs, disks, nvram and interface XML by MAC."""
+        record = self._record(name)
+        return record["facts"] if record else None
+
+    def refresh(self, name: str) -> None:
+        """Re-read a domain soon, for changes libvirt sends no event for (e.g. config-only resizes)."""
+        with self._lock:
+            uuid = self._by_name.get(name)
+        if uuid:
+            self._work.put(uuid)
+
+    def _record(self, name: str) -> Optional[dict]:
+        with self._lock:
+            uuid = self._by_name.get(name)
+            return self._by_uuid.get(uuid) if uuid else None
+
+    # ----- background worker -----
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self._connect()
+                self._resync()
+                self.generation += 1
+                self._ready.set()
+                self._drain()
+            except libvirt.libvirtError as e:
+                log.warning("inventory for %s lost libvirt: %s", self.uri, e)
+            except Exception:
+                # Anything else (unparsable XML, a bug) must not end the thread for good:
+                # log it, then reconnect and rebuild like after a lost connection.
+                log.exception("inventory for %s failed; resyncing", self.uri)
+            finally:
+                self._ready.clear()
+                self._disconnect()
+            self._stop.wait(RECONNECT_DELAY)
+
+    def _connect(self) -> None:
+        conn = get_conn(self.uri)
+        try:
+            conn.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+        except libvirt.libvirtError:
+            pass
+        conn.registerCloseCallback(self._on_close, None)
+        # Register callbacks BEFORE the resync so no event can slip through the gap.
+        for event_id, cb in (
+            (libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle),
+            (libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED, self._on_device),
+            (libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED, self._on_device),
+            (libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE, self._on_agent),
+            # Tags live in the domain metadata; this event needs libvirt >= 3.0.
+            (getattr(libvirt, "VIR_DOMAIN_EVENT_ID_METADATA_CHANGE", None), self._on_metadata),
+            # The balloon was resized (PATCH /vms/{name}/resources, the auto-balloon controller).
+            (libvirt.VIR_DOMAIN_EVENT_ID_BALLOON_CHANGE, self._on_balloon),
+        ):
+            if event_id is not None:
+                self._callback_ids.append(conn.domainEventRegisterAny(None, event_id, cb, None))
+        # Network define/undefine/start/stop, for caches of network XML (app/services/network_libvirt.py).
+        self._network_callback_ids.append(conn.networkEventRegisterAny(
+            None, libvirt.VIR_NETWORK_EVENT_ID_LIFECYCLE, self._on_network, None))
+        self._conn = conn
+
+    def _disconnect(self) -> None:
+        conn, self._conn = self._conn, None
+        ids, self._callback_ids = self._callback_ids, []
+        net_ids, self._network_callback_ids = self._network_callback_ids, []
+        if conn is None:
+            return
+        for cb_id in ids:
+            try:
+                conn.domainEventDeregisterAny(cb_id)
+            except libvirt.libvirtError:
+                pass
+        for cb_id in net_ids:
+            try:
+                conn.networkEventDeregisterAny(cb_id)
+            except libvirt.libvirtError:
+                pass
+        try:
+            conn.unregisterCloseCallback()
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def _drain(self) -> None:
+        # Apply queued refreshes until a resync is requested (connection dropped or stop()).
+        while True:
+            try:
+                item = self._work.get(timeout=KEEPALIVE_INTERVAL)
+            except queue.Empty:
+                # Quiet period: make sure the connection is still there (covers drivers
+                # without keepalive, where the close callback may never fire).
+                if self._conn.isAlive() != 1:
+                    return
+                continue
+            if item is _RESYNC:
+                return
+            self._refresh(item)
+
+    def _resync(self) -> None:
+        """Rebuild the whole inventory: two bulk stats calls plus one XMLDesc per domain."""
+        by_uuid = {}
+        for flag, active in (
+            (libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE, True),
+            (libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_INACTIVE, False),
+        ):
+            for dom, stats in self._conn.getAllDomainStats(DETAIL_STATS, flag):
+                try:
+                    record = _make_record(dom, stats, active)
+                except libvirt.libvirtError:
+                    continue  # domain vanished between the two calls; its event will follow
+                by_uuid[record["uuid"]] = record
+        with self._lock:
+            self._by_uuid = by_uuid
+            self._by_name = {r["name"]: u for u, r in by_uuid.items()}
+
+    def _refresh(self, uuid: str) -> None:
+        """Re-read one domain after an event; drop it if it no longer exists."""
+        try:
+            dom = self._conn.lookupByUUIDString(uuid)
+            active = dom.isActive() == 1
+            records = self._conn.domainListGetStats([dom], DETAIL_STATS)
+            record = _make_record(dom, records[0][1] if records else {}, active)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+            record = None
+        with self._lock:
+            old = self._by_uuid.pop(uuid, None)
+            if old is not None and self._by_name.get(old["name"]) == uuid:
+                del self._by_name[old["name"]]
+            if record is not None:
+                self._by_uuid[uuid] = record
+                self._by_name[record["name"]] = uuid
+
+    # ----- libvirt callbacks (run on the event loop thread; must not block) -----
+    def _on_lifecycle(self, conn, dom, event, detail, opaque):
+        self._work.put(dom.UUIDString())
+        self._emit("lifecycle", dom, {"event": event, "detail": detail})
+
+    def _on_device(self, conn, dom, dev_alias, opaque):
+        self._work.put(dom.UUIDString())
+        self._emit("device", dom, {"alias": dev_alias})
+
+    def _on_metadata(self, conn, dom, mtype, nsuri, opaque):
+        self._work.put(dom.UUIDString())
+
+    def _on_balloon(self, conn, dom, actual, opaque):
+        self._work.put(dom.UUIDString())
+
+    def _on_agent(self, conn, dom, state, reason, opaque):
+        # Guest agent connected/disconnected; nothing cached changes, but waiters care.
+        self._emit("agent", dom, {"connected": state == libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED})
+
+    def _on_network(self, conn, net, event, detail, opaque):
+        self._emit("network", net, {"event": event, "detail": detail})
+
+    def _on_close(self, conn, reason, opaque):
+        self._ready.clear()
+        self._work.put(_RESYNC)
+
+
+# Helper: build a cache record from a stats entry plus the domain XML.
+def _make_record(dom, stats: dict, active: bool) -> dict:
+    record = _stats_details(dom, stats, active)
+    record["facts"] = domain_facts(dom.XMLDesc(0))
+    return record
+
+
+# Helper: copy only the requested public fields out of a record.
+def _project(record: dict, fields) -> dict:
+    return {f: record[f] for f in fields if f in record}
+
+
+# One inventory per libvirt URI, started by the FastAPI lifespan in app/main.py.
+_inventories: dict[str, Inventory] = {}
+
+
+def start(uri: Optional[str] = None) -> Optional[Inventory]:
+    if not INVENTORY_ENABLED:
+        return None
+    uri = uri or LIBVIRT_URI
+    inv = _inventories.get(uri)
+    if inv is None:
+        inv = _inventories[uri] = Inventory(uri)
+        inv.start()
+    return inv
+
+
+def add_listener(fn, uri: Optional[str] = None) -> bool:
+    """Subscribe fn to domain events on `uri`. Returns False if the inventory isn't running."""
+    inv = _inventories.get(uri or LIBVIRT_URI)
+    if inv is None:
+        return False
+    inv.add_listener(fn)
+    return True
+
+
+def remove_listener(fn, uri: Optional[str] = None) -> None:
+    inv = _inventories.get(uri or LIBVIRT_URI)
+    if inv is not None:
+        inv.remove_listener(fn)
+
+
+def refresh(name: str, uri: Optional[str] = None) -> None:
+    inv = _inventories.get(uri or LIBVIRT_URI)
+    if inv is not None:
+        inv.refresh(name)
+
+
+def stop(uri: Optional[str] = None) -> None:
+    inv = _inventories.pop(uri or LIBVIRT_URI, None)
+    if inv is not None:
+        inv.stop()
+
+
+def stop_all() -> None:
+    for inv in list(_inventories.values()):
+        inv.stop()
+    _inventories.clear()
+
+
+def get(uri: Optional[str] = None) -> Optional[Inventory]:
+    """Return the inventory for `uri` if it is running and fully synced, else None."""
+    inv = _inventories.get(uri or LIBVIRT_URI)
+    return inv if inv is not None and inv.ready() else None
+
+
+# Read helpers used by the routers: serve from the cache, fall back to live libvirt
+# while the cache is disabled, starting up, or resyncing after a dropped connection.
+def list_vms(details: bool = False, uri: Optional[str] = None) -> list[dict]:
+    inv = get(uri)
+    if inv is not None:
+        return inv.list_vms(details=details)
+    return _live_list_vms(details=details, uri=uri)
+
+
+def get_vm_info(name: str, uri: Optional[str] = None) -> Optional[dict]:
+    inv = get(uri)
+    if inv is not None:
+        return inv.get_vm(name)
+    return _live_get_vm_info(name, uri=uri)
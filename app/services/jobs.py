@@ -0,0 +1,300 @@
+# Background job runner for long operations (VM creation and friends).
+#
+# Work is submitted to a bounded thread pool and tracked as a Job that the API
+# can report on (GET /jobs, GET /jobs/{id}). A job moves through
+# queued -> running -> succeeded | failed, and the work function reports finer
+# grained progress with job.update(stage=..., progress=...).
+import asyncio
+import itertools
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+# How many jobs may run at the same time. Extra jobs wait in the queue.
+JOB_WORKERS = int(os.environ.get("KVM_ORCH_JOB_WORKERS", "4"))
+# How many finished jobs we remember for GET /jobs (oldest are forgotten first).
+JOB_HISTORY = int(os.environ.get("KVM_ORCH_JOB_HISTORY", "500"))
+
+
+class Pending:
+    """
+    Returned by a work function that hands the end of its job to a callback (e.g. a DHCP lease
+    showing up): the worker thread is freed and the job stays running until resolve() or fail().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._job: Optional["Job"] = None
+        self._outcome: Optional[tuple] = None   # (succeeded, result or error) once ended
+
+    def resolve(self, result: Any = None) -> None:
+        self._end((True, result))
+
+    def fail(self, error: str) -> None:
+        self._end((False, error))
+
+    def _end(self, outcome: tuple) -> None:
+        with self._lock:
+            if self._outcome is not None:
+                return  # only the first outcome counts
+            self._outcome, job = outcome, self._job
+        if job is not None:
+            _complete(job, *outcome)
+
+    def _attach(self, job: "Job") -> None:
+        # It may have ended already, before the work function returned.
+        with self._lock:
+            self._job, outcome = job, self._outcome
+        if outcome is not None:
+            _complete(job, *outcome)
+
+
+class NameInUse(Exception):
+    """Another unfinished job is already making a VM of this name (see submit_unique())."""
+
+
+class Job:
+    """State of one background operation. Updated by the worker, read by the API."""
+
+    _seq = itertools.count(1)
+
+    def __init__(self, kind: str, target: Optional[str] = None, creates: Optional[list[str]] = None):
+        self.id = uuid.uuid4().hex
+        self.seq = next(Job._seq)     # submission order, for stable listing
+        self.kind = kind              # e.g. "create_vm"
+        self.target = target          # e.g. the VM name
+        self.creates = set(creates or ())  # names of the VMs it makes besides the target (clones)
+        self.status = "queued"        # queued | running | succeeded | failed
+        self.stage = "queued"         # free-form step name reported by the work function
+        self.progress = 0             # 0-100
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.children: list["Job"] = []   # per-item jobs of a batch job, reported under "items"
+        self._done = threading.Event()
+        self._callbacks: list[Callable[["Job"], None]] = []
+        self._cb_lock = threading.Lock()
+
+    def update(self, stage: Optional[str] = None, progress: Optional[int] = None) -> None:
+        changed = stage is not None and stage != self.stage
+        if stage is not None:
+            self.stage = stage
+        if progress is not None:
+            self.progress = max(0, min(100, int(progress)))
+        if changed:
+            _notify(self)
+
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, fn: Callable[["Job"], None]) -> None:
+        """Call fn(job) once the job has finished (right away if it already has)."""
+        with self._cb_lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    async def wait_async(self, timeout: Optional[float] = None) -> bool:
+        """wait() for async code: suspends the coroutine instead of blocking a thread."""
+        if self.finished:
+            return True
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self.add_done_callback(lambda job: loop.call_soon_threadsafe(
+            lambda: done.done() or done.set_result(True)))
+        try:
+            await asyncio.wait_for(done, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _finish(self) -> None:
+        with self._cb_lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+
+    def summary(self) -> dict:
+        """Short form used for the items of a batch job."""
+        return {
+            "id": self.id,
+            "target": self.target,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+        }
+
+    def as_dict(self) -> dict:
+        data = {
+            "id": self.id,
+            "kind": self.kind,
+            "target": self.target,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.children:
+            data["items"] = [c.summary() for c in self.children]
+        return data
+
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+_listeners: list[Callable[[Job], None]] = []   # fn(job) on every status or stage change
+_jobs: "OrderedDict[str, Job]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def execute(job: Job, fn: Callable, *args, **kwargs) -> Job:
+    """Run fn(job, *args, **kwargs) for a job made with create(), in the calling thread."""
+    _execute(job, fn, args, kwargs)
+    return job
+
+
+def _execute(job: Job, fn: Callable, args: tuple, kwargs: dict) -> None:
+    job.status = "running"
+    job.started_at = time.time()
+    _notify(job)
+    try:
+        result = fn(job, *args, **kwargs)
+    except Exception as e:
+        traceback.print_exc()
+        _complete(job, False, str(e) or e.__class__.__name__)
+        return
+    if isinstance(result, Pending):
+        result._attach(job)  # finished later by whoever resolves it; this thread is free now
+    else:
+        _complete(job, True, result)
+
+
+def _complete(job: Job, succeeded: bool, value: Any) -> None:
+    if succeeded:
+        job.result = value
+        job.status = "succeeded"
+        # Set directly (not update()) so listeners hear about the finish once, below.
+        job.stage, job.progress = "done", 100
+    else:
+        job.status = "failed"
+        # Leave job.stage where it was so the status shows which step failed.
+        job.error = value
+    job.finished_at = time.time()
+    job._finish()
+    _notify(job)
+
+
+def _trim() -> None:
+    # Forget the oldest finished jobs once we are over the history limit.
+    finished = [j for j in _jobs.values() if j.finished]
+    for job in finished[: max(0, len(finished) - JOB_HISTORY)]:
+        del _jobs[job.id]
+
+
+def add_listener(fn: Callable[[Job], None]) -> None:
+    """Call fn(job) whenever a job changes status or stage (from the worker thread)."""
+    global _listeners
+    _listeners = _listeners + [fn]
+
+
+def remove_listener(fn: Callable[[Job], None]) -> None:
+    global _listeners
+    _listeners = [f for f in _listeners if f != fn]
+
+
+def _notify(job: Job) -> None:
+    for fn in _listeners:
+        try:
+            fn(job)
+        except Exception:
+            traceback.print_exc()
+
+
+def create(kind: str, target: Optional[str] = None) -> Job:
+    """Register a queued job without running it (see execute())."""
+    job = Job(kind, target)
+    with _lock:
+        _trim()
+        _jobs[job.id] = job
+    return job
+
+
+def submit(kind: str, fn: Callable, *args, target: Optional[str] = None, **kwargs) -> Job:
+    """
+    Queue fn(job, *args, **kwargs) on the worker pool and return its Job right away.
+    The function's return value becomes job.result; an exception marks the job failed.
+    """
+    job = create(kind, target)
+    _executor.submit(_execute, job, fn, args, kwargs)
+    return job
+
+
+def submit_unique(kind: str, fn: Callable, *args, names: list[str], target: Optional[str] = None,
+                  skip_taken: bool = False, **kwargs) -> Job:
+    """
+    submit() for jobs that make VMs called `names`. The names are checked against the other
+    unfinished jobs and reserved for this one in a single critical section, so two requests for
+    the same name can't both be queued. A name already being made raises NameInUse, or with
+    skip_taken=True is left out and handed to the work function as taken={...}.
+    """
+    with _lock:
+        busy = [n for n in names if _making(n) is not None]
+        if busy and not skip_taken:
+            raise NameInUse(", ".join(busy))
+        _trim()
+        job = Job(kind, target, [n for n in names if n not in busy])
+        _jobs[job.id] = job
+    if skip_taken:
+        kwargs["taken"] = set(busy)
+    _executor.submit(_execute, job, fn, args, kwargs)
+    return job
+
+
+def get(job_id: str) -> Optional[Job]:
+    with _lock:
+        return _jobs.get(job_id)
+
+
+def list_jobs(status: Optional[str] = None, kind: Optional[str] = None) -> list[Job]:
+    with _lock:
+        items = list(_jobs.values())
+    return [j for j in items if (status is None or j.status == status) and (kind is None or j.kind == kind)]
+
+
+def _making(name: str) -> Optional[Job]:
+    # Called with _lock held.
+    for job in _jobs.values():
+        if not job.finished and ((job.kind == "create_vm" and job.target == name) or name in job.creates):
+            return job
+    return None
+
+
+def creating(name: str) -> Optional[Job]:
+    """Return an unfinished job that is making a VM of this name (a create or a clone), if one exists."""
+    with _lock:
+        return _making(name)
+
+
+def shutdown() -> None:
+    # Don't wait for running jobs; queued ones are cancelled.
+    _executor.shutdown(wait=False, cancel_futures=True)
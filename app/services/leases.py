@@ -0,0 +1,202 @@
+# Shared DHCP lease index, read through the libvirt API.
+#
+# Instead of every waiting request forking `virsh net-dhcp-leases` once a second,
+# each libvirt network gets ONE poller thread that calls DHCPLeases() and keeps a
+# MAC -> lease map. Waiters register a callback (notify_ip) or a change listener and
+# are called from the poller, so the cost of IP resolution no longer grows with the
+# number of clients waiting and no thread sits blocked per waiter. The poller only
+# runs while somebody is waiting (plus a short grace period) and stops on its own afterwards.
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import libvirt
+from app.services.libvirt_client import LIBVIRT_URI, connection
+
+log = logging.getLogger(__name__)
+
+# Seconds between DHCPLeases() calls while at least one client is waiting.
+LEASE_POLL_INTERVAL = float(os.environ.get("KVM_ORCH_LEASE_POLL_INTERVAL", "1"))
+# Keep polling this many seconds after the last waiter left (cheap follow-up lookups).
+LEASE_IDLE_TIMEOUT = float(os.environ.get("KVM_ORCH_LEASE_IDLE_TIMEOUT", "30"))
+
+
+class LeaseIndex:
+    """MAC -> lease map for one libvirt network, refreshed by a single poller."""
+
+    def __init__(self, network: str, uri: str):
+        self.network = network
+        self.uri = uri
+        self._leases: dict[str, list[dict]] = {}   # mac -> leases (a MAC can hold v4 and v6)
+        self._refreshed_at = 0.0
+        self._cond = threading.Condition()
+        self._waiters = 0
+        self._last_wanted = 0.0
+        self._poller: Optional[threading.Thread] = None
+        self._listeners = []      # fn() called after each refresh that changed the map
+        self._watches = []        # (macs, deadline, fn) of notify_ip() callers still waiting
+
+    # ----- reads -----
+    def leases(self) -> dict[str, list[dict]]:
+        with self._cond:
+            return dict(self._leases)
+
+    def find_ip(self, macs: list[str]) -> Optional[str]:
+        """Return the first IPv4 address leased to any of `macs`, using the current map."""
+        with self._cond:
+            return self._match(macs)
+
+    @property
+    def refreshed_at(self) -> float:
+        """time.time() of the last successful refresh (0 if never)."""
+        return self._refreshed_at
+
+    def snapshot(self) -> dict[str, list[dict]]:
+        """Copy of the current lease map (mac -> leases)."""
+        with self._cond:
+            return {mac: list(items) for mac, items in self._leases.items()}
+
+    def _match(self, macs) -> Optional[str]:
+        for mac in macs:
+            for lease in self._leases.get(mac.lower(), ()):
+                if lease["type"] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                    return lease["ip"]
+        return None
+
+    def _fresh(self) -> bool:
+        # Only trust the map if it was refreshed within about one poll interval.
+        return time.time() - self._refreshed_at <= LEASE_POLL_INTERVAL * 2
+
+    def notify_ip(self, macs: list[str], timeout: float, fn) -> None:
+        """
+        Call fn(ip) once one of `macs` has an IPv4 lease, or fn(None) after `timeout` seconds.
+        Nothing blocks meanwhile: fn is called from the poller thread (or right away if the
+        lease is already known), so it must be quick.
+        """
+        macs = [m.lower() for m in (macs or [])]
+        with self._cond:
+            ip = self._match(macs) if self._fresh() else None
+            if not ip:
+                self._watches = self._watches + [(macs, time.monotonic() + timeout, fn)]
+                self._waiters += 1
+                self._last_wanted = time.monotonic()
+                self._ensure_poller()
+        if ip:
+            fn(ip)
+
+    def _check_watches(self) -> None:
+        """Call the notify_ip() callbacks whose lease showed up or whose time ran out."""
+        now = time.monotonic()
+        with self._cond:
+            fresh = self._fresh()
+            due, keep = [], []
+            for macs, deadline, fn in self._watches:
+                ip = self._match(macs) if fresh else None
+                if ip or now >= deadline:
+                    due.append((fn, ip))
+                else:
+                    keep.append((macs, deadline, fn))
+            if due:
+                self._watches = keep
+                self._waiters -= len(due)
+                self._last_wanted = now
+        for fn, ip in due:
+            try:
+                fn(ip)
+            except Exception:
+                log.exception("IP callback for network %s failed", self.network)
+
+    def add_listener(self, fn) -> None:
+        """
+        Call fn() whenever the lease map changes. A listener keeps the poller running
+        like a waiter does, so always pair it with remove_listener().
+        """
+        with self._cond:
+            self._listeners = self._listeners + [fn]
+            self._waiters += 1
+            self._ensure_poller()
+
+    def remove_listener(self, fn) -> None:
+        with self._cond:
+            if fn in self._listeners:
+                self._listeners = [f for f in self._listeners if f != fn]
+                self._waiters -= 1
+                self._last_wanted = time.monotonic()
+
+    # ----- poller -----
+    def _ensure_poller(self) -> None:
+        # Called with self._cond held.
+        if self._poller is None:
+            self._poller = threading.Thread(target=self._poll, name=f"leases[{self.network}]", daemon=True)
+            self._poller.start()
+
+    def refresh(self) -> None:
+        """Fetch the network's leases once and wake every waiter."""
+        with connection(self.uri) as conn:
+            raw = conn.networkLookupByName(self.network).DHCPLeases()
+        leases: dict[str, list[dict]] = {}
+        for item in raw:
+            mac = (item.get("mac") or "").lower()
+            if not mac:
+                continue
+            leases.setdefault(mac, []).append({
+                "mac": mac,
+                "ip": item.get("ipaddr"),
+                "prefix": item.get("prefix"),
+                "type": item.get("type"),
+                "hostname": item.get("hostname"),
+                "expirytime": item.get("expirytime"),
+            })
+        with self._cond:
+            changed = leases != self._leases
+            self._leases = leases
+            self._refreshed_at = time.time()
+            self._cond.notify_all()
+            listeners = self._listeners if changed else []
+        for fn in listeners:
+            fn()
+
+    def _poll(self) -> None:
+        try:
+            while True:
+                try:
+                    self.refresh()
+                except (libvirt.libvirtError, RuntimeError) as e:
+                    log.warning("DHCP lease refresh for network %s failed: %s", self.network, e)
+                except Exception:
+                    # Anything else (a bad lease record, a listener bug) must not end the poller.
+                    log.exception("DHCP lease refresh for network %s failed", self.network)
+                self._check_watches()  # also after a failed refresh, so timeouts still fire
+                with self._cond:
+                    if self._waiters == 0 and time.monotonic() - self._last_wanted > LEASE_IDLE_TIMEOUT:
+                        return
+                time.sleep(LEASE_POLL_INTERVAL)
+        finally:
+            # However the loop ends, let the next waiter start a new poller.
+            with self._cond:
+                if self._poller is threading.current_thread():
+                    self._poller = None
+
+
+# One index per (uri, network), created on first use.
+_indexes: dict[tuple[str, str], LeaseIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(network: str, uri: Optional[str] = None) -> LeaseIndex:
+    key = (uri or LIBVIRT_URI, network)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = LeaseIndex(network, key[0])
+        return index
+
+
+def notify_ip(macs: list[str], fn, network: str = "default", timeout: float = 120, uri: Optional[str] = None) -> None:
+    """
+    Call fn(ip) with the IPv4 address leased to any of `macs` on `network` once it shows up,
+    or fn(None) if it doesn't within `timeout` seconds. Returns right away.
+    """
+    get_index(network, uri).notify_ip(macs, timeout, fn)
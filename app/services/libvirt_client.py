@@ -1,6 +1,9 @@
-
 # Import the libvirt Python bindings, which allow us to control and query virtual machines managed by libvirt (like KVM/QEMU)
 import os
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
 import libvirt
 from lxml import etree  # ensure lxml is in requirements
 # This dictionary maps numeric VM states (as returned by libvirt) to human-readable strings
@@ -9,10 +12,36 @@ STATE_MAP = {
     4: "shutdown", 5: "shutoff", 6: "crashed", 7: "pmsuspended",
 }
 
+# XML namespace of our own domain metadata (tags). Written by domain templates and set_vm_tags().
+METADATA_NS = "https://github.com/bufanoc/kvm-orchestrator/tags"
+METADATA_PREFIX = "kvmo"
+# Per-VM auto-balloon bounds (app/services/resources.py). libvirt keeps one metadata element per
+# namespace, so this needs its own: <kvmob:balloon enabled="true" min_mb="1024" max_mb="8192"/>.
+BALLOON_NS = "https://github.com/bufanoc/kvm-orchestrator/balloon"
+BALLOON_PREFIX = "kvmob"
+# The disk files a VM owns, for VMs that share files with others (linked clones, app/services/clone.py):
+# <kvmod:disks><kvmod:disk path="/var/lib/libvirt/images/web-02.qcow2"/></kvmod:disks>.
+# Deleting the VM removes only these files.
+DISKS_NS = "https://github.com/bufanoc/kvm-orchestrator/disks"
+DISKS_PREFIX = "kvmod"
+
+# Default libvirt URI used by every service function when no uri is passed.
+# Override with KVM_ORCH_LIBVIRT_URI (e.g. test:///default for local testing).
+LIBVIRT_URI = os.environ.get("KVM_ORCH_LIBVIRT_URI", "qemu:///system")
+# Maximum number of libvirt connections open at the same time for one URI.
+POOL_SIZE = int(os.environ.get("KVM_ORCH_POOL_SIZE", "8"))
+# How long a caller waits for a free connection before giving up (seconds).
+POOL_TIMEOUT = float(os.environ.get("KVM_ORCH_POOL_TIMEOUT", "30"))
+# Keepalive: ping the daemon every KEEPALIVE_INTERVAL seconds and treat the
+# connection as dead after KEEPALIVE_COUNT unanswered pings.
+KEEPALIVE_INTERVAL = int(os.environ.get("KVM_ORCH_KEEPALIVE_INTERVAL", "5"))
+KEEPALIVE_COUNT = int(os.environ.get("KVM_ORCH_KEEPALIVE_COUNT", "3"))
+
 
 # Open a connection to the libvirt daemon (default: system-wide QEMU/KVM)
 # Returns a connection object, or raises an error if it fails
-def get_conn(uri: str = "qemu:///system"):
+def get_conn(uri: Optional[str] = None):
+    uri = uri or LIBVIRT_URI
     conn = libvirt.open(uri)
     if conn is None:
         # If connection fails, raise an error
@@ -20,31 +49,212 @@ def get_conn(uri: str = "qemu:///system"):
     return conn
 
 
-# List all virtual machines (both running and defined-but-stopped)
-# Returns a list of summary dictionaries for each VM
-def list_vms(uri: str = "qemu:///system"):
-    conn = get_conn(uri)
+# Keepalive and close callbacks only fire while a libvirt event loop is running.
+# We register the default event implementation once and drive it from a daemon thread.
+_event_loop_lock = threading.Lock()
+_event_loop_started = False
+
+
+def ensure_event_loop() -> None:
+    """
+    Register libvirt's default event implementation and run it in a background thread.
+    Must happen before connections are opened so keepalive can be enabled on them.
+    """
+    global _event_loop_started
+    with _event_loop_lock:
+        if _event_loop_started:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def _run_loop():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+
+        threading.Thread(target=_run_loop, name="libvirt-event-loop", daemon=True).start()
+        _event_loop_started = True
+
+
+class ConnectionPool:
+    """
+    A small pool of long-lived libvirt connections for a single URI.
+
+    Connections are checked out with acquire() and returned with release().
+    At most `size` connections exist at once; callers block (up to `timeout`)
+    when all of them are in use. Dead connections are detected through the
+    close callback and isAlive(), and are replaced with fresh ones.
+    """
+
+    def __init__(self, uri: str, size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT):
+        self.uri = uri
+        self.size = size
+        self.timeout = timeout
+        self._idle = []                # connections ready to be handed out
+        self._dead = set()             # ids of connections reported closed by libvirt
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _open(self):
+        ensure_event_loop()
+        conn = get_conn(self.uri)
+        try:
+            # Let libvirt notice a vanished daemon instead of hanging on the next call.
+            conn.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+        except libvirt.libvirtError:
+            # Some drivers (e.g. test:///) don't support keepalive; isAlive() still works.
+            pass
+        try:
+            conn.registerCloseCallback(self._on_close, None)
+        except libvirt.libvirtError:
+            pass
+        return conn
+
+    def _on_close(self, conn, reason, opaque):
+        # Called from the event loop thread when libvirt drops the connection.
+        with self._lock:
+            self._dead.add(id(conn))
+
+    def _usable(self, conn) -> bool:
+        with self._lock:
+            if id(conn) in self._dead:
+                return False
+        try:
+            return conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    def _discard(self, conn) -> None:
+        with self._lock:
+            self._dead.discard(id(conn))
+        try:
+            conn.unregisterCloseCallback()
+        except libvirt.libvirtError:
+            pass
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def acquire(self):
+        """Check a connection out of the pool, opening or reconnecting as needed."""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise RuntimeError(f"Timed out waiting for a libvirt connection to {self.uri}")
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return self._open()
+                if self._usable(conn):
+                    return conn
+                # Stale connection (daemon restarted, network blip): drop it and try the next one.
+                self._discard(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn) -> None:
+        """Return a connection to the pool (or close it if it died while checked out)."""
+        try:
+            if self._usable(conn):
+                with self._lock:
+                    self._idle.append(conn)
+            else:
+                self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """Close every idle connection (checked-out ones are closed when released)."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            idle = len(self._idle)
+        return {"uri": self.uri, "size": self.size, "idle": idle}
+
+
+# One pool per URI, created on first use.
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(uri: Optional[str] = None) -> ConnectionPool:
+    uri = uri or LIBVIRT_URI
+    with _pools_lock:
+        pool = _pools.get(uri)
+        if pool is None:
+            pool = _pools[uri] = ConnectionPool(uri)
+        return pool
+
+
+def close_pools() -> None:
+    """Close all pooled connections (used on application shutdown)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+# Borrow a pooled connection for the duration of a `with` block:
+#     with connection(uri) as conn:
+#         conn.lookupByName(...)
+@contextmanager
+def connection(uri: Optional[str] = None):
+    pool = get_pool(uri)
+    conn = pool.acquire()
     try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+# Stats groups requested from getAllDomainStats.
+# STATE is enough for the summary view; VCPU and BALLOON add the "details" fields.
+SUMMARY_STATS = libvirt.VIR_DOMAIN_STATS_STATE
+DETAIL_STATS = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BALLOON
+# Stats group each detail field comes from, so list_vms(fields=...) asks only for what is needed.
+FIELD_STATS = {
+    "vcpus": libvirt.VIR_DOMAIN_STATS_VCPU,
+    "memory_kib_max": libvirt.VIR_DOMAIN_STATS_BALLOON,
+    "memory_kib_cur": libvirt.VIR_DOMAIN_STATS_BALLOON,
+}
+
+
+# List all virtual machines (both running and defined-but-stopped)
+# Returns a list of summary dictionaries for each VM (plus vcpus/memory when details=True).
+# `fields` narrows the stats groups fetched: e.g. without memory fields no balloon stats are read.
+def list_vms(details: bool = False, uri: Optional[str] = None, fields=None):
+    stats = DETAIL_STATS if details else SUMMARY_STATS
+    if fields is not None:
+        stats = SUMMARY_STATS
+        for field in fields:
+            stats |= FIELD_STATS.get(field, 0)
+        details = stats != SUMMARY_STATS
+    with connection(uri) as conn:
         items = []
-        # Loop through all running VMs by their IDs
-        for id_ in conn.listDomainsID():        # running
-            dom = conn.lookupByID(id_)
-            items.append(_domain_summary(dom))
-        # Loop through all defined but not running VMs by their names
-        for name in conn.listDefinedDomains():  # defined but stopped
-            dom = conn.lookupByName(name)
-            items.append(_domain_summary(dom))
+        # One bulk call per activity state: the whole inventory costs two round trips
+        # no matter how many domains exist. Splitting by flag also tells us "active"
+        # without an isActive() call per domain.
+        for flag, active in (
+            (libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE, True),
+            (libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_INACTIVE, False),
+        ):
+            for dom, record in conn.getAllDomainStats(stats, flag):
+                if details:
+                    items.append(_stats_details(dom, record, active))
+                else:
+                    items.append(_stats_summary(dom, record, active))
         return items
-    finally:
-        # Always close the connection to free resources
-        conn.close()
 
 
 # Get detailed information about a specific VM by name
 # Returns a dictionary of VM details, or None if not found
-def get_vm_info(name: str, uri: str = "qemu:///system"):
-    conn = get_conn(uri)
-    try:
+def get_vm_info(name: str, uri: Optional[str] = None):
+    with connection(uri) as conn:
         try:
             # Try to look up the VM by name
             dom = conn.lookupByName(name)
@@ -53,165 +263,304 @@ def get_vm_info(name: str, uri: str = "qemu:///system"):
             return None
         # Return detailed info about the VM
         return _domain_details(dom)
-    finally:
-        conn.close()
 
 
 # Start a VM by name (if it is not already running)
-
-# Start a VM by name (if it is not already running)
-def vm_start(name: str, uri: str = "qemu:///system"):
-    conn = get_conn(uri)
-    try:
+def vm_start(name: str, uri: Optional[str] = None):
+    with connection(uri) as conn:
         dom = conn.lookupByName(name)
         if dom.isActive() != 1:
             dom.create()
-    finally:
-        conn.close()
-
 
-# Gracefully shut down a VM by name (sends ACPI shutdown signal)
 
 # Gracefully shut down a VM by name (sends ACPI shutdown signal)
-def vm_shutdown(name: str, uri: str = "qemu:///system"):
-    conn = get_conn(uri)
-    try:
+def vm_shutdown(name: str, uri: Optional[str] = None):
+    with connection(uri) as conn:
         dom = conn.lookupByName(name)
         dom.shutdown()  # graceful ACPI
-    finally:
-        conn.close()
 
 
 # Force-stop (destroy) a VM by name (immediate power off)
-
-# Force-stop (destroy) a VM by name (immediate power off)
-def vm_destroy(name: str, uri: str = "qemu:///system"):
-    conn = get_conn(uri)
-    try:
+def vm_destroy(name: str, uri: Optional[str] = None):
+    with connection(uri) as conn:
         dom = conn.lookupByName(name)
         dom.destroy()  # hard stop
-    finally:
-        conn.close()
 
 
-# Helper function: summarize a VM's basic info (name, uuid, state, active)
-def _domain_summary(dom):
-    state, _ = dom.state()
+# Reboot a running VM (graceful, like shutdown)
+def vm_reboot(name: str, uri: Optional[str] = None):
+    with connection(uri) as conn:
+        dom = conn.lookupByName(name)
+        dom.reboot(0)
+
+
+# Helper function: summarize a VM's basic info (name, uuid, state, active) from a stats record.
+# name() and UUIDString() are cached on the domain object, so this makes no RPCs.
+def _stats_summary(dom, record: dict, active: bool):
+    state = record.get("state.state", 0)
     return {
         "name": dom.name(),
         "uuid": dom.UUIDString(),
         "state": STATE_MAP.get(state, str(state)),
-        "active": bool(dom.isActive()),
+        "active": active,
     }
 
 
+# Helper function: summary plus vcpus and memory, read from the VCPU and BALLOON stats groups.
+def _stats_details(dom, record: dict, active: bool):
+    info = _stats_summary(dom, record, active)
+    # Skip fields the driver didn't report instead of inventing zeros.
+    for key, field in (
+        ("vcpu.current", "vcpus"),
+        ("balloon.maximum", "memory_kib_max"),
+        ("balloon.current", "memory_kib_cur"),
+    ):
+        if key in record:
+            info[field] = record[key]
+    return info
+
+
 
-# Helper function: get detailed info about a VM (adds vcpus and memory info)
+# Helper function: get detailed info about a single VM with one bulk stats call.
 def _domain_details(dom):
-    info = _domain_summary(dom)
-    try:
-        # dom.info() returns: (state, maxMemKiB, memoryKiB, nrVirtCpu, cpuTime)
-        st, maxMem, memCur, vcpus, _cpuTime = dom.info()
-        info.update({
-            "vcpus": vcpus,
-            "memory_kib_max": maxMem,
-            "memory_kib_cur": memCur,
-        })
-    except Exception:
-        # If we can't get details, just skip them
-        pass
-    return info
+    conn = dom.connect()
+    active = dom.isActive() == 1
+    records = conn.domainListGetStats([dom], DETAIL_STATS)
+    record = records[0][1] if records else {}
+    return _stats_details(dom, record, active)
+
+
+# Helper function: pull the facts we need out of a domain's XML in one parse.
+# Returns MACs (lowercased), the VM's own disk files, the NVRAM path, each interface's XML keyed by MAC
+# the names of the libvirt networks the interfaces are attached to, the VM's tags and its
+# auto-balloon bounds.
+def domain_facts(xml: str) -> dict:
+    root = etree.fromstring(xml.encode())
+    macs = []
+    interfaces = {}
+    networks = []
+    # Find all <mac> elements under <devices>/<interface> in the XML
+    for iface in root.findall(".//devices/interface"):
+        src = iface.find("source")
+        net = src.get("network") if src is not None else None
+        if net and net not in networks:
+            networks.append(net)  # libvirt networks the VM is plugged into
+        mac = iface.find("mac")
+        addr = mac.get("address") if mac is not None else None  # Get the MAC address attribute
+        if addr:
+            macs.append(addr.lower())  # Add the MAC address (lowercased) to the list
+            interfaces[addr.lower()] = etree.tostring(iface, with_tail=False).decode()
+    # The disk files that belong to this VM (deleted with it). Linked clones list theirs in our
+    # metadata. Otherwise every <disk><source> path counts (qcow2, seed ISO, etc.) except read-only,
+    # shareable and CD-ROM disks, which other VMs may use too; the VM's own seed ("<name>-seed.*") is its own.
+    owned_el = root.find(f".//metadata/{{{DISKS_NS}}}disks")
+    owned = None
+    if owned_el is not None:
+        owned = [d.get("path") for d in owned_el.findall(f"{{{DISKS_NS}}}disk") if d.get("path")]
+        disks = list(owned)
+    else:
+        disks = []
+        seed_prefix = f"{root.findtext('name')}-seed."
+        for disk in root.findall(".//devices/disk"):
+            src = disk.find("source")
+            p = (src.get("file") or src.get("dev") or src.get("name")) if src is not None else None
+            if not p:
+                continue
+            shared = (disk.get("device") == "cdrom" or disk.find("readonly") is not None
+                      or disk.find("shareable") is not None)
+            if not shared or os.path.basename(p).startswith(seed_prefix):
+                disks.append(p)
+    # Tags from our metadata element: <kvmo:tags><kvmo:tag>web</kvmo:tag>...</kvmo:tags>
+    tags = [t.text for t in root.findall(f".//metadata/{{{METADATA_NS}}}tags/{{{METADATA_NS}}}tag") if t.text]
+    # Auto-balloon bounds: <kvmob:balloon enabled=".." min_mb=".." max_mb=".."/>
+    policy = root.find(f".//metadata/{{{BALLOON_NS}}}balloon")
+    balloon = _balloon_policy(policy) if policy is not None else None
+    return {
+        "macs": macs,
+        "disks": disks,
+        "owned": owned,     # the <kvmod:disks> list as written, None without one
+        "nvram": root.findtext(".//os/nvram"),
+        "interfaces": interfaces,
+        "networks": networks,
+        "tags": tags,
+        "balloon": balloon,
+    }
+
+
+# Helper function: return cached XML facts for a domain from the event-fed inventory,
+# or None when the inventory isn't running for this URI (callers then ask libvirt).
+def cached_facts(name: str, uri: Optional[str] = None) -> Optional[dict]:
+    # Imported here because app.services.inventory itself builds on this module.
+    from app.services import inventory
+    inv = inventory.get(uri)
+    return inv.facts(name) if inv is not None else None
 
 
 # Helper function: get all interface MAC addresses for a VM by name
 # Returns a list of MAC addresses (lowercased)
-def get_vm_macs(name: str, uri: str = "qemu:///system") -> list[str]:
+def get_vm_macs(name: str, uri: Optional[str] = None) -> list[str]:
     """
     Return all interface MAC addresses for the domain (lowercased).
+    Served from the inventory cache when available.
     """
-    # Open a connection to the libvirt daemon
-    conn = get_conn(uri)
+    facts = cached_facts(name, uri)
+    if facts is None:
+        # Borrow a pooled connection to the libvirt daemon
+        with connection(uri) as conn:
+            # Look up the VM (domain) by its name and parse its XML description
+            facts = domain_facts(conn.lookupByName(name).XMLDesc(0))
+    # Return the list of MAC addresses
+    return list(facts["macs"])
+
+
+# Helper function: the <tags> metadata element for a list of tags.
+def tags_xml(tags: list[str]) -> str:
+    root = etree.Element(f"{{{METADATA_NS}}}tags", nsmap={METADATA_PREFIX: METADATA_NS})
+    for tag in tags:
+        etree.SubElement(root, f"{{{METADATA_NS}}}tag").text = tag
+    return etree.tostring(root).decode()
+
+
+# Helper function: which of `paths` are the backing file of another volume or domain disk
+# (linked clones and the VMs they were made from). Returns {path: what it backs}.
+# Pool volumes report their backing file even when no VM using them is running.
+def backing_users(conn, paths: list[str], skip_vm: Optional[str] = None) -> dict[str, str]:
+    wanted, users = set(paths), {}
+    for pool in conn.listAllStoragePools(getattr(libvirt, "VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE", 0)):
+        try:
+            vols = pool.listAllVolumes(0)
+        except libvirt.libvirtError:
+            continue  # pool went away or can't be listed; the domain check below still runs
+        for vol in vols:
+            try:
+                backing = etree.fromstring(vol.XMLDesc(0).encode()).findtext("backingStore/path")
+                if backing in wanted and vol.path() not in wanted:
+                    users.setdefault(backing, f"volume {vol.path()}")
+            except libvirt.libvirtError:
+                continue
+    for dom in conn.listAllDomains(0):
+        if dom.name() == skip_vm:
+            continue
+        root = etree.fromstring(dom.XMLDesc(0).encode())
+        for src in root.findall("devices/disk/backingStore//source"):
+            if src.get("file") in wanted:
+                users.setdefault(src.get("file"), f"VM {dom.name()}")
+    return users
+
+
+# Helper function: the <disks> metadata element listing the disk files a VM owns.
+def disks_xml(paths: list[str]) -> str:
+    root = etree.Element(f"{{{DISKS_NS}}}disks", nsmap={DISKS_PREFIX: DISKS_NS})
+    for path in paths:
+        etree.SubElement(root, f"{{{DISKS_NS}}}disk", path=path)
+    return etree.tostring(root).decode()
+
+
+def _balloon_policy(el) -> dict:
+    number = lambda attr: int(el.get(attr)) if el.get(attr) else None
+    return {"enabled": el.get("enabled") == "true", "min_mb": number("min_mb"), "max_mb": number("max_mb")}
+
+
+def balloon_xml(policy: dict) -> str:
+    root = etree.Element(f"{{{BALLOON_NS}}}balloon", nsmap={BALLOON_PREFIX: BALLOON_NS})
+    root.set("enabled", "true" if policy.get("enabled") else "false")
+    for attr in ("min_mb", "max_mb"):
+        if policy.get(attr) is not None:
+            root.set(attr, str(policy[attr]))
+    return etree.tostring(root).decode()
+
+
+# A VM's auto-balloon policy ({"enabled", "min_mb", "max_mb"}) read from its metadata, or None if unset.
+def balloon_policy(dom) -> Optional[dict]:
     try:
-        # Look up the VM (domain) by its name
-        dom = conn.lookupByName(name)
-        # Get the XML description of the VM (contains all config info)
-        xml = dom.XMLDesc(0)
-        # Parse the XML using lxml.etree
-        root = etree.fromstring(xml.encode())
-        macs = []
-        # Find all <mac> elements under <devices>/<interface> in the XML
-        for mac in root.findall(".//devices/interface/mac"):
-            addr = mac.get("address")  # Get the MAC address attribute
-            if addr:
-                macs.append(addr.lower())  # Add the MAC address (lowercased) to the list
-        # Return the list of MAC addresses
-        return macs
-    finally:
-        # Always close the connection to free resources
-        conn.close()
+        text = dom.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, BALLOON_NS, 0)
+    except libvirt.libvirtError:
+        return None  # no element in our namespace
+    return _balloon_policy(etree.fromstring(text.encode()))
 
 
-def vm_start(name: str, uri: str = "qemu:///system"):
-    conn = get_conn(uri)
-    try:
+# Replace a VM's tags (stored in the domain metadata, so they survive restarts).
+def set_vm_tags(name: str, tags: list[str], uri: Optional[str] = None):
+    with connection(uri) as conn:
         dom = conn.lookupByName(name)
-        if dom.isActive() != 1:
-            dom.create()
-    finally:
-        conn.close()
+        flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        if dom.isActive() == 1:
+            flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+        dom.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, tags_xml(tags), METADATA_PREFIX, METADATA_NS, flags)
 
-def vm_shutdown(name: str, uri: str = "qemu:///system"):
-    conn = get_conn(uri)
-    try:
-        dom = conn.lookupByName(name)
-        dom.shutdown()  # graceful ACPI
-    finally:
-        conn.close()
 
-def vm_destroy(name: str, uri: str = "qemu:///system"):
-    conn = get_conn(uri)
-    try:
+# Address sources for find_vm_ip(), tried in this order: the guest agent knows the
+# real in-guest addresses, libvirt's DHCP leases cover NAT networks, ARP covers bridges.
+ADDRESS_SOURCES = (
+    ("guest-agent", "VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT"),
+    ("dhcp-leases", "VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE"),
+    ("arp", "VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_ARP"),  # needs libvirt >= 4.2
+)
+
+
+# Helper function: ask libvirt for a VM's IPv4 address via dom.interfaceAddresses()
+# Returns (ip, source) or (None, None). Raises libvirt.libvirtError if the VM doesn't exist.
+def find_vm_ip(name: str, uri: Optional[str] = None, sources=None) -> tuple[Optional[str], Optional[str]]:
+    wanted = sources or [label for label, _ in ADDRESS_SOURCES]
+    with connection(uri) as conn:
         dom = conn.lookupByName(name)
-        dom.destroy()  # hard stop
-    finally:
-        conn.close()
+        for label, const in ADDRESS_SOURCES:
+            src = getattr(libvirt, const, None)
+            if label not in wanted or src is None:
+                continue
+            try:
+                ifaces = dom.interfaceAddresses(src, 0)
+            except libvirt.libvirtError:
+                # Agent not running / not responding, VM shut off, source unsupported...
+                continue
+            for ifname, iface in (ifaces or {}).items():
+                if ifname == "lo":
+                    continue
+                for addr in iface.get("addrs") or []:
+                    ip = addr.get("addr")
+                    if addr.get("type") == libvirt.VIR_IP_ADDR_TYPE_IPV4 and ip and not ip.startswith("127."):
+                        return ip, label
+    return None, None
 
 
 # newest
-def vm_delete(name: str, uri: str = "qemu:///system"):
+def vm_delete(name: str, uri: Optional[str] = None, wipe: Optional[bool] = None) -> dict:
     """
-    Stop if running, undefine domain, and remove storage/NVRAM.
+    Stop if running and undefine the domain, then queue its own disks, seed and NVRAM for
+    removal by the background reclamation workers (app/services/reclaim.py). Disks it shares
+    with other VMs (see domain_facts()) are left in place.
     Works even when older libvirt-python is missing some flags.
+    Returns the queued files: {"reclaim": [{"id", "path", "bytes"}], "pending_bytes"}.
     """
-    conn = get_conn(uri)
-    try:
+    # Imported here because app.services.reclaim itself builds on this module.
+    from app.services import reclaim
+    with connection(uri) as conn:
         dom = conn.lookupByName(name)
 
-        # Collect file paths BEFORE undefine (so we can remove leftovers)
-        xml = dom.XMLDesc(0)
-        root = etree.fromstring(xml.encode())
-
-        # All <disk><source file="..."> paths (qcow2, seed ISO, etc.)
-        disk_paths = []
-        for src in root.findall(".//devices/disk/source"):
-            p = src.get("file") or src.get("dev") or src.get("name")
-            if p:
-                disk_paths.append(p)
+        # Collect file paths BEFORE undefine (so we can remove leftovers).
+        # The inventory cache already has them; otherwise read the XML once.
+        facts = cached_facts(name, uri) or domain_facts(dom.XMLDesc(0))
+        disk_paths = facts["disks"]
+        nvram_path = facts["nvram"]
 
-        nvram_path = root.findtext(".//os/nvram")
+        # Never remove a file that other VMs still read through (a clone's source disk).
+        in_use = backing_users(conn, disk_paths, skip_vm=name)
+        if in_use:
+            raise RuntimeError(f"VM '{name}' can't be deleted: " +
+                               ", ".join(f"{path} backs {user}" for path, user in sorted(in_use.items())) +
+                               "; delete those first")
 
         # Stop if running
         if dom.isActive() == 1:
             dom.destroy()
 
-        # Build flags with feature detection
+        # Build flags with feature detection. Storage is NOT removed here (that would
+        # block this call for as long as deleting the disk takes); reclaim does it.
         flags = 0
         flags |= getattr(libvirt, "VIR_DOMAIN_UNDEFINE_MANAGED_SAVE", 0)
         flags |= getattr(libvirt, "VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA", 0)
         if nvram_path:
             flags |= getattr(libvirt, "VIR_DOMAIN_UNDEFINE_NVRAM", 0)
-        # On newer libvirt, this removes storage; on older, it's just 0
-        flags |= getattr(libvirt, "VIR_DOMAIN_UNDEFINE_REMOVE_ALL_STORAGE", 0)
 
         try:
             dom.undefineFlags(flags)
@@ -219,13 +568,7 @@ def vm_delete(name: str, uri: str = "qemu:///system"):
             # Fallback for old bindings with minimal flag support
             dom.undefine()
 
-        # Manual cleanup in case REMOVE_ALL_STORAGE wasn't supported
-        for p in set(filter(None, disk_paths + ([nvram_path] if nvram_path else []))):
-            try:
-                if os.path.exists(p):
-                    os.remove(p)
-            except Exception:
-                pass
-
-    finally:
-        conn.close()
+        # Queue the files (sizes are looked up on this connection; works for remote pools too)
+        items = reclaim.enqueue(conn, disk_paths + ([nvram_path] if nvram_path else []), vm=name, uri=uri,
+                                wipe=wipe)
+    return {"reclaim": items, "pending_bytes": sum(i["bytes"] for i in items)}
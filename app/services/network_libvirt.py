@@ -1,36 +1,176 @@
+# Network helpers: list, define/delete, and attach/detach VM NICs.
+#
+# network_list() answers from a per-node cache of parsed network XML. The cache is filled
+# with one listAllNetworks() call (plus one XMLDesc per network) and dropped whenever the
+# node's inventory thread sees a network lifecycle event (define/undefine/start/stop) or
+# reconnects, so dashboards polling /networks cost no libvirt calls for the network facts.
+# Lease counts come from the shared DHCP lease index when its poller is running, otherwise
+# from DHCPLeases() cached for a few seconds.
+import ipaddress
+import os
+import threading
+import time
+from typing import Optional
 import libvirt  # Import the libvirt library to interact with virtualization hosts
 from lxml import etree  # Import lxml.etree for parsing XML
-from app.services.libvirt_client import get_conn  # Import a helper to get a libvirt connection
+from app.services.libvirt_client import LIBVIRT_URI, connection, cached_facts, domain_facts  # Pooled connections and domain XML facts
+from app.services import inventory  # Per-node event threads (network lifecycle events invalidate the cache)
+from app.services import leases  # Shared DHCP lease index (free lease counts while its poller runs)
 
-def network_list(uri: str = "qemu:///system") -> list[dict]:
-    # List all networks (active and inactive) on the libvirt host
-    conn = get_conn(uri)  # Connect to the libvirt daemon
-    try:
+# Seconds a network's DHCPLeases() answer is reused when no lease poller is running.
+NETWORK_LEASE_TTL = float(os.environ.get("KVM_ORCH_NETWORK_LEASE_TTL", "5"))
+
+_cache_lock = threading.Lock()
+_cache: dict[str, tuple] = {}         # uri -> (inventory, generation, version, networks)
+_versions: dict[str, int] = {}        # uri -> bumped by every network event (guards fill races)
+_listening: dict[str, object] = {}    # uri -> inventory our invalidation listener is registered on
+_lease_cache: dict[tuple, tuple] = {} # (uri, network) -> (monotonic time, leases)
+
+
+def network_facts(xml: str) -> dict:
+    """Bridge, forward mode, addresses and DHCP ranges from a network's XML."""
+    root = etree.fromstring(xml.encode())
+    bridge = root.find("bridge")
+    forward = root.find("forward")
+    ips, ranges, hosts = [], [], 0
+    for ip in root.findall("ip"):
+        address = ip.get("address")
+        prefix = ip.get("prefix")
+        if prefix is None and ip.get("netmask"):
+            prefix = ipaddress.IPv4Network(f"0.0.0.0/{ip.get('netmask')}").prefixlen
+        ips.append({"address": address, "prefix": int(prefix) if prefix is not None else None,
+                    "family": ip.get("family", "ipv4")})
+        dhcp = ip.find("dhcp")
+        if dhcp is None:
+            continue
+        for rng in dhcp.findall("range"):
+            start, end = rng.get("start"), rng.get("end")
+            size = int(ipaddress.ip_address(end)) - int(ipaddress.ip_address(start)) + 1
+            ranges.append({"start": start, "end": end, "size": size})
+        hosts += len(dhcp.findall("host"))
+    return {
+        "uuid": root.findtext("uuid"),
+        "bridge": bridge.get("name") if bridge is not None else None,
+        # No <forward> means an isolated network.
+        "forward_mode": (forward.get("mode") or "nat") if forward is not None else None,
+        "ips": ips,
+        "dhcp_ranges": ranges,
+        "dhcp_hosts": hosts,
+    }
+
+
+def _load_networks(conn) -> list[dict]:
+    """Every network on the host: one call per list plus one XMLDesc per network."""
+    nets = conn.listAllNetworks(0)
+    active = {n.name() for n in conn.listAllNetworks(libvirt.VIR_CONNECT_LIST_NETWORKS_ACTIVE)}
+    autostart = {n.name() for n in conn.listAllNetworks(libvirt.VIR_CONNECT_LIST_NETWORKS_AUTOSTART)}
+    out = []
+    for net in nets:
+        name = net.name()
+        out.append({"name": name, "active": name in active, "autostart": name in autostart,
+                    **network_facts(net.XMLDesc(0))})
+    return sorted(out, key=lambda n: n["name"])
+
+
+def _invalidate(uri: str) -> None:
+    with _cache_lock:
+        _cache.pop(uri, None)
+        _versions[uri] = _versions.get(uri, 0) + 1
+
+
+def _listen(uri: str, inv) -> None:
+    # Drop the cache on any network lifecycle event from this node's inventory thread.
+    with _cache_lock:
+        if _listening.get(uri) is inv:
+            return
+        _listening[uri] = inv
+
+    def on_event(kind, name, uuid, detail):
+        if kind == "network":
+            _invalidate(uri)
+    inv.add_listener(on_event)
+
+
+def _networks(conn, uri: str) -> list[dict]:
+    """Parsed networks of `uri`, from the cache while the node's event stream keeps it valid."""
+    inv = inventory.get(uri)
+    if inv is None:
+        return _load_networks(conn)  # no event stream: nothing tells us when to invalidate
+    _listen(uri, inv)
+    with _cache_lock:
+        entry = _cache.get(uri)
+        version = _versions.get(uri, 0)
+        if entry is not None and entry[0] is inv and entry[1] == inv.generation and entry[2] == version:
+            return entry[3]
+    networks = _load_networks(conn)
+    with _cache_lock:
+        # Only keep it if no network event arrived while we were reading.
+        if _versions.get(uri, 0) == version:
+            _cache[uri] = (inv, inv.generation, version, networks)
+    return networks
+
+
+def _network_leases(conn, uri: str, name: str) -> list[dict]:
+    """Current leases of one active network: [{"ip", "type"}]."""
+    index = leases.get_index(name, uri)
+    if time.time() - index.refreshed_at <= leases.LEASE_POLL_INTERVAL * 2:
+        return [lease for items in index.snapshot().values() for lease in items]
+    key = (uri, name)
+    cached = _lease_cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < NETWORK_LEASE_TTL:
+        return cached[1]
+    raw = conn.networkLookupByName(name).DHCPLeases()
+    items = [{"ip": item.get("ipaddr"), "type": item.get("type")} for item in raw]
+    _lease_cache[key] = (time.monotonic(), items)
+    return items
+
+
+def _lease_stats(network: dict, items: list[dict]) -> dict:
+    """Lease count and how full the DHCP ranges are (leased addresses in range / range size)."""
+    capacity = sum(r["size"] for r in network["dhcp_ranges"])
+    bounds = [(int(ipaddress.ip_address(r["start"])), int(ipaddress.ip_address(r["end"])))
+              for r in network["dhcp_ranges"]]
+    in_range = 0
+    for lease in items:
+        try:
+            addr = int(ipaddress.ip_address(lease["ip"]))
+        except (TypeError, ValueError):
+            continue
+        if any(lo <= addr <= hi for lo, hi in bounds):
+            in_range += 1
+    return {
+        "leases": len(items),
+        "dhcp_capacity": capacity,
+        "utilization": round(in_range / capacity, 4) if capacity else None,
+    }
+
+
+def network_list(uri: Optional[str] = None, with_leases: bool = True) -> list[dict]:
+    # List all networks (active and inactive) on the libvirt host, with bridge / forward mode /
+    # DHCP facts and, unless with_leases=False, lease counts and DHCP range utilization.
+    uri = uri or LIBVIRT_URI
+    with connection(uri) as conn:  # Borrow a pooled connection to libvirt
         out = []
-        # Iterate over both active and defined (inactive) networks
-        for name in conn.listNetworks() + conn.listDefinedNetworks():
-            net = conn.networkLookupByName(name)  # Get the network object by name
-            xml = etree.fromstring(net.XMLDesc().encode())  # Parse the network's XML description
-            br = xml.findtext(".//bridge[@name]")  # Find the bridge name (if any)
-            bridge = xml.find(".//bridge")  # Get the bridge element
-            out.append({
-                "name": net.name(),  # Network name
-                "active": bool(net.isActive()),  # Whether the network is active
-                "autostart": bool(net.autostart()),  # Whether the network autostarts with libvirt
-                "bridge": bridge.get("name") if bridge is not None else None,  # Bridge name or None
-            })
+        for network in _networks(conn, uri):
+            item = dict(network)
+            if with_leases:
+                if network["active"] and network["dhcp_ranges"]:
+                    try:
+                        item.update(_lease_stats(network, _network_leases(conn, uri, network["name"])))
+                    except libvirt.libvirtError:
+                        item.update({"leases": None, "dhcp_capacity": None, "utilization": None})
+                else:
+                    item.update(_lease_stats(network, []))  # inactive or no DHCP: nothing leased
+            out.append(item)
         return out  # Return the list of networks as dictionaries
-    finally:
-        conn.close()  # Always close the connection
 
-def network_ensure(name: str, bridge: str, uri: str = "qemu:///system"):
+def network_ensure(name: str, bridge: str, uri: Optional[str] = None):
     """
     Define/start a libvirt 'bridge' network that binds to an existing Linux bridge.
     Idempotent.
     """
     # Ensure a network with the given name and bridge exists and is running
-    conn = get_conn(uri)  # Connect to libvirt
-    try:
+    with connection(uri) as conn:  # Borrow a pooled connection to libvirt
         try:
             net = conn.networkLookupByName(name)  # Try to find the network by name
         except libvirt.libvirtError:
@@ -50,24 +190,20 @@ def network_ensure(name: str, bridge: str, uri: str = "qemu:///system"):
         if not net.isActive():
             net.create()  # Start the network if not already active
         net.setAutostart(True)  # Set the network to autostart with libvirt
-    finally:
-        conn.close()  # Close the connection
+    _invalidate(uri or LIBVIRT_URI)  # autostart changes don't raise a network event
 
-def network_delete(name: str, uri: str = "qemu:///system"):
+def network_delete(name: str, uri: Optional[str] = None):
     # Delete a network by name
-    conn = get_conn(uri)  # Connect to libvirt
-    try:
+    with connection(uri) as conn:  # Borrow a pooled connection to libvirt
         net = conn.networkLookupByName(name)  # Find the network by name
         if net.isActive():
             net.destroy()  # Stop the network if it's running
         net.undefine()  # Remove the network definition
-    finally:
-        conn.close()  # Close the connection
+    _invalidate(uri or LIBVIRT_URI)
 
-def nic_attach(vm_name: str, network_name: str, uri: str = "qemu:///system"):
+def nic_attach(vm_name: str, network_name: str, uri: Optional[str] = None):
     # Attach a network interface (NIC) to a virtual machine
-    conn = get_conn(uri)  # Connect to libvirt
-    try:
+    with connection(uri) as conn:  # Borrow a pooled connection to libvirt
         dom = conn.lookupByName(vm_name)  # Find the VM (domain) by name
         # XML definition for the new network interface (virtio model)
         iface_xml = f"""
@@ -83,30 +219,21 @@ def nic_attach(vm_name: str, network_name: str, uri: str = "qemu:///system"):
         except Exception:
             flags = 0
         dom.attachDeviceFlags(iface_xml, flags)  # Attach the NIC to the VM
-    finally:
-        conn.close()  # Close the connection
 
-def nic_detach(vm_name: str, mac_addr: str, uri: str = "qemu:///system"):
+def nic_detach(vm_name: str, mac_addr: str, uri: Optional[str] = None):
     """
-    Detach NIC by MAC (lowercase). If unknown, list domain XML first to find it.
+    Detach NIC by MAC (lowercase). The interface XML comes from the inventory
+    cache when available; otherwise the domain XML is read to find it.
     """
     # Detach a network interface from a VM by its MAC address
-    conn = get_conn(uri)  # Connect to libvirt
-    try:
+    facts = cached_facts(vm_name, uri)  # Cached XML facts (None if the cache isn't running)
+    with connection(uri) as conn:  # Borrow a pooled connection to libvirt
         dom = conn.lookupByName(vm_name)  # Find the VM by name
-        xml = dom.XMLDesc(0)  # Get the VM's XML description
-        root = etree.fromstring(xml.encode())  # Parse the XML
-        nic = None
+        if facts is None:
+            facts = domain_facts(dom.XMLDesc(0))  # Parse the VM's XML description
         # Look for the interface with the matching MAC address
-        for iface in root.findall(".//devices/interface"):
-            mac = iface.find("mac")
-            if mac is not None and mac.get("address", "").lower() == mac_addr.lower():
-                nic = iface
-                break
-        if nic is None:
+        nic_xml = facts["interfaces"].get(mac_addr.lower())
+        if nic_xml is None:
             raise RuntimeError(f"MAC {mac_addr} not found on {vm_name}")  # Error if not found
-        nic_xml = etree.tostring(nic).decode()  # Convert the interface XML back to string
         flags = getattr(libvirt, "VIR_DOMAIN_AFFECT_LIVE", 0) | getattr(libvirt, "VIR_DOMAIN_AFFECT_CONFIG", 0)
         dom.detachDeviceFlags(nic_xml, flags)  # Detach the NIC from the VM
-    finally:
-        conn.close()  # Close the connection
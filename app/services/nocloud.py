@@ -0,0 +1,346 @@
+# NoCloud (cloud-init) seed images written in pure Python.
+#
+# cloud-init's NoCloud datasource looks for a filesystem labelled "cidata"
+# containing `user-data` and `meta-data`. We used to build it with
+# `cloud-localds` in a temp dir and `sudo mv` it into place; now the few hundred
+# bytes of YAML are rendered from templates and the image is streamed straight
+# to its final path (or uploaded into the node's storage pool) in one of two formats:
+#   - "iso":  ISO9660 with Joliet long names (what cloud-localds produces), attached as a CD-ROM
+#   - "vfat": a small raw FAT12 image with VFAT long names, attached as a plain disk
+import io
+import os
+import tempfile
+import time
+import uuid
+from string import Template
+from typing import BinaryIO, Optional
+
+from app.services import timings
+
+# ----- templates -----
+USER_DATA_TEMPLATE = Template("""\
+#cloud-config
+hostname: $hostname
+package_update: true
+packages:
+  - qemu-guest-agent
+users:
+  - name: $username
+    groups: [sudo]
+    shell: /bin/bash
+    sudo: ['ALL=(ALL) NOPASSWD:ALL']
+${ssh_keys_block}\
+runcmd:
+  - [ systemctl, enable, --now, qemu-guest-agent ]
+""")
+
+# Seed for a clone of an existing VM (app/services/clone.py): the new instance-id makes cloud-init
+# run again, so the clone gets its own hostname, and a fresh machine-id (the DHCP client id of
+# systemd-networkd derives from it, so clones would otherwise ask for the golden VM's address).
+# Packages and users are already in the cloned disk.
+CLONE_USER_DATA_TEMPLATE = Template("""\
+#cloud-config
+hostname: $hostname
+preserve_hostname: false
+bootcmd:
+  - [ cloud-init-per, instance, new-machine-id, sh, -c, "rm -f /etc/machine-id /var/lib/dbus/machine-id && systemd-machine-id-setup" ]
+${ssh_keys_block}\
+runcmd:
+  - [ sh, -c, "command -v netplan >/dev/null && netplan apply || true" ]
+""")
+
+CLONE_SSH_KEYS_TEMPLATE = Template("""\
+ssh_authorized_keys:
+  - $ssh_pubkey
+""")
+
+SSH_KEYS_TEMPLATE = Template("""\
+    ssh_authorized_keys:
+      - $ssh_pubkey
+""")
+
+META_DATA_TEMPLATE = Template("""\
+instance-id: $instance_id
+local-hostname: $hostname
+""")
+
+VOLUME_LABEL = "cidata"
+
+
+def render_user_data(hostname: str, username: str, ssh_pubkey: Optional[str]) -> str:
+    keys = SSH_KEYS_TEMPLATE.substitute(ssh_pubkey=ssh_pubkey) if ssh_pubkey else ""
+    return USER_DATA_TEMPLATE.substitute(hostname=hostname, username=username, ssh_keys_block=keys)
+
+
+def render_meta_data(hostname: str, instance_id: Optional[str] = None) -> str:
+    return META_DATA_TEMPLATE.substitute(hostname=hostname, instance_id=instance_id or uuid.uuid4())
+
+
+def seed_files(hostname: str, username: str, ssh_pubkey: Optional[str],
+               instance_id: Optional[str] = None) -> dict[str, bytes]:
+    """The files that go on the seed volume, by name."""
+    return {
+        "meta-data": render_meta_data(hostname, instance_id).encode(),
+        "user-data": render_user_data(hostname, username, ssh_pubkey).encode(),
+    }
+
+
+def clone_seed_files(hostname: str, ssh_pubkey: Optional[str] = None,
+                     instance_id: Optional[str] = None) -> dict[str, bytes]:
+    """Seed files for a clone: new hostname and machine-id, optionally one more SSH key."""
+    keys = CLONE_SSH_KEYS_TEMPLATE.substitute(ssh_pubkey=ssh_pubkey) if ssh_pubkey else ""
+    return {
+        "meta-data": render_meta_data(hostname, instance_id).encode(),
+        "user-data": CLONE_USER_DATA_TEMPLATE.substitute(hostname=hostname, ssh_keys_block=keys).encode(),
+    }
+
+
+# ----- ISO9660 + Joliet -----
+SECTOR = 2048
+
+
+def _both16(n: int) -> bytes:
+    return n.to_bytes(2, "little") + n.to_bytes(2, "big")
+
+
+def _both32(n: int) -> bytes:
+    return n.to_bytes(4, "little") + n.to_bytes(4, "big")
+
+
+def _dir_date(t: time.struct_time) -> bytes:
+    # 7-byte directory record date; offset 0 = GMT.
+    return bytes([t.tm_year - 1900, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec, 0])
+
+
+def _vol_date(t: time.struct_time) -> bytes:
+    # 17-byte volume descriptor date: "YYYYMMDDHHMMSScc" + GMT offset.
+    return time.strftime("%Y%m%d%H%M%S00", t).encode() + b"\x00"
+
+
+def _dir_record(ident: bytes, extent: int, size: int, is_dir: bool, t: time.struct_time) -> bytes:
+    length = 33 + len(ident) + (1 - len(ident) % 2)   # padded to an even length
+    rec = (
+        bytes([length, 0]) + _both32(extent) + _both32(size) + _dir_date(t)
+        + bytes([2 if is_dir else 0, 0, 0]) + _both16(1) + bytes([len(ident)]) + ident
+    )
+    return rec.ljust(length, b"\x00")
+
+
+def _path_table(root_extent: int, little: bool) -> bytes:
+    # A single entry: the root directory (identifier 0x00, parent 1, padded to even length).
+    order = "little" if little else "big"
+    return bytes([1, 0]) + root_extent.to_bytes(4, order) + (1).to_bytes(2, order) + b"\x00\x00"
+
+
+def _iso_name(name: str) -> bytes:
+    # ISO9660 level 1: 8.3 upper-case d-characters. Linux reads the Joliet names instead.
+    stem, _, ext = name.upper().partition(".")
+    clean = lambda s: "".join(c if c.isalnum() or c == "_" else "_" for c in s)
+    return f"{clean(stem)[:8]}.{clean(ext)[:3]};1".encode("ascii")
+
+
+def _pad(text: str, size: int, joliet: bool) -> bytes:
+    # Space-padded text field; Joliet descriptors use UCS-2 big-endian.
+    if joliet:
+        return (text + " " * size).encode("utf-16-be")[:size]
+    return text.encode("ascii")[:size].ljust(size, b" ")
+
+
+def _volume_descriptor(joliet: bool, label: str, total: int, pt_size: int, pt_l: int, pt_m: int,
+                       root_rec: bytes, t: time.struct_time) -> bytes:
+    vd = bytearray(SECTOR)
+    vd[0] = 2 if joliet else 1
+    vd[1:6] = b"CD001"
+    vd[6] = 1
+    vd[8:40] = _pad("LINUX", 32, joliet)
+    vd[40:72] = _pad(label, 32, joliet)
+    vd[80:88] = _both32(total)
+    if joliet:
+        vd[88:91] = b"%/E"              # Joliet level 3 escape sequence
+    vd[120:124] = _both16(1)            # volume set size
+    vd[124:128] = _both16(1)            # volume sequence number
+    vd[128:132] = _both16(SECTOR)
+    vd[132:140] = _both32(pt_size)
+    vd[140:144] = pt_l.to_bytes(4, "little")
+    vd[148:152] = pt_m.to_bytes(4, "big")
+    vd[156:190] = root_rec
+    for start, size in ((190, 128), (318, 128), (446, 128), (574, 128)):
+        vd[start:start + size] = _pad("", size, joliet)
+    for start in (702, 739, 776):
+        vd[start:start + 37] = _pad("", 37, joliet)
+    stamp = _vol_date(t)
+    vd[813:830] = stamp
+    vd[830:847] = stamp
+    vd[847:864] = b"0" * 16 + b"\x00"
+    vd[864:881] = b"0" * 16 + b"\x00"
+    vd[881] = 1
+    return bytes(vd)
+
+
+def write_iso(out: BinaryIO, files: dict[str, bytes], label: str = VOLUME_LABEL) -> None:
+    """Stream an ISO9660 image with Joliet names holding `files` (flat, small files) to `out`."""
+    t = time.gmtime()
+    names = sorted(files)
+    # Fixed layout: 16 system sectors, PVD, Joliet SVD, terminator, four path tables,
+    # the two root directories, then file data.
+    pt_l, pt_m, jpt_l, jpt_m = 19, 20, 21, 22
+    root, jroot = 23, 24
+    extents, next_free = {}, 25
+    for name in names:
+        extents[name] = next_free
+        next_free += max(1, -(-len(files[name]) // SECTOR))
+    total = next_free
+
+    def root_dir(joliet: bool) -> bytes:
+        this = jroot if joliet else root
+        recs = _dir_record(b"\x00", this, SECTOR, True, t) + _dir_record(b"\x01", this, SECTOR, True, t)
+        for name in names:
+            ident = (name + ";1").encode("utf-16-be") if joliet else _iso_name(name)
+            recs += _dir_record(ident, extents[name], len(files[name]), False, t)
+        if len(recs) > SECTOR:
+            raise ValueError("too many files for a single-sector seed directory")
+        return recs.ljust(SECTOR, b"\x00")
+
+    pt_size = len(_path_table(root, True))
+    out.write(b"\x00" * SECTOR * 16)
+    out.write(_volume_descriptor(False, label, total, pt_size, pt_l, pt_m,
+                                 _dir_record(b"\x00", root, SECTOR, True, t), t))
+    out.write(_volume_descriptor(True, label, total, pt_size, jpt_l, jpt_m,
+                                 _dir_record(b"\x00", jroot, SECTOR, True, t), t))
+    out.write((b"\xffCD001\x01").ljust(SECTOR, b"\x00"))
+    for extent, little in ((root, True), (root, False), (jroot, True), (jroot, False)):
+        out.write(_path_table(extent, little).ljust(SECTOR, b"\x00"))
+    out.write(root_dir(False))
+    out.write(root_dir(True))
+    for name in names:
+        data = files[name]
+        out.write(data)
+        out.write(b"\x00" * (max(1, -(-len(data) // SECTOR)) * SECTOR - len(data)))
+
+
+# ----- FAT12 with VFAT long names -----
+# Classic 1.44 MB floppy geometry: every FAT driver and blkid knows it.
+FAT_SECTOR = 512
+FAT_TOTAL_SECTORS = 2880
+FAT_SECTORS_PER_FAT = 9
+FAT_ROOT_ENTRIES = 224
+FAT_DATA_START = 1 + 2 * FAT_SECTORS_PER_FAT + FAT_ROOT_ENTRIES * 32 // FAT_SECTOR   # sector 33
+
+
+def _fat_set(fat: bytearray, cluster: int, value: int) -> None:
+    off = cluster * 3 // 2
+    if cluster % 2 == 0:
+        fat[off] = value & 0xFF
+        fat[off + 1] = (fat[off + 1] & 0xF0) | ((value >> 8) & 0x0F)
+    else:
+        fat[off] = (fat[off] & 0x0F) | ((value & 0x0F) << 4)
+        fat[off + 1] = (value >> 4) & 0xFF
+
+
+def _dos_datetime(t: time.struct_time) -> tuple[int, int]:
+    return ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday, (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+
+
+def _lfn_entries(name: str, short: bytes) -> list[bytes]:
+    checksum = 0
+    for c in short:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + c) & 0xFF
+    chars = name.encode("utf-16-le") + b"\x00\x00"
+    chars = chars.ljust(-(-len(chars) // 26) * 26, b"\xff")
+    pieces = [chars[i:i + 26] for i in range(0, len(chars), 26)]
+    entries = []
+    for seq, piece in enumerate(pieces, 1):
+        order = seq | (0x40 if seq == len(pieces) else 0)
+        entries.append(bytes([order]) + piece[0:10] + bytes([0x0F, 0, checksum]) + piece[10:22] + b"\x00\x00" + piece[22:26])
+    return entries[::-1]   # stored last piece first
+
+
+def write_vfat(out: BinaryIO, files: dict[str, bytes], label: str = VOLUME_LABEL) -> None:
+    """Stream a raw FAT12 image labelled `label` holding `files` (flat, long names allowed) to `out`."""
+    t = time.localtime()
+    ddate, dtime = _dos_datetime(t)
+    label_b = label.upper().encode("ascii")[:11].ljust(11, b" ")
+
+    boot = bytearray(FAT_SECTOR)
+    boot[0:3] = b"\xeb\x3c\x90"
+    boot[3:11] = b"mkfs.fat"
+    boot[11:13] = FAT_SECTOR.to_bytes(2, "little")
+    boot[13] = 1                                           # sectors per cluster
+    boot[14:16] = (1).to_bytes(2, "little")                # reserved sectors
+    boot[16] = 2                                           # number of FATs
+    boot[17:19] = FAT_ROOT_ENTRIES.to_bytes(2, "little")
+    boot[19:21] = FAT_TOTAL_SECTORS.to_bytes(2, "little")
+    boot[21] = 0xF0                                        # media descriptor
+    boot[22:24] = FAT_SECTORS_PER_FAT.to_bytes(2, "little")
+    boot[24:26] = (18).to_bytes(2, "little")               # sectors per track
+    boot[26:28] = (2).to_bytes(2, "little")                # heads
+    boot[38] = 0x29                                        # extended boot signature
+    boot[39:43] = uuid.uuid4().bytes[:4]                   # volume serial
+    boot[43:54] = label_b
+    boot[54:62] = b"FAT12   "
+    boot[510:512] = b"\x55\xaa"
+
+    fat = bytearray(FAT_SECTORS_PER_FAT * FAT_SECTOR)
+    _fat_set(fat, 0, 0xFF0)
+    _fat_set(fat, 1, 0xFFF)
+    root = [label_b + bytes([0x08]) + b"\x00" * 10 + dtime.to_bytes(2, "little") + ddate.to_bytes(2, "little") + b"\x00" * 6]
+    cluster, names = 2, sorted(files)
+    # Check the size before filling in the FAT: it only has entries for the clusters a floppy has.
+    if sum(max(1, -(-len(files[n]) // FAT_SECTOR)) for n in names) > FAT_TOTAL_SECTORS - FAT_DATA_START:
+        raise ValueError("seed data too large for the vfat seed image")
+    for i, name in enumerate(names):
+        data = files[name]
+        count = max(1, -(-len(data) // FAT_SECTOR))
+        for c in range(cluster, cluster + count):
+            _fat_set(fat, c, c + 1 if c < cluster + count - 1 else 0xFFF)
+        short = f"SEED~{i + 1}".encode("ascii").ljust(8, b" ") + b"   "
+        root.extend(_lfn_entries(name, short))
+        root.append(
+            short + bytes([0x20, 0, 0]) + dtime.to_bytes(2, "little") + ddate.to_bytes(2, "little")
+            + ddate.to_bytes(2, "little") + b"\x00\x00" + dtime.to_bytes(2, "little") + ddate.to_bytes(2, "little")
+            + cluster.to_bytes(2, "little") + len(data).to_bytes(4, "little")
+        )
+        cluster += count
+    if len(root) > FAT_ROOT_ENTRIES:
+        raise ValueError("seed data too large for the vfat seed image")
+
+    out.write(boot)
+    out.write(fat)
+    out.write(fat)
+    out.write(b"".join(root).ljust(FAT_ROOT_ENTRIES * 32, b"\x00"))
+    for name in names:
+        data = files[name]
+        out.write(data)
+        out.write(b"\x00" * (max(1, -(-len(data) // FAT_SECTOR)) * FAT_SECTOR - len(data)))
+    written = FAT_DATA_START + (cluster - 2)
+    out.write(b"\x00" * (FAT_TOTAL_SECTORS - written) * FAT_SECTOR)
+
+
+WRITERS = {"iso": write_iso, "vfat": write_vfat}
+
+
+def seed_image(files: dict[str, bytes], seed_format: str = "iso") -> bytes:
+    """The seed image as bytes, for uploading into a node's storage pool (storage.upload_volume)."""
+    out = io.BytesIO()
+    WRITERS[seed_format](out, files)
+    return out.getvalue()
+
+
+def write_seed(path: str, files: dict[str, bytes], seed_format: str = "iso") -> str:
+    """
+    Write the seed image straight to `path`. If the images directory isn't writable
+    by the API user, write to a temp file and move it into place with sudo (one fork).
+    """
+    writer = WRITERS[seed_format]
+    try:
+        with open(path, "wb") as out:
+            writer(out, files)
+    except PermissionError:
+        with tempfile.NamedTemporaryFile(suffix=os.path.basename(path), delete=False) as out:
+            writer(out, files)
+        try:
+            timings.run(["sudo", "mv", out.name, path], check=True)
+        finally:
+            if os.path.exists(out.name):
+                os.remove(out.name)
+    return path
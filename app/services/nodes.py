@@ -0,0 +1,347 @@
+# app/services/nodes.py
+#
+# Registry of hypervisor nodes (libvirt URIs) and the placement scheduler.
+#
+# Nodes come from a small JSON file (KVM_ORCH_NODES_FILE), e.g.
+#   [{"name": "kvm1", "uri": "qemu:///system"},
+#    {"name": "kvm2", "uri": "qemu+ssh://root@kvm2/system"}]
+# and can be added/removed at runtime through /nodes (changes are written back to the file).
+# Without a file there is one node, "local", using KVM_ORCH_LIBVIRT_URI.
+#
+# Every libvirt service function already takes a `uri`, so "run this on node X" is just
+# passing that node's URI. Reads that cover all nodes fan out in parallel (see fan_out).
+#
+# The scheduler scores each node from getInfo() (CPUs, RAM), getFreeMemory(),
+# getCPUStats() (how busy the host is) and the free space of its storage pools (cached),
+# minus what in-flight creates have already reserved, and picks the best node that fits.
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Optional
+from urllib.parse import urlsplit
+
+import libvirt
+
+from app.services import events, inventory, storage
+from app.services.libvirt_client import LIBVIRT_URI, connection
+
+log = logging.getLogger(__name__)
+
+# Where the node list is kept.
+NODES_FILE = os.environ.get("KVM_ORCH_NODES_FILE", "/etc/kvm-orchestrator/nodes.json")
+# Name of the implicit node used when there is no nodes file.
+DEFAULT_NODE = os.environ.get("KVM_ORCH_NODE_NAME", "local")
+# vCPUs we are willing to hand out per physical CPU thread.
+CPU_OVERCOMMIT = float(os.environ.get("KVM_ORCH_CPU_OVERCOMMIT", "4"))
+# Host memory (MiB) never given to VMs, left for the host itself.
+HOST_RESERVED_MB = int(os.environ.get("KVM_ORCH_HOST_RESERVED_MB", "1024"))
+# Seconds a placement keeps its reservation after the VM was defined: the node's free memory
+# doesn't show a new guest right away. Dropped earlier once the node's inventory lists the VM running.
+RESERVATION_TTL = float(os.environ.get("KVM_ORCH_RESERVATION_TTL", "60"))
+
+
+class NoCapacity(Exception):
+    """No node has room for the requested VM."""
+
+
+class UnknownNode(KeyError):
+    """The named node is not in the registry."""
+
+
+_lock = threading.Lock()
+_nodes: dict[str, dict] = {}            # name -> {"name", "uri"}
+_reservations: dict[str, dict] = {}     # token -> {"node", "uri", "vm", "vcpus", "memory_mb", "disk_gb", "until"}
+_cpu_samples: dict[str, dict] = {}      # node -> last getCPUStats() result (for busy %)
+
+
+# ----- registry -----
+def is_local(node: dict) -> bool:
+    """True if the node's libvirt runs on this host (a URI without a host name, e.g. qemu:///system)."""
+    return urlsplit(node["uri"]).hostname is None
+
+
+def load() -> list[dict]:
+    """(Re)read the nodes file. Called once at startup from the FastAPI lifespan."""
+    nodes = []
+    try:
+        with open(NODES_FILE) as f:
+            data = json.load(f)
+        nodes = data.get("nodes", []) if isinstance(data, dict) else data
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        log.warning("can't read nodes file %s (%s); using the local node only", NODES_FILE, e)
+    if not nodes:
+        nodes = [{"name": DEFAULT_NODE, "uri": LIBVIRT_URI}]
+    with _lock:
+        _nodes.clear()
+        for node in nodes:
+            _nodes[node["name"]] = {"name": node["name"], "uri": node["uri"]}
+    return list_nodes()
+
+
+def _save() -> None:
+    # Best effort: the registry still works in memory if the file can't be written.
+    try:
+        os.makedirs(os.path.dirname(NODES_FILE), exist_ok=True)
+        tmp = NODES_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"nodes": list_nodes()}, f, indent=2)
+        os.replace(tmp, NODES_FILE)
+    except OSError as e:
+        log.warning("can't write nodes file %s: %s", NODES_FILE, e)
+
+
+def list_nodes() -> list[dict]:
+    with _lock:
+        if not _nodes:
+            _nodes[DEFAULT_NODE] = {"name": DEFAULT_NODE, "uri": LIBVIRT_URI}
+        return [dict(n) for n in _nodes.values()]
+
+
+def get_node(name: str) -> dict:
+    with _lock:
+        node = _nodes.get(name)
+    if node is None:
+        raise UnknownNode(name)
+    return dict(node)
+
+
+def uri_for(name: Optional[str]) -> str:
+    """URI of the named node (the first node when name is None)."""
+    return get_node(name)["uri"] if name else list_nodes()[0]["uri"]
+
+
+def add_node(name: str, uri: str) -> dict:
+    """Register a node after checking that we can connect to it, and start its inventory and events."""
+    with connection(uri) as conn:
+        conn.getInfo()
+    with _lock:
+        if name in _nodes:
+            raise ValueError(f"node '{name}' already exists")
+        _nodes[name] = {"name": name, "uri": uri}
+    _save()
+    inventory.start(uri)
+    events.watch_node({"name": name, "uri": uri})
+    return {"name": name, "uri": uri}
+
+
+def remove_node(name: str) -> None:
+    with _lock:
+        node = _nodes.pop(name, None)
+    if node is None:
+        raise UnknownNode(name)
+    _save()
+    events.unwatch_node(node)
+    inventory.stop(node["uri"])
+
+
+# ----- fan-out helpers -----
+def fan_out(fn: Callable[[dict], object], nodes: Optional[list[dict]] = None) -> tuple[dict, dict]:
+    """
+    Call fn(node) for every node in parallel.
+    Returns ({node name: result}, {node name: error message}) so one dead node doesn't fail the call.
+    """
+    nodes = nodes if nodes is not None else list_nodes()
+    results, errors = {}, {}
+
+    def call(node):
+        try:
+            results[node["name"]] = fn(node)
+        except Exception as e:
+            errors[node["name"]] = str(e)
+
+    if len(nodes) == 1:
+        call(nodes[0])  # the common case: no threads needed
+    else:
+        with ThreadPoolExecutor(max_workers=len(nodes), thread_name_prefix="fan-out") as pool:
+            list(pool.map(call, nodes))
+    return results, errors
+
+
+def locate(name: str) -> Optional[dict]:
+    """The node a VM lives on, or None if no node has it."""
+    nodes = list_nodes()
+    # Cached inventories answer without libvirt calls; ask them first.
+    for node in nodes:
+        inv = inventory.get(node["uri"])
+        if inv is not None and inv.get_vm(name) is not None:
+            return node
+    rest = [n for n in nodes if inventory.get(n["uri"]) is None]
+    if not rest:
+        return None
+    results, _ = fan_out(lambda node: inventory.get_vm_info(name, uri=node["uri"]), rest)
+    for node in rest:
+        if results.get(node["name"]):
+            return node
+    return None
+
+
+# ----- capacity -----
+def _cpu_busy(node_name: str, conn) -> Optional[float]:
+    """Fraction of host CPU time spent busy since the previous sample (None on the first sample)."""
+    try:
+        stats = conn.getCPUStats(libvirt.VIR_NODE_CPU_STATS_ALL_CPUS, 0)
+    except libvirt.libvirtError:
+        return None
+    with _lock:
+        prev = _cpu_samples.get(node_name)
+        _cpu_samples[node_name] = stats
+    if prev is None:
+        return None
+    total = sum(stats.values()) - sum(prev.values())
+    idle = stats.get("idle", 0) - prev.get("idle", 0)
+    return round(1 - idle / total, 3) if total > 0 else None
+
+
+def _running(reservation: dict) -> bool:
+    inv = inventory.get(reservation["uri"])
+    vm = inv.get_vm(reservation["vm"]) if inv is not None and reservation["vm"] else None
+    return bool(vm and vm.get("active"))
+
+
+def _reserved(node_name: str) -> dict:
+    now = time.monotonic()
+    with _lock:
+        pending = [(t, r) for t, r in _reservations.items() if r["node"] == node_name]
+    items = []
+    for token, r in pending:
+        # A settled reservation (VM defined) lasts until the VM runs or the TTL is over.
+        if r["until"] is not None and (now >= r["until"] or _running(r)):
+            _release(token)
+        else:
+            items.append(r)
+    return {
+        "vcpus": sum(r["vcpus"] for r in items),
+        "memory_mb": sum(r["memory_mb"] for r in items),
+        "disk_gb": sum(r["disk_gb"] for r in items),
+    }
+
+
+def capacity(node: dict) -> dict:
+    """Current capacity of one node (a few cheap libvirt calls plus the cached VM list)."""
+    with connection(node["uri"]) as conn:
+        info = conn.getInfo()  # [model, memory MiB, cpus, mhz, nodes, sockets, cores, threads]
+        free_mb = conn.getFreeMemory() // (1024 * 1024)
+        busy = _cpu_busy(node["name"], conn)
+    # Free space of the best pool for disks, from the pool capacity cache (app/services/storage.py).
+    storage_total, storage_free = storage.disk_space(node["uri"])
+    running = [vm for vm in inventory.list_vms(details=True, uri=node["uri"]) if vm["active"]]
+    return {
+        "node": node["name"],
+        "uri": node["uri"],
+        "cpus": info[2],
+        "memory_mb": info[1],
+        "free_memory_mb": free_mb,
+        "cpu_busy": busy,
+        "vms_running": len(running),
+        "vcpus_allocated": sum(vm.get("vcpus", 0) for vm in running),
+        "storage_total_gb": storage_total // 1024 ** 3 if storage_total is not None else None,
+        "storage_free_gb": storage_free // 1024 ** 3 if storage_free is not None else None,
+        "reserved": _reserved(node["name"]),
+    }
+
+
+def score(cap: dict, vcpus: int, memory_mb: int, disk_gb: int) -> Optional[float]:
+    """
+    How good a home this node is for the VM (higher is better), or None if it doesn't fit.
+    The score is the average share of memory, vCPUs and disk left free after placing the VM,
+    lowered by how busy the host CPUs currently are.
+    """
+    res = cap["reserved"]
+    mem_left = cap["free_memory_mb"] - HOST_RESERVED_MB - res["memory_mb"] - memory_mb
+    vcpu_limit = cap["cpus"] * CPU_OVERCOMMIT
+    vcpus_left = vcpu_limit - cap["vcpus_allocated"] - res["vcpus"] - vcpus
+    if mem_left < 0 or vcpus_left < 0:
+        return None
+    shares = [mem_left / cap["memory_mb"], vcpus_left / vcpu_limit]
+    if cap["storage_free_gb"] is not None:
+        disk_left = cap["storage_free_gb"] - res["disk_gb"] - disk_gb
+        if disk_left < 0:
+            return None
+        shares.append(disk_left / max(cap["storage_total_gb"], 1))
+    return round(sum(shares) / len(shares) - 0.5 * (cap["cpu_busy"] or 0), 4)
+
+
+def schedule(vcpus: int, memory_mb: int, disk_gb: int, nodes: Optional[list[dict]] = None) -> tuple[dict, list[dict]]:
+    """Pick the best node for a VM. Returns (node, candidates with their scores); raises NoCapacity."""
+    caps, errors = fan_out(capacity, nodes)
+    return _pick(caps, errors, vcpus, memory_mb, disk_gb)
+
+
+def _pick(caps: dict, errors: dict, vcpus: int, memory_mb: int, disk_gb: int) -> tuple[dict, list[dict]]:
+    candidates = []
+    for name, cap in caps.items():
+        candidates.append({"node": name, "score": score(cap, vcpus, memory_mb, disk_gb)})
+    for name, err in errors.items():
+        candidates.append({"node": name, "score": None, "error": err})
+    fitting = [c for c in candidates if c["score"] is not None]
+    if not fitting:
+        raise NoCapacity(f"no node has room for {vcpus} vCPUs / {memory_mb} MiB / {disk_gb} GiB")
+    best = max(fitting, key=lambda c: c["score"])
+    return get_node(best["node"]), candidates
+
+
+# Serialises scheduling decisions: pick a node and reserve on it before the next create looks.
+# Only the pick and the reservation run under it; node capacity is gathered before.
+_schedule_lock = threading.Lock()
+
+
+@contextmanager
+def placement(vcpus: int, memory_mb: int, disk_gb: int, node: Optional[str] = None, local_only: bool = False,
+              vm: Optional[str] = None):
+    """
+    Choose a node (or use the pinned `node`) and reserve the VM's resources on it, so parallel
+    creates don't all land on the same "emptiest" node. If the body fails the reservation goes
+    at once; otherwise it stays until VM `vm` runs on the node or RESERVATION_TTL passes.
+    `local_only` limits the choice to nodes on this host (see is_local). Yields the node dict.
+    """
+    if node:
+        chosen = get_node(node)
+        if local_only and not is_local(chosen):
+            raise NoCapacity(f"node '{node}' is remote; this disk backend can only create VMs on local nodes")
+        token = _reserve(chosen, vm, vcpus, memory_mb, disk_gb)
+    else:
+        candidates = [n for n in list_nodes() if is_local(n)] if local_only else None
+        if candidates == []:
+            raise NoCapacity("no local node; this disk backend can only create VMs on local nodes")
+        caps, errors = fan_out(capacity, candidates)  # the slow part: RPCs to every node
+        with _schedule_lock:
+            for name, cap in caps.items():
+                cap["reserved"] = _reserved(name)  # creates placed since the capacity was read
+            chosen = _pick(caps, errors, vcpus, memory_mb, disk_gb)[0]
+            token = _reserve(chosen, vm, vcpus, memory_mb, disk_gb)
+    try:
+        yield chosen
+    except BaseException:
+        _release(token)
+        raise
+    _settle(token)
+
+
+def _reserve(node: dict, vm: Optional[str], vcpus: int, memory_mb: int, disk_gb: int) -> str:
+    token = uuid.uuid4().hex
+    with _lock:
+        _reservations[token] = {"node": node["name"], "uri": node["uri"], "vm": vm, "vcpus": vcpus,
+                                "memory_mb": memory_mb, "disk_gb": disk_gb, "until": None}
+    return token
+
+
+def _settle(token: str) -> None:
+    # The VM is defined: keep the reservation until it shows up running (see _reserved).
+    if RESERVATION_TTL <= 0:
+        _release(token)
+        return
+    with _lock:
+        if token in _reservations:
+            _reservations[token]["until"] = time.monotonic() + RESERVATION_TTL
+
+
+def _release(token: str) -> None:
+    with _lock:
+        _reservations.pop(token, None)
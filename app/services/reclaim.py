@@ -0,0 +1,219 @@
+# app/services/reclaim.py
+#
+# Background storage reclamation for deleted VMs.
+#
+# Deleting a VM used to remove its disk, seed and NVRAM files inline, so a big qcow2 on busy
+# storage held the request, and tearing down 100 VMs ran one after the other. Now vm_delete()
+# only stops and undefines the domain, then queues the files here; a few worker threads
+# remove them in parallel:
+#   - files that belong to a libvirt storage pool are deleted through the pool API
+#     (storageVolLookupByPath().delete(), after wipe() if asked), which also works on remote
+#     nodes and keeps the pool's view of its volumes right;
+#   - other regular files are removed with os.remove() (only possible on the local host);
+#   - anything else (block devices outside a pool, network disks) is left alone.
+# Failures are kept for GET /reclaim and can be retried with POST /reclaim/retry.
+#
+# A new VM may reuse a deleted VM's name (and so its disk path) while the old files are still
+# queued; create_vm() calls wait_for() first so the new disk is never the one removed.
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Optional
+from urllib.parse import urlsplit
+
+import libvirt
+
+from app.services.libvirt_client import LIBVIRT_URI, connection
+
+log = logging.getLogger(__name__)
+
+# Files removed at the same time.
+RECLAIM_WORKERS = int(os.environ.get("KVM_ORCH_RECLAIM_WORKERS", "4"))
+# Zero pool volumes (vol.wipe()) before deleting them. Slow; per-request ?wipe=true also works.
+RECLAIM_WIPE = os.environ.get("KVM_ORCH_RECLAIM_WIPE", "0") == "1"
+# Failed items remembered for GET /reclaim.
+RECLAIM_FAILURES = int(os.environ.get("KVM_ORCH_RECLAIM_FAILURES", "200"))
+
+_lock = threading.Condition()
+_queue: "queue.Queue" = queue.Queue()
+_items: dict[str, dict] = {}                       # id -> queued or running item
+_failed: deque = deque(maxlen=RECLAIM_FAILURES)     # failed items, newest last
+_totals = {"reclaimed": 0, "reclaimed_bytes": 0, "skipped": 0, "failed": 0}
+_workers: list[threading.Thread] = []
+_stop = threading.Event()
+
+
+def _size(conn, path: str) -> tuple[Optional[object], int]:
+    """(pool volume or None, bytes allocated on storage) for a path."""
+    try:
+        vol = conn.storageVolLookupByPath(path)
+        return vol, vol.info()[2]  # info = [type, capacity, allocation]
+    except libvirt.libvirtError:
+        pass
+    try:
+        st = os.stat(path)
+        return None, st.st_blocks * 512
+    except OSError:
+        return None, 0
+
+
+def enqueue(conn, paths: list[str], vm: str, uri: Optional[str] = None, wipe: Optional[bool] = None) -> list[dict]:
+    """
+    Queue the files of a deleted VM for removal. `conn` is an open connection to the VM's node,
+    used to look up sizes. Returns the queued items (id, path, bytes).
+    """
+    uri = uri or LIBVIRT_URI
+    items = []
+    for path in dict.fromkeys(p for p in paths if p):
+        vol, size = _size(conn, path)
+        item = {
+            "id": uuid.uuid4().hex,
+            "vm": vm,
+            "uri": uri,
+            "path": path,
+            "bytes": size,
+            "in_pool": vol is not None,
+            "wipe": RECLAIM_WIPE if wipe is None else wipe,
+            "status": "queued",
+            "queued_at": time.time(),
+            "error": None,
+        }
+        items.append(item)
+    with _lock:
+        for item in items:
+            _items[item["id"]] = item
+    _ensure_workers()
+    for item in items:
+        _queue.put(item["id"])
+    return [{"id": i["id"], "path": i["path"], "bytes": i["bytes"]} for i in items]
+
+
+def wait_for(vm: str, uri: Optional[str] = None, timeout: float = 300) -> bool:
+    """
+    Block until no file of a deleted VM named `vm` is queued on `uri` (its disk may be in any
+    pool, so we match on the VM rather than a path). Returns False on timeout.
+    """
+    uri = uri or LIBVIRT_URI
+    deadline = time.monotonic() + timeout
+    with _lock:
+        while any(i["vm"] == vm and i["uri"] == uri for i in _items.values()):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _lock.wait(remaining)
+    return True
+
+
+def _reclaim(item: dict) -> str:
+    """Remove one file. Returns "reclaimed" or "skipped"; raises on failure."""
+    path = item["path"]
+    with connection(item["uri"]) as conn:
+        try:
+            vol = conn.storageVolLookupByPath(path)
+        except libvirt.libvirtError:
+            vol = None
+        if vol is not None:
+            if item["wipe"]:
+                vol.wipe(0)
+            vol.delete(0)
+            return "reclaimed"
+    # Not a pool volume: we can only remove regular files on this host.
+    if urlsplit(item["uri"]).hostname is not None:
+        raise RuntimeError("not in a storage pool on a remote node; define a pool for its directory")
+    if not os.path.lexists(path):
+        return "reclaimed"  # already gone (e.g. NVRAM removed by undefine)
+    if not os.path.isfile(path):
+        return "skipped"    # block device or similar: never remove device nodes
+    os.remove(path)
+    return "reclaimed"
+
+
+def _work() -> None:
+    while not _stop.is_set():
+        try:
+            item_id = _queue.get(timeout=1)
+        except queue.Empty:
+            continue
+        with _lock:
+            item = _items.get(item_id)
+            if item is None:
+                continue
+            item["status"] = "running"
+        try:
+            outcome = _reclaim(item)
+            error = None
+        except (libvirt.libvirtError, OSError, RuntimeError) as e:
+            outcome, error = "failed", str(e)
+            log.warning("reclaiming %s of VM %s failed: %s", item["path"], item["vm"], e)
+        with _lock:
+            _items.pop(item_id, None)
+            if outcome == "failed":
+                item.update(status="failed", error=error, failed_at=time.time())
+                _failed.append(item)
+                _totals["failed"] += 1
+            elif outcome == "skipped":
+                _totals["skipped"] += 1
+            else:
+                _totals["reclaimed"] += 1
+                _totals["reclaimed_bytes"] += item["bytes"]
+            _lock.notify_all()
+
+
+def _ensure_workers() -> None:
+    with _lock:
+        alive = [t for t in _workers if t.is_alive()]
+        _stop.clear()
+        for i in range(len(alive), RECLAIM_WORKERS):
+            t = threading.Thread(target=_work, name=f"reclaim-{i}", daemon=True)
+            t.start()
+            alive.append(t)
+        _workers[:] = alive
+
+
+def retry_failed() -> int:
+    """Queue every failed item again. Returns how many were queued."""
+    with _lock:
+        items = list(_failed)
+        _failed.clear()
+        for item in items:
+            item.update(status="queued", error=None, queued_at=time.time())
+            _items[item["id"]] = item
+    _ensure_workers()
+    for item in items:
+        _queue.put(item["id"])
+    return len(items)
+
+
+def status() -> dict:
+    """Pending work, totals and recent failures (GET /reclaim)."""
+    public = lambda i: {k: v for k, v in i.items() if k != "uri"}
+    with _lock:
+        pending = sorted(_items.values(), key=lambda i: i["queued_at"])
+        return {
+            "workers": RECLAIM_WORKERS,
+            "pending": len(pending),
+            "pending_bytes": sum(i["bytes"] for i in pending),
+            "running": sum(1 for i in pending if i["status"] == "running"),
+            **_totals,
+            "items": [public(i) for i in pending],
+            "failures": [public(i) for i in _failed],
+        }
+
+
+# ----- lifecycle (called from the FastAPI lifespan in app/main.py) -----
+def start() -> None:
+    _ensure_workers()
+
+
+def stop() -> None:
+    # Queued items are dropped; their files stay on disk (listed in the log).
+    _stop.set()
+    with _lock:
+        for item in _items.values():
+            log.warning("shutting down with %s of VM %s not reclaimed", item["path"], item["vm"])
+    for t in _workers:
+        t.join(timeout=5)
@@ -0,0 +1,157 @@
+# app/services/resources.py
+#
+# Changing a VM's memory and vCPUs after it was created (GET/PATCH /vms/{name}/resources).
+#
+# A VM is defined with a maximum and a current value for both (CreateVm max_memory_mb / max_vcpus):
+#   - memory: the guest sees the maximum as installed RAM; the virtio balloon driver in the guest
+#     gives back everything above the current size. setMemoryFlags() moves the balloon, so memory
+#     can go up to the maximum and back down on a running VM without a reboot.
+#   - vCPUs: setVcpusFlags() hot-plugs (or unplugs) vCPUs up to the maximum.
+# Changes apply to the running VM ("live"), to its saved definition used from the next boot
+# ("config"), or both. The maximums themselves can only change in the definition.
+#
+# The same endpoint stores the VM's auto-balloon policy (app/services/balloon.py) in its metadata.
+import logging
+from typing import Optional
+
+import libvirt
+from lxml import etree
+
+from app.services import inventory
+from app.services.libvirt_client import BALLOON_NS, BALLOON_PREFIX, balloon_policy, balloon_xml, connection
+
+log = logging.getLogger(__name__)
+
+_UNITS = {"b": 1 / 1024, "bytes": 1 / 1024, "k": 1, "kib": 1, "kb": 1000 / 1024,
+          "m": 1024, "mib": 1024, "mb": 1000 ** 2 / 1024, "g": 1024 ** 2, "gib": 1024 ** 2, "gb": 1000 ** 3 / 1024}
+
+
+class ResourceError(Exception):
+    """The change can't be made as asked (e.g. above the VM's maximum, or live on a stopped VM)."""
+
+
+def _kib(el) -> Optional[int]:
+    if el is None or not el.text:
+        return None
+    return int(int(el.text) * _UNITS.get(el.get("unit", "KiB").lower(), 1))
+
+
+def _config(dom) -> dict:
+    """Sizes in the saved definition: {"memory_kib", "max_memory_kib", "vcpus", "max_vcpus"}."""
+    root = etree.fromstring(dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE).encode())
+    max_memory = _kib(root.find("memory"))
+    vcpu = root.find("vcpu")
+    max_vcpus = int(vcpu.text) if vcpu is not None else None
+    return {
+        "memory_kib": _kib(root.find("currentMemory")) or max_memory,
+        "max_memory_kib": max_memory,
+        "vcpus": int(vcpu.get("current", max_vcpus)) if vcpu is not None else None,
+        "max_vcpus": max_vcpus,
+    }
+
+
+def _live(dom) -> Optional[dict]:
+    """Sizes of the running VM, or None if it is shut off."""
+    if dom.isActive() != 1:
+        return None
+    _, _, memory, vcpus, _ = dom.info()  # [state, max memory KiB, memory KiB, vCPUs, cpu time]
+    return {
+        "memory_kib": memory,
+        "max_memory_kib": dom.maxMemory(),
+        "vcpus": vcpus,
+        "max_vcpus": dom.vcpusFlags(libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_VCPU_MAXIMUM),
+    }
+
+
+def _mb(values: Optional[dict]) -> Optional[dict]:
+    if values is None:
+        return None
+    return {
+        "memory_mb": values["memory_kib"] // 1024 if values["memory_kib"] is not None else None,
+        "max_memory_mb": values["max_memory_kib"] // 1024 if values["max_memory_kib"] is not None else None,
+        "vcpus": values["vcpus"],
+        "max_vcpus": values["max_vcpus"],
+    }
+
+
+def _read(name: str, dom) -> dict:
+    return {"name": name, "live": _mb(_live(dom)), "config": _mb(_config(dom)), "balloon": balloon_policy(dom)}
+
+
+def get_resources(name: str, uri: Optional[str] = None) -> dict:
+    """Current and maximum memory / vCPUs of a VM, live and in its definition, plus its balloon policy."""
+    with connection(uri) as conn:
+        return _read(name, conn.lookupByName(name))
+
+
+def _check(what: str, value: int, limit: Optional[int], where: str, unit: str = "") -> None:
+    if limit is not None and value > limit:
+        raise ResourceError(f"{what} {value}{unit} is above the {where} maximum of {limit}{unit}")
+
+
+def set_resources(name: str, req, uri: Optional[str] = None) -> dict:
+    """
+    Apply a VmResources change (see app/models.py) and return the new sizes (as get_resources()).
+    The maximums change first, so one call can raise a maximum and the current value together.
+    """
+    with connection(uri) as conn:
+        dom = conn.lookupByName(name)
+        live = _live(dom) if req.live else None
+        if req.changes_size():
+            if req.live and not req.config and live is None:
+                raise ResourceError(f"VM '{name}' is not running; set config=true to change its definition")
+            if (req.max_memory_mb is not None or req.max_vcpus is not None) and not req.config:
+                raise ResourceError("max_memory_mb and max_vcpus only change the definition; set config=true")
+        config = _config(dom) if req.config else None
+
+        # Check everything before changing anything, so a refused change leaves the VM as it was.
+        if config is not None:
+            max_memory = req.max_memory_mb * 1024 if req.max_memory_mb is not None else config["max_memory_kib"]
+            max_vcpus = req.max_vcpus if req.max_vcpus is not None else config["max_vcpus"]
+            if req.memory_mb is not None:
+                _check("memory_mb", req.memory_mb, max_memory // 1024 if max_memory else None, "configured", " MiB")
+            if req.vcpus is not None:
+                _check("vcpus", req.vcpus, max_vcpus, "configured")
+        if live is not None:
+            # A running VM keeps the maximums it was started with until it is restarted.
+            if req.memory_mb is not None:
+                _check("memory_mb", req.memory_mb, live["max_memory_kib"] // 1024, "running VM's", " MiB")
+            if req.vcpus is not None:
+                _check("vcpus", req.vcpus, live["max_vcpus"], "running VM's")
+
+        policy = None
+        if req.auto_balloon is not None or req.balloon_min_mb is not None or req.balloon_max_mb is not None:
+            # Merged with the stored policy, so a bound set earlier is checked against the new one.
+            policy = balloon_policy(dom) or {"enabled": False, "min_mb": None, "max_mb": None}
+            if req.auto_balloon is not None:
+                policy["enabled"] = req.auto_balloon
+            for field in ("min_mb", "max_mb"):
+                if getattr(req, f"balloon_{field}") is not None:
+                    policy[field] = getattr(req, f"balloon_{field}")
+            if None not in (policy["min_mb"], policy["max_mb"]) and policy["min_mb"] > policy["max_mb"]:
+                raise ResourceError("balloon_min_mb must be at most balloon_max_mb")
+
+        flags = (libvirt.VIR_DOMAIN_AFFECT_LIVE if live is not None else 0) | \
+                (libvirt.VIR_DOMAIN_AFFECT_CONFIG if config is not None else 0)
+        if req.max_memory_mb is not None:
+            dom.setMemoryFlags(req.max_memory_mb * 1024,
+                               libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_MEM_MAXIMUM)
+        if req.max_vcpus is not None:
+            dom.setVcpusFlags(req.max_vcpus, libvirt.VIR_DOMAIN_AFFECT_CONFIG | libvirt.VIR_DOMAIN_VCPU_MAXIMUM)
+        if req.memory_mb is not None and flags:
+            dom.setMemoryFlags(req.memory_mb * 1024, flags)
+        if req.vcpus is not None and flags:
+            # Unplugging vCPUs needs the guest's cooperation; libvirt reports it if the guest refuses.
+            dom.setVcpusFlags(req.vcpus, flags)
+
+        if policy is not None:
+            md_flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+            if dom.isActive() == 1:
+                md_flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+            dom.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT, balloon_xml(policy),
+                            BALLOON_PREFIX, BALLOON_NS, md_flags)
+        result = _read(name, dom)
+    log.info("resources of %s changed: %s", name, req.model_dump(exclude_none=True))
+    # Config-only changes send no balloon event; have the inventory re-read the VM.
+    inventory.refresh(name, uri)
+    return result
@@ -0,0 +1,69 @@
+# app/services/selectors.py
+#
+# Resolve a VmSelector (names / prefix / glob / regex / state / active / tag) to the VMs it
+# matches.
+# Reads come from the event-driven inventory when it is running, so picking VMs out of a
+# fleet of hundreds costs no libvirt calls; without the inventory we ask libvirt directly
+# (and only fetch domain XML when the selector filters on tags).
+import fnmatch
+import re
+from typing import Optional
+
+from app.models import VmSelector
+from app.services import inventory
+from app.services.libvirt_client import connection, domain_facts, list_vms
+
+
+def is_empty(selector: VmSelector) -> bool:
+    return not (selector.all or selector.names or selector.prefix or selector.glob or selector.regex
+                or selector.state or selector.tag or selector.active is not None)
+
+
+def matches(selector: VmSelector, vm: dict, tags: Optional[list[str]] = None) -> bool:
+    """Does one VM (a list_vms() record, plus its tags) match the selector?"""
+    name = vm["name"]
+    if selector.names and name not in selector.names:
+        return False
+    if selector.prefix and not name.startswith(selector.prefix):
+        return False
+    if selector.glob and not fnmatch.fnmatchcase(name, selector.glob):
+        return False
+    if selector.regex and not re.fullmatch(selector.regex, name):
+        return False
+    if selector.state and vm["state"] != selector.state:
+        return False
+    if selector.active is not None and vm["active"] != selector.active:
+        return False
+    if selector.tag and selector.tag not in (tags or []):
+        return False
+    return True
+
+
+def records(need_tags: bool, uri: Optional[str] = None, fields=None) -> list[tuple[dict, list[str]]]:
+    """
+    (vm, tags) for every VM on `uri`. Without the inventory, `fields` limits which stats
+    libvirt is asked for, and tags (one XMLDesc per VM) are only read if need_tags.
+    """
+    inv = inventory.get(uri)
+    if inv is not None:
+        return [(vm, facts.get("tags", [])) for vm, facts in inv.records()]
+    vms = list_vms(uri=uri, fields=fields)
+    if not need_tags:
+        return [(vm, []) for vm in vms]
+    out = []
+    with connection(uri) as conn:
+        for vm in vms:
+            try:
+                tags = domain_facts(conn.lookupByName(vm["name"]).XMLDesc(0))["tags"]
+            except Exception:
+                continue  # VM vanished while we were looking
+            out.append((vm, tags))
+    return out
+
+
+def select_vms(selector: VmSelector, uri: Optional[str] = None) -> list[dict]:
+    """All VMs matching the selector, sorted by name. An empty selector matches nothing."""
+    if is_empty(selector):
+        return []
+    found = [vm for vm, tags in records(bool(selector.tag), uri) if matches(selector, vm, tags)]
+    return sorted(found, key=lambda vm: vm["name"])
@@ -0,0 +1,188 @@
+# Pre-staged qcow2 overlay pool.
+#
+# Creating the VM disk (`qemu-img create -b BASE_IMG`) used to sit on the critical
+# path of every create. This module keeps a few ready-made overlays per
+# (base image, size) in a staging directory. create_vm() claims one and renames it
+# into place (resizing it first when the VM asked for a bigger disk), and a
+# background thread tops the pool back up. Overlays left in the staging directory
+# are picked up again after a restart.
+#
+# Only disks are staged: the cloud-init seed carries the VM's name and SSH key, so
+# it can't be prepared before the request arrives.
+import logging
+import os
+import re
+import subprocess
+import threading
+import uuid
+from typing import Optional
+
+from app.services import timings
+
+log = logging.getLogger(__name__)
+
+# Where ready overlays wait to be claimed. Keep it on the same filesystem as the
+# images directory (vm_create.IMAGES_DIR) so a claim is a plain rename.
+STAGING_DIR = os.environ.get("KVM_ORCH_STAGING_DIR", "/var/lib/libvirt/images/.staging")
+# How many ready overlays to keep per (base image, size). 0 disables the pool.
+STAGING_COUNT = int(os.environ.get("KVM_ORCH_STAGING_COUNT", "2"))
+# Disk sizes (GB) to stage, comma separated. Bigger requests claim the largest smaller overlay and resize it.
+STAGING_SIZES = [int(x) for x in os.environ.get("KVM_ORCH_STAGING_SIZES", "10").split(",") if x.strip()]
+# Seconds to wait before retrying after a failed refill (e.g. base image missing).
+STAGING_RETRY = float(os.environ.get("KVM_ORCH_STAGING_RETRY", "60"))
+
+# Staged file names: <base image stem>--<size>G--<random>.qcow2
+_NAME_RE = re.compile(r"^(?P<base>.+)--(?P<size>\d+)G--[0-9a-f]{32}\.qcow2$")
+
+_lock = threading.Lock()
+_ready: dict[tuple[str, int], list[str]] = {}   # (base image path, size GB) -> staged overlay paths
+_stats = {"hits": 0, "misses": 0, "resized": 0, "created": 0, "errors": 0}
+_wake = threading.Event()
+_stop = threading.Event()
+_thread: Optional[threading.Thread] = None
+_bases: list[str] = []                          # base images to stage overlays for (see start())
+
+
+def _run(cmd: list[str]) -> None:
+    timings.run(cmd, check=True)  # subprocess.run() that records the command's latency
+
+
+def _stem(base: str) -> str:
+    return os.path.splitext(os.path.basename(base))[0]
+
+
+# ----- claiming -----
+def claim(base: str, size_gb: int, dest: str) -> bool:
+    """
+    Move a ready overlay of `base` to `dest`, grown to `size_gb` if needed.
+    Returns False (a miss) when nothing suitable is staged; the caller then creates the disk itself.
+    """
+    if STAGING_COUNT <= 0:
+        return False
+    with _lock:
+        # Exact size first, otherwise the largest staged size below the request (qcow2 can grow, not shrink).
+        sizes = sorted((s for (b, s), paths in _ready.items() if b == base and paths and s <= size_gb), reverse=True)
+        size = size_gb if size_gb in sizes else (sizes[0] if sizes else None)
+        path = _ready[(base, size)].pop() if size is not None else None
+        _stats["hits" if path else "misses"] += 1
+    _wake.set()  # refill in the background either way
+    if path is None:
+        return False
+    try:
+        if size != size_gb:
+            _run(["sudo", "qemu-img", "resize", path, f"{size_gb}G"])
+            with _lock:
+                _stats["resized"] += 1
+        _move(path, dest)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning("claiming staged overlay %s failed: %s", path, e)
+        with _lock:
+            _stats["errors"] += 1
+        # It is no longer in _ready and may be half resized: remove it (the refill makes a new one).
+        _discard(path)
+        return False
+    return True
+
+
+def _discard(path: str) -> None:
+    try:
+        try:
+            os.remove(path)
+        except PermissionError:
+            _run(["sudo", "rm", "-f", path])
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning("removing staged overlay %s failed: %s", path, e)
+
+
+def _move(src: str, dest: str) -> None:
+    # Same filesystem, so this is a rename; images dirs are usually root-owned, hence the sudo fallback.
+    try:
+        os.rename(src, dest)
+    except PermissionError:
+        _run(["sudo", "mv", src, dest])
+
+
+# ----- refilling -----
+def _create_overlay(base: str, size_gb: int) -> str:
+    path = os.path.join(STAGING_DIR, f"{_stem(base)}--{size_gb}G--{uuid.uuid4().hex}.qcow2")
+    _run(["sudo", "qemu-img", "create", "-q", "-f", "qcow2", "-F", "qcow2", "-b", base, path, f"{size_gb}G"])
+    return path
+
+
+def _missing() -> list[tuple[str, int]]:
+    with _lock:
+        return [
+            (base, size)
+            for base in _bases
+            for size in STAGING_SIZES
+            if len(_ready.get((base, size), [])) < STAGING_COUNT
+        ]
+
+
+def _refill_loop() -> None:
+    while not _stop.is_set():
+        failed = False
+        for base, size in _missing():
+            if _stop.is_set():
+                return
+            try:
+                path = _create_overlay(base, size)
+            except (OSError, subprocess.CalledProcessError) as e:
+                log.warning("staging overlay for %s (%dG) failed: %s", base, size, e)
+                with _lock:
+                    _stats["errors"] += 1
+                failed = True
+                continue
+            with _lock:
+                _ready.setdefault((base, size), []).append(path)
+                _stats["created"] += 1
+        _wake.wait(STAGING_RETRY if failed else None)
+        _wake.clear()
+
+
+def _adopt_existing() -> None:
+    # Pick up overlays staged by a previous run of the API.
+    if not os.path.isdir(STAGING_DIR):
+        _run(["sudo", "mkdir", "-p", STAGING_DIR])
+        return
+    by_stem = {_stem(b): b for b in _bases}
+    for fname in sorted(os.listdir(STAGING_DIR)):
+        m = _NAME_RE.match(fname)
+        if m and m.group("base") in by_stem:
+            key = (by_stem[m.group("base")], int(m.group("size")))
+            _ready.setdefault(key, []).append(os.path.join(STAGING_DIR, fname))
+
+
+def start(bases: list[str]) -> None:
+    """Adopt overlays left from a previous run and start refilling for `bases`."""
+    global _thread
+    if STAGING_COUNT <= 0 or _thread is not None:
+        return
+    for base in bases:
+        if base not in _bases:
+            _bases.append(base)
+    try:
+        _adopt_existing()
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning("staging directory %s unavailable: %s", STAGING_DIR, e)
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_refill_loop, name="staging-refill", daemon=True)
+    _thread.start()
+
+
+def stop() -> None:
+    global _thread
+    _stop.set()
+    _wake.set()
+    _thread = None
+
+
+def status() -> dict:
+    with _lock:
+        pools = [
+            {"base": base, "size_gb": size, "ready": len(_ready.get((base, size), [])), "target": STAGING_COUNT}
+            for base in _bases
+            for size in STAGING_SIZES
+        ]
+        return {"enabled": STAGING_COUNT > 0, "dir": STAGING_DIR, "pools": pools, **_stats}
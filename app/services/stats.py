@@ -0,0 +1,314 @@
+# app/services/stats.py
+#
+# Background per-VM performance collector.
+#
+# Every STATS_INTERVAL seconds one thread asks each node for the stats of all running
+# domains in a single getAllDomainStats() call (cpu, balloon, block, interface, vcpu).
+# Counters are turned into rates (CPU %, IOPS, bytes/s) from the difference with the
+# previous sample, and each VM keeps the last STATS_HISTORY points in a ring buffer
+# (collections.deque with maxlen), so memory use is fixed.
+#
+# The Prometheus text for /metrics is rendered once per collection and cached, so a
+# scrape just returns a prepared string: scraping often costs nothing extra.
+import collections
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import libvirt
+
+from app.services import nodes
+from app.services.libvirt_client import connection
+
+log = logging.getLogger(__name__)
+
+# Seconds between samples; 0 disables the collector.
+STATS_INTERVAL = float(os.environ.get("KVM_ORCH_STATS_INTERVAL", "10"))
+# Points kept per VM (360 x 10 s = one hour).
+STATS_HISTORY = int(os.environ.get("KVM_ORCH_STATS_HISTORY", "360"))
+
+# Everything we ask libvirt for in one bulk call.
+COLLECT_STATS = (
+    libvirt.VIR_DOMAIN_STATS_STATE
+    | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL
+    | libvirt.VIR_DOMAIN_STATS_BALLOON
+    | libvirt.VIR_DOMAIN_STATS_VCPU
+    | libvirt.VIR_DOMAIN_STATS_INTERFACE
+    | libvirt.VIR_DOMAIN_STATS_BLOCK
+)
+
+# Rate fields stored in every ring-buffer point (besides "ts").
+POINT_FIELDS = (
+    "cpu_percent", "memory_used_kib",
+    "disk_read_iops", "disk_write_iops", "disk_read_bps", "disk_write_bps",
+    "net_rx_bps", "net_tx_bps",
+)
+
+
+# Helper: pull the counters we use out of one getAllDomainStats record.
+def _raw_sample(record: dict) -> dict:
+    disks = {}
+    for i in range(record.get("block.count", 0)):
+        p = f"block.{i}."
+        disks[record.get(p + "name", str(i))] = {
+            "rd_reqs": record.get(p + "rd.reqs", 0), "wr_reqs": record.get(p + "wr.reqs", 0),
+            "rd_bytes": record.get(p + "rd.bytes", 0), "wr_bytes": record.get(p + "wr.bytes", 0),
+        }
+    nics = {}
+    for i in range(record.get("net.count", 0)):
+        p = f"net.{i}."
+        nics[record.get(p + "name", str(i))] = {
+            "rx_bytes": record.get(p + "rx.bytes", 0), "tx_bytes": record.get(p + "tx.bytes", 0),
+            "rx_pkts": record.get(p + "rx.pkts", 0), "tx_pkts": record.get(p + "tx.pkts", 0),
+        }
+    current = record.get("balloon.current", 0)
+    # "unused" needs a guest balloon driver; without it count all assigned memory as used.
+    unused = record.get("balloon.unused")
+    return {
+        "t": time.monotonic(),
+        "ts": time.time(),
+        "cpu_time": record.get("cpu.time", 0),
+        "vcpus": record.get("vcpu.current", 0),
+        "memory_kib": current,
+        "memory_max_kib": record.get("balloon.maximum", 0),
+        "memory_used_kib": current - unused if unused is not None else current,
+        "memory_rss_kib": record.get("balloon.rss"),
+        "disks": disks,
+        "nics": nics,
+    }
+
+
+def _total(devices: dict, key: str) -> int:
+    return sum(d[key] for d in devices.values())
+
+
+# Helper: rates between two raw samples of the same VM, or None if the counters went
+# backwards (the VM was restarted) or no time passed.
+def _point(prev: dict, cur: dict) -> Optional[dict]:
+    dt = cur["t"] - prev["t"]
+    if dt <= 0 or cur["cpu_time"] < prev["cpu_time"]:
+        return None
+
+    def rate(devices_key, key):
+        delta = _total(cur[devices_key], key) - _total(prev[devices_key], key)
+        return round(delta / dt, 1) if delta >= 0 else None
+
+    return {
+        "ts": round(cur["ts"], 3),
+        # 100 = one host CPU fully busy; a 4-vCPU VM can reach 400.
+        "cpu_percent": round((cur["cpu_time"] - prev["cpu_time"]) / (dt * 1e9) * 100, 2),
+        "memory_used_kib": cur["memory_used_kib"],
+        "disk_read_iops": rate("disks", "rd_reqs"),
+        "disk_write_iops": rate("disks", "wr_reqs"),
+        "disk_read_bps": rate("disks", "rd_bytes"),
+        "disk_write_bps": rate("disks", "wr_bytes"),
+        "net_rx_bps": rate("nics", "rx_bytes"),
+        "net_tx_bps": rate("nics", "tx_bytes"),
+    }
+
+
+# ----- Prometheus text format -----
+def _label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _metric(lines: list, name: str, kind: str, help_text: str, samples: list) -> None:
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        if value is None:
+            continue
+        text = ",".join(f'{k}="{_label(v)}"' for k, v in labels.items())
+        lines.append(f"{name}{{{text}}} {value}")
+
+
+def render_prometheus(latest: dict, node_stats: dict) -> str:
+    """Prometheus exposition text for the latest sample of every VM (see /metrics)."""
+    lines = []
+    vms = sorted(latest.items())
+    vm_labels = lambda key: {"node": key[0], "vm": key[1]}
+
+    _metric(lines, "kvm_orch_vm_cpu_seconds_total", "counter", "CPU time used by the VM.",
+            [(vm_labels(k), raw["cpu_time"] / 1e9) for k, (raw, _) in vms])
+    _metric(lines, "kvm_orch_vm_cpu_percent", "gauge", "CPU use over the last interval (100 = one host CPU).",
+            [(vm_labels(k), pt["cpu_percent"] if pt else None) for k, (_, pt) in vms])
+    _metric(lines, "kvm_orch_vm_vcpus", "gauge", "Current vCPU count.",
+            [(vm_labels(k), raw["vcpus"]) for k, (raw, _) in vms])
+    _metric(lines, "kvm_orch_vm_memory_bytes", "gauge", "Memory currently assigned (balloon).",
+            [(vm_labels(k), raw["memory_kib"] * 1024) for k, (raw, _) in vms])
+    _metric(lines, "kvm_orch_vm_memory_max_bytes", "gauge", "Maximum memory of the VM.",
+            [(vm_labels(k), raw["memory_max_kib"] * 1024) for k, (raw, _) in vms])
+    _metric(lines, "kvm_orch_vm_memory_used_bytes", "gauge", "Memory in use by the guest (assigned minus unused).",
+            [(vm_labels(k), raw["memory_used_kib"] * 1024) for k, (raw, _) in vms])
+    _metric(lines, "kvm_orch_vm_memory_rss_bytes", "gauge", "Resident memory of the QEMU process.",
+            [(vm_labels(k), raw["memory_rss_kib"] * 1024 if raw["memory_rss_kib"] is not None else None)
+             for k, (raw, _) in vms])
+
+    disk = lambda k, dev: {**vm_labels(k), "device": dev}
+    for key, name, help_text in (
+        ("rd_reqs", "kvm_orch_vm_disk_read_requests_total", "Disk read requests."),
+        ("wr_reqs", "kvm_orch_vm_disk_write_requests_total", "Disk write requests."),
+        ("rd_bytes", "kvm_orch_vm_disk_read_bytes_total", "Bytes read from disk."),
+        ("wr_bytes", "kvm_orch_vm_disk_write_bytes_total", "Bytes written to disk."),
+    ):
+        _metric(lines, name, "counter", help_text,
+                [(disk(k, dev), c[key]) for k, (raw, _) in vms for dev, c in sorted(raw["disks"].items())])
+
+    nic = lambda k, dev: {**vm_labels(k), "interface": dev}
+    for key, name, help_text in (
+        ("rx_bytes", "kvm_orch_vm_network_receive_bytes_total", "Bytes received."),
+        ("tx_bytes", "kvm_orch_vm_network_transmit_bytes_total", "Bytes sent."),
+        ("rx_pkts", "kvm_orch_vm_network_receive_packets_total", "Packets received."),
+        ("tx_pkts", "kvm_orch_vm_network_transmit_packets_total", "Packets sent."),
+    ):
+        _metric(lines, name, "counter", help_text,
+                [(nic(k, dev), c[key]) for k, (raw, _) in vms for dev, c in sorted(raw["nics"].items())])
+
+    nodes_sorted = sorted(node_stats.items())
+    _metric(lines, "kvm_orch_node_vms_running", "gauge", "Running VMs on the node.",
+            [({"node": n}, s["vms"]) for n, s in nodes_sorted])
+    _metric(lines, "kvm_orch_node_collect_seconds", "gauge", "Time the last stats collection took.",
+            [({"node": n}, s["seconds"]) for n, s in nodes_sorted])
+    _metric(lines, "kvm_orch_node_up", "gauge", "1 if the last stats collection succeeded.",
+            [({"node": n}, 0 if s.get("error") else 1) for n, s in nodes_sorted])
+    return "\n".join(lines) + "\n"
+
+
+class Collector:
+    """Samples all running VMs on all nodes every `interval` seconds."""
+
+    def __init__(self, interval: float = STATS_INTERVAL, history: int = STATS_HISTORY):
+        self.interval = interval
+        self.history = history
+        self._lock = threading.Lock()
+        self._series: dict[tuple, collections.deque] = {}   # (node, vm) -> ring buffer of points
+        self._latest: dict[tuple, tuple] = {}               # (node, vm) -> (raw sample, last point)
+        self._node_stats: dict[str, dict] = {}
+        self._text = render_prometheus({}, {})
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="stats-collector", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.collect()
+            except Exception:
+                log.exception("stats collection failed")
+            # Keep a steady rhythm even when a collection is slow.
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def _sample_node(self, node: dict) -> list[tuple[str, dict]]:
+        with connection(node["uri"]) as conn:
+            records = conn.getAllDomainStats(COLLECT_STATS, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+            return [(dom.name(), _raw_sample(record)) for dom, record in records]
+
+    def collect(self) -> None:
+        """Take one sample of every node, update the ring buffers and re-render /metrics."""
+        timings = {}
+
+        def timed(node):
+            started = time.monotonic()
+            try:
+                return self._sample_node(node)
+            finally:
+                timings[node["name"]] = round(time.monotonic() - started, 4)
+
+        results, errors = nodes.fan_out(timed)
+        with self._lock:
+            seen = set()
+            for node_name, samples in results.items():
+                for vm_name, raw in samples:
+                    key = (node_name, vm_name)
+                    seen.add(key)
+                    prev = self._latest.get(key)
+                    point = _point(prev[0], raw) if prev else None
+                    self._latest[key] = (raw, point)
+                    if point is not None:
+                        series = self._series.get(key)
+                        if series is None:
+                            series = self._series[key] = collections.deque(maxlen=self.history)
+                        series.append(point)
+            # VMs that stopped drop out of /metrics; their history is kept until it ages out.
+            for key in [k for k in self._latest if k not in seen and k[0] not in errors]:
+                del self._latest[key]
+            cutoff = time.time() - self.interval * self.history
+            for key in [k for k, s in self._series.items() if k not in self._latest and (not s or s[-1]["ts"] < cutoff)]:
+                del self._series[key]
+            self._node_stats = {
+                name: {"vms": len(results.get(name, [])), "seconds": timings.get(name), "error": errors.get(name)}
+                for name in set(results) | set(errors)
+            }
+            latest = dict(self._latest)
+            node_stats = dict(self._node_stats)
+        text = render_prometheus(latest, node_stats)
+        with self._lock:
+            self._text = text
+
+    # ----- reads -----
+    def prometheus(self) -> str:
+        with self._lock:
+            return self._text
+
+    def series(self, node: str, vm: str, window: float) -> list[dict]:
+        """Points of one VM from the last `window` seconds, oldest first."""
+        cutoff = time.time() - window
+        with self._lock:
+            points = list(self._series.get((node, vm), ()))
+        return [p for p in points if p["ts"] >= cutoff]
+
+
+def summarize(points: list[dict]) -> dict:
+    """Average and maximum of every rate field over a list of points."""
+    out = {}
+    for field in POINT_FIELDS:
+        values = [p[field] for p in points if p.get(field) is not None]
+        if values:
+            out[field] = {"avg": round(sum(values) / len(values), 2), "max": max(values)}
+    return out
+
+
+def parse_window(text: str) -> float:
+    """'90' / '90s' / '5m' / '1h' -> seconds. Raises ValueError."""
+    units = {"s": 1, "m": 60, "h": 3600}
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        seconds = float(text[:-1]) * units[text[-1]]
+    else:
+        seconds = float(text)
+    if seconds <= 0:
+        raise ValueError("window must be positive")
+    return seconds
+
+
+_collector: Optional[Collector] = None
+
+
+def start() -> Optional[Collector]:
+    global _collector
+    if STATS_INTERVAL <= 0:
+        return None
+    if _collector is None:
+        _collector = Collector()
+        _collector.start()
+    return _collector
+
+
+def stop() -> None:
+    global _collector
+    if _collector is not None:
+        _collector.stop()
+        _collector = None
+
+
+def get() -> Optional[Collector]:
+    return _collector
@@ -0,0 +1,281 @@
+# app/services/storage.py
+#
+# VM disks as libvirt storage pool volumes.
+#
+# Disks used to be made with `sudo qemu-img create -f qcow2 -b BASE_IMG` straight into
+# /var/lib/libvirt/images: one privileged process per create, files libvirt's pools only saw
+# after a refresh, and always the same directory. Now each disk is created by libvirt itself
+# with storageVolCreateXML(): a qcow2 volume whose <backingStore> is the base image. That also
+# works on remote nodes, keeps the pools' numbers right, and lets us choose:
+#   - the pool: the first pool of KVM_ORCH_STORAGE_POOLS (a preference list, fastest first,
+#     e.g. "nvme,default") that has room for the disk, else the pool with the most free space.
+#     Only file-based pools (dir, fs, netfs) can hold qcow2 overlays. A create can also pin a pool.
+#   - the qcow2 cluster size (qemu's default is 64 KiB; bigger clusters mean less metadata
+#     for big, mostly sequential disks).
+# Overlays are always thin: libvirt refuses preallocation for a volume with a backing store
+# ("metadata preallocation conflicts with backing store"). CreateVm preallocation only works
+# with the qemu-img disk backend (app/services/vm_create.py).
+#
+# Cloud-init seeds go into the same pool as the disk (upload_volume), so nothing of a VM needs
+# to be written to the orchestrator's own filesystem.
+#
+# Base images are registered by name (KVM_ORCH_BASE_IMAGES) and CreateVm picks one with `image`.
+# The paths must exist on every node that gets VMs of that image.
+#
+# Pool capacity (pool.info()) is cached per node for KVM_ORCH_POOL_CACHE_TTL seconds. It is shown
+# at GET /storage/pools and the scheduler (app/services/nodes.py) reads it from the cache too.
+import logging
+import os
+import threading
+import time
+from typing import Optional
+from xml.sax.saxutils import escape
+
+import libvirt
+from lxml import etree
+
+from app.services.libvirt_client import LIBVIRT_URI, connection
+
+log = logging.getLogger(__name__)
+
+# Base images as name=path pairs, comma separated. The first one is the default.
+BASE_IMAGES_SPEC = os.environ.get(
+    "KVM_ORCH_BASE_IMAGES", "jammy=/var/lib/libvirt/images/base/jammy-server-cloudimg-amd64.img")
+# Pools to put disks on, in order of preference (fastest first). Pools not listed, or a full
+# preferred pool, fall back to the pool with the most free space. Empty = always the emptiest pool.
+# (KVM_ORCH_STORAGE_POOL, the single pool of older versions, is still read as the default.)
+STORAGE_POOLS = [p.strip() for p in os.environ.get(
+    "KVM_ORCH_STORAGE_POOLS", os.environ.get("KVM_ORCH_STORAGE_POOL", "default")).split(",") if p.strip()]
+# Seconds pool capacity is cached.
+POOL_CACHE_TTL = float(os.environ.get("KVM_ORCH_POOL_CACHE_TTL", "30"))
+
+# Pool types whose volumes are files, so they can be qcow2 overlays of a base image.
+FILE_POOL_TYPES = ("dir", "fs", "netfs")
+
+
+class UnknownImage(KeyError):
+    """The named base image is not registered."""
+
+
+class NoPool(Exception):
+    """No usable storage pool on the node has room for the disk."""
+
+
+def _parse_images(spec: str) -> dict[str, str]:
+    images = {}
+    for item in spec.split(","):
+        name, sep, path = item.strip().partition("=")
+        if not item.strip():
+            continue
+        if not sep or not name.strip() or not path.strip():
+            log.warning("ignoring base image entry %r (expected name=path)", item)
+            continue
+        images[name.strip()] = path.strip()
+    return images
+
+
+BASE_IMAGES = _parse_images(BASE_IMAGES_SPEC)
+DEFAULT_IMAGE = os.environ.get("KVM_ORCH_DEFAULT_IMAGE", next(iter(BASE_IMAGES), ""))
+
+_lock = threading.Lock()
+_pools: dict[str, tuple[float, list[dict]]] = {}   # uri -> (fetched at, pools)
+_formats: dict[tuple[str, str], str] = {}          # (uri, base image path) -> its disk format
+
+
+# ----- base images -----
+def images() -> list[dict]:
+    """Registered base images (GET /storage/images)."""
+    return [{"name": name, "path": path, "default": name == DEFAULT_IMAGE} for name, path in BASE_IMAGES.items()]
+
+
+def image_path(name: Optional[str] = None) -> str:
+    """Path of a registered base image (None = the default image). Raises UnknownImage."""
+    name = name or DEFAULT_IMAGE
+    try:
+        return BASE_IMAGES[name]
+    except KeyError:
+        raise UnknownImage(name) from None
+
+
+def _backing_format(conn, uri: str, path: str) -> str:
+    """Disk format of a base image: read from its pool volume if it is in one, else qcow2 (cloud images)."""
+    key = (uri, path)
+    if key not in _formats:
+        fmt = "qcow2"
+        try:
+            found = etree.fromstring(conn.storageVolLookupByPath(path).XMLDesc(0)).find("target/format")
+            if found is not None:
+                fmt = found.get("type", fmt)
+        except libvirt.libvirtError:
+            pass
+        _formats[key] = fmt
+    return _formats[key]
+
+
+# ----- pool capacity -----
+def _fetch_pools(uri: str) -> list[dict]:
+    result = []
+    with connection(uri) as conn:
+        for pool in conn.listAllStoragePools(libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE):
+            root = etree.fromstring(pool.XMLDesc(0))
+            _, capacity, allocation, available = pool.info()  # [state, capacity, allocation, available]
+            name = pool.name()
+            result.append({
+                "name": name,
+                "type": root.get("type"),
+                "path": root.findtext("target/path"),
+                "capacity": capacity,
+                "allocation": allocation,
+                "available": available,
+                "usable": root.get("type") in FILE_POOL_TYPES,
+                "preference": STORAGE_POOLS.index(name) if name in STORAGE_POOLS else None,
+            })
+    return result
+
+
+def pools(uri: Optional[str] = None, refresh: bool = False) -> list[dict]:
+    """Active storage pools of a node with their capacity in bytes (cached for POOL_CACHE_TTL)."""
+    uri = uri or LIBVIRT_URI
+    with _lock:
+        cached = _pools.get(uri)
+    if cached is not None and not refresh and time.monotonic() - cached[0] < POOL_CACHE_TTL:
+        return [dict(p) for p in cached[1]]
+    fetched = _fetch_pools(uri)
+    with _lock:
+        _pools[uri] = (time.monotonic(), fetched)
+    return [dict(p) for p in fetched]
+
+
+def disk_space(uri: Optional[str] = None) -> tuple[Optional[int], Optional[int]]:
+    """(capacity, available) in bytes of the usable pool with the most free space, or (None, None)."""
+    try:
+        usable = [p for p in pools(uri) if p["usable"]]
+    except libvirt.libvirtError:
+        return None, None
+    if not usable:
+        return None, None
+    best = max(usable, key=lambda p: p["available"])
+    return best["capacity"], best["available"]
+
+
+def choose_pool(size_gb: int, uri: Optional[str] = None, pool: Optional[str] = None) -> dict:
+    """
+    The pool a new disk of `size_gb` goes on: `pool` if given, else the first preferred pool
+    (KVM_ORCH_STORAGE_POOLS) with room, else the usable pool with the most free space.
+    Raises NoPool.
+    """
+    candidates = pools(uri)
+    if pool is not None:
+        match = [p for p in candidates if p["name"] == pool]
+        if not match:
+            raise NoPool(f"storage pool '{pool}' is not active on this node")
+        if not match[0]["usable"]:
+            raise NoPool(f"storage pool '{pool}' is a {match[0]['type']} pool; disks need one of {', '.join(FILE_POOL_TYPES)}")
+        return match[0]
+    fitting = [p for p in candidates if p["usable"] and p["available"] >= size_gb * 1024 ** 3]
+    if not fitting:
+        raise NoPool(f"no active {'/'.join(FILE_POOL_TYPES)} storage pool has {size_gb} GiB free")
+    preferred = sorted((p for p in fitting if p["preference"] is not None), key=lambda p: p["preference"])
+    return preferred[0] if preferred else max(fitting, key=lambda p: p["available"])
+
+
+def _account(uri: str, pool_name: str, allocated: int) -> None:
+    """Charge a new volume to the cached pool numbers, so the next choice sees it before the cache expires."""
+    with _lock:
+        cached = _pools.get(uri)
+        for p in cached[1] if cached else []:
+            if p["name"] == pool_name:
+                p["allocation"] += allocated
+                p["available"] = max(p["available"] - allocated, 0)
+
+
+# ----- disk creation -----
+def volume_xml(name: str, capacity: int, backing_path: str, backing_format: str,
+               cluster_size_kb: Optional[int] = None) -> str:
+    """Volume XML for a thin qcow2 overlay of `backing_path`, `capacity` bytes big."""
+    cluster = f"\n    <clusterSize unit='KiB'>{cluster_size_kb}</clusterSize>" if cluster_size_kb else ""
+    return f"""<volume>
+  <name>{escape(name)}</name>
+  <capacity unit='bytes'>{capacity}</capacity>
+  <allocation unit='bytes'>0</allocation>
+  <target>
+    <format type='qcow2'/>{cluster}
+  </target>
+  <backingStore>
+    <path>{escape(backing_path)}</path>
+    <format type='{escape(backing_format)}'/>
+  </backingStore>
+</volume>"""
+
+
+def create_overlay(vol_name: str, pool: str, capacity: int, backing_path: str, uri: Optional[str] = None,
+                   backing_format: Optional[str] = None, cluster_size_kb: Optional[int] = None) -> dict:
+    """
+    Create volume `vol_name` in `pool`: a qcow2 overlay of `backing_path` (any file the node can
+    read, e.g. a base image or another VM's disk). Returns {"path", "pool", "allocation"}.
+    """
+    uri = uri or LIBVIRT_URI
+    with connection(uri) as conn:
+        fmt = backing_format or _backing_format(conn, uri, backing_path)
+        xml = volume_xml(vol_name, capacity, backing_path, fmt, cluster_size_kb)
+        vol = conn.storagePoolLookupByName(pool).createXML(xml, 0)
+        path, allocated = vol.path(), vol.info()[2]  # info = [type, capacity, allocation]
+    _account(uri, pool, allocated)
+    return {"path": path, "pool": pool, "allocation": allocated}
+
+
+def upload_volume(vol_name: str, pool: str, data: bytes, uri: Optional[str] = None) -> dict:
+    """
+    Create raw volume `vol_name` in `pool` holding `data` (e.g. a cloud-init seed image), sent over
+    the libvirt connection, so it also works on remote nodes. Returns {"path", "pool", "allocation"}.
+    """
+    uri = uri or LIBVIRT_URI
+    xml = f"""<volume>
+  <name>{escape(vol_name)}</name>
+  <capacity unit='bytes'>{len(data)}</capacity>
+  <target>
+    <format type='raw'/>
+  </target>
+</volume>"""
+    with connection(uri) as conn:
+        vol = conn.storagePoolLookupByName(pool).createXML(xml, 0)
+        sent = [0]
+
+        def next_chunk(stream, nbytes, opaque):
+            chunk = data[sent[0]:sent[0] + nbytes]
+            sent[0] += len(chunk)
+            return chunk  # b"" ends the upload
+
+        try:
+            stream = conn.newStream(0)
+            vol.upload(stream, 0, len(data), 0)
+            stream.sendAll(next_chunk, None)  # aborts the stream itself on error
+            stream.finish()
+        except Exception:
+            vol.delete(0)  # don't leave a half-written volume behind
+            raise
+        path, allocated = vol.path(), vol.info()[2]
+    _account(uri, pool, allocated)
+    return {"path": path, "pool": pool, "allocation": allocated}
+
+
+def create_disk(name: str, size_gb: int, image: Optional[str] = None, uri: Optional[str] = None,
+                pool: Optional[str] = None, cluster_size_kb: Optional[int] = None) -> dict:
+    """
+    Create the disk of VM `name` as a qcow2 overlay of a base image, in the pool picked by
+    choose_pool(). Returns {"path", "pool", "allocation"}.
+    """
+    base = image_path(image)
+    target = choose_pool(size_gb, uri, pool)
+    return create_overlay(f"{name}.qcow2", target["name"], size_gb * 1024 ** 3, base, uri=uri,
+                          cluster_size_kb=cluster_size_kb)
+
+
+def volume_of(path: str, uri: Optional[str] = None) -> Optional[dict]:
+    """{"pool", "capacity"} of the pool volume at `path`, or None if it isn't in a pool."""
+    with connection(uri) as conn:
+        try:
+            vol = conn.storageVolLookupByPath(path)
+            return {"pool": vol.storagePoolLookupByVolume().name(), "capacity": vol.info()[1]}
+        except libvirt.libvirtError:
+            return None
@@ -0,0 +1,222 @@
+# app/services/timings.py
+#
+# Latency instrumentation: how long each API route, libvirt call and external command takes.
+#
+# - TimingMiddleware (added to app.main.app) times every HTTP request per route template,
+#   e.g. "GET /vms/{name}".
+# - install_libvirt() wraps the public methods of the libvirt-python classes (virConnect,
+#   virDomain, virNetwork, ...) once at startup, so every libvirt call anywhere in the app
+#   is timed per method, e.g. "virConnect.getAllDomainStats".
+# - run() replaces subprocess.run() for our external commands (qemu-img, sudo mv, virt-install).
+#
+# Each name gets a fixed log-scale histogram, so recording is a bisect plus a few integer
+# updates and memory doesn't grow with traffic; p50/p95/p99 are estimated from the buckets.
+# Calls slower than KVM_ORCH_SLOW_CALL_MS are also logged. See GET /debug/timings.
+import bisect
+import functools
+import logging
+import os
+import subprocess
+import threading
+import time
+import types
+
+import libvirt
+
+log = logging.getLogger(__name__)
+
+# Set KVM_ORCH_TIMINGS=0 to switch all instrumentation off.
+TIMINGS_ENABLED = os.environ.get("KVM_ORCH_TIMINGS", "1") != "0"
+# Log calls slower than this many milliseconds (0 = don't log).
+SLOW_CALL_MS = float(os.environ.get("KVM_ORCH_SLOW_CALL_MS", "0"))
+
+# Histogram bucket upper bounds in seconds: 50 µs .. ~10 min, each ~20% wider than the last.
+BUCKETS = [0.00005 * 1.2 ** i for i in range(90)]
+
+# libvirt-python classes whose methods we time.
+LIBVIRT_CLASSES = ("virConnect", "virDomain", "virNetwork", "virStoragePool", "virStorageVol",
+                   "virInterface", "virNodeDevice", "virSecret", "virNWFilter")
+# Cheap local accessors that never reach libvirtd; timing them would only add noise.
+LIBVIRT_SKIP = {"name", "UUIDString", "UUID", "connect", "ID", "c_pointer"}
+
+
+class Histogram:
+    """Call count, error count and latency distribution for one name."""
+
+    __slots__ = ("count", "errors", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def record(self, seconds: float, error: bool) -> None:
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def quantile(self, q: float) -> float:
+        """Approximate quantile in seconds (upper bound of the bucket holding it, capped at max)."""
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(BUCKETS[i] if i < len(BUCKETS) else self.max, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        ms = lambda s: round(s * 1000, 3)
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.count, 4) if self.count else 0.0,
+            "mean_ms": ms(self.total / self.count) if self.count else 0.0,
+            "p50_ms": ms(self.quantile(0.50)),
+            "p95_ms": ms(self.quantile(0.95)),
+            "p99_ms": ms(self.quantile(0.99)),
+            "max_ms": ms(self.max),
+            "total_ms": ms(self.total),
+        }
+
+
+_lock = threading.Lock()
+_histograms: dict[str, dict[str, Histogram]] = {"route": {}, "libvirt": {}, "subprocess": {}}
+
+
+def record(kind: str, name: str, seconds: float, error: bool = False) -> None:
+    """Add one observation. kind is "route", "libvirt" or "subprocess"."""
+    with _lock:
+        hist = _histograms[kind].get(name)
+        if hist is None:
+            hist = _histograms[kind][name] = Histogram()
+        hist.record(seconds, error)
+    if SLOW_CALL_MS and seconds * 1000 >= SLOW_CALL_MS:
+        log.warning("slow %s call %s took %.0f ms%s", kind, name, seconds * 1000, " (failed)" if error else "")
+
+
+def snapshot() -> dict:
+    """Summaries for every timed name, slowest total first (GET /debug/timings)."""
+    with _lock:
+        out = {kind: {name: h.summary() for name, h in items.items()} for kind, items in _histograms.items()}
+    return {kind: dict(sorted(items.items(), key=lambda kv: -kv[1]["total_ms"])) for kind, items in out.items()}
+
+
+def reset() -> None:
+    with _lock:
+        for items in _histograms.values():
+            items.clear()
+
+
+# ----- HTTP routes -----
+class TimingMiddleware:
+    """
+    Plain ASGI middleware (not BaseHTTPMiddleware, which adds overhead and buffers streaming
+    responses). The request is timed until its response is fully sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TIMINGS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # FastAPI stores the matched route in the scope; use its template so
+            # /vms/a and /vms/b count as one route.
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "<unmatched>"
+            record("route", f"{scope['method']} {path}", time.perf_counter() - started, status["code"] >= 500)
+
+
+# ----- libvirt calls -----
+def _timed_method(name: str, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        error = True
+        try:
+            result = fn(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            record("libvirt", name, time.perf_counter() - started, error)
+    wrapper.__timed_original__ = fn
+    return wrapper
+
+
+_installed = False
+
+
+def install_libvirt() -> None:
+    """Wrap the public methods of the libvirt-python classes with timers (once per process)."""
+    global _installed
+    if _installed or not TIMINGS_ENABLED:
+        return
+    for cls_name in LIBVIRT_CLASSES:
+        cls = getattr(libvirt, cls_name, None)
+        if cls is None:
+            continue
+        for attr, fn in list(vars(cls).items()):
+            # Plain functions only: leave staticmethods, properties and already-wrapped methods alone.
+            if (attr.startswith("_") or attr in LIBVIRT_SKIP or not isinstance(fn, types.FunctionType)
+                    or hasattr(fn, "__timed_original__")):
+                continue
+            setattr(cls, attr, _timed_method(f"{cls_name}.{attr}", fn))
+    _installed = True
+
+
+def uninstall_libvirt() -> None:
+    """Undo install_libvirt() (on app shutdown)."""
+    global _installed
+    for cls_name in LIBVIRT_CLASSES:
+        cls = getattr(libvirt, cls_name, None)
+        if cls is None:
+            continue
+        for attr, fn in list(vars(cls).items()):
+            if hasattr(fn, "__timed_original__"):
+                setattr(cls, attr, fn.__timed_original__)
+    _installed = False
+
+
+# ----- external commands -----
+def command_name(cmd: list[str]) -> str:
+    """Short label for a command line: "sudo qemu-img create ..." -> "qemu-img create"."""
+    args = [a for a in cmd if not a.startswith("-")]
+    if args and args[0] == "sudo":
+        args = args[1:]
+    if not args:
+        return "?"
+    prog = os.path.basename(args[0])
+    # Tools with sub-commands (qemu-img create / resize) are timed per sub-command.
+    return f"{prog} {args[1]}" if prog in ("qemu-img", "virsh") and len(args) > 1 else prog
+
+
+def run(cmd: list[str], **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run() that records how long the command took under its command_name()."""
+    if not TIMINGS_ENABLED:
+        return subprocess.run(cmd, **kwargs)
+    started = time.perf_counter()
+    error = True
+    try:
+        result = subprocess.run(cmd, **kwargs)
+        error = result.returncode != 0
+        return result
+    finally:
+        record("subprocess", command_name(cmd), time.perf_counter() - started, error)
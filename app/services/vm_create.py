@@ -1,102 +1,282 @@
 
 # Import standard Python modules for file and process management
-import os, subprocess, tempfile, textwrap, uuid, pathlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 # Import Optional for type hinting (allows a value to be None)
-from typing import Optional
+from typing import Callable, Optional
+import libvirt
+# Pooled libvirt connections, and MAC lookup plus the shared DHCP lease index for the IP wait
+from app.services.libvirt_client import LIBVIRT_URI, connection, domain_facts, get_vm_macs, set_vm_tags
+from app.services.leases import notify_ip
+# Pool of pre-created disk overlays (app/services/staging.py)
+from app.services import staging
+# Disks as storage pool volumes, base image registry, pool capacity (app/services/storage.py)
+from app.services import storage
+# Background removal of deleted VMs' files (app/services/reclaim.py)
+from app.services import reclaim
+# In-process NoCloud seed image writer (app/services/nocloud.py)
+from app.services import nocloud
+# Job records for the per-VM items of a batch create (app/services/jobs.py)
+from app.services import jobs
+# Node registry and placement scheduler (app/services/nodes.py)
+from app.services import nodes
+# Latency tracking for the external commands we run (app/services/timings.py)
+from app.services import timings
+# Cached per-OS-variant domain XML templates (app/services/domain_xml.py)
+from app.services.domain_xml import render_domain, DEFAULT_OS_VARIANT
 
-# Path to the base Ubuntu cloud image used for new VMs
-BASE_IMG = "/var/lib/libvirt/images/base/jammy-server-cloudimg-amd64.img"
-# Directory where VM disk images and seed ISOs will be stored
+# Directory where the qemu-img backend puts disks and seed images (this host only)
 IMAGES_DIR = "/var/lib/libvirt/images"
+# How domains are defined: "native" (libvirt defineXML from a template, default) or "virt-install"
+CREATE_BACKEND = os.environ.get("KVM_ORCH_CREATE_BACKEND", "native")
+# How disks are made: "pool" (libvirt storage pool volumes, default; see app/services/storage.py)
+# or "qemu-img" (sudo qemu-img create into IMAGES_DIR, with the staging pool). The qemu-img backend
+# writes to this host's filesystem, so it can only place VMs on nodes with a local URI.
+DISK_BACKEND = os.environ.get("KVM_ORCH_DISK_BACKEND", "pool")
 
 
 # Helper function to run a shell command and raise an error if it fails
 def _run(cmd: list[str]) -> None:
-    subprocess.run(cmd, check=True)
+    timings.run(cmd, check=True)  # subprocess.run() that records the command's latency
 
 
 
-# Create a cloud-init seed ISO for the VM, containing user-data and meta-data
-# This ISO is used to set up the VM's hostname, user account, SSH key, and install the qemu-guest-agent on first boot.
+# Create a cloud-init seed image for the VM, containing user-data and meta-data
+# This image is used to set up the VM's hostname, user account, SSH key, and install the qemu-guest-agent on first boot.
+# The files are rendered from templates and the image is written in-process (app/services/nocloud.py):
+# "iso" gives an ISO9660 CD-ROM like cloud-localds did, "vfat" a small raw disk image.
+# With a `pool` the image is uploaded as a volume of that pool on the VM's node (works on remote
+# nodes); without one (qemu-img backend) it is written to IMAGES_DIR on this host.
 # (Referenced in create_vm below)
-def _mk_seed_iso(name: str, username: str, ssh_pubkey: Optional[str]) -> str:
-    # Build the cloud-init user-data file as a list of lines (YAML format)
-    lines = [
-        "#cloud-config",  # Tells cloud-init this is a config file
-        f"hostname: {name}",  # Set the VM's hostname
-        "package_update: true",  # Update package list on first boot
-        "packages:",
-        "  - qemu-guest-agent",  # Install the qemu-guest-agent package
-        "users:",
-        f"  - name: {username}",  # Create a user with the given username
-        "    groups: [sudo]",  # Add user to sudo group
-        "    shell: /bin/bash",  # Set default shell
-        "    sudo: ['ALL=(ALL) NOPASSWD:ALL']",  # Allow passwordless sudo
-    ]
-    # If an SSH public key is provided, add it to the user's authorized_keys
-    if ssh_pubkey:
-        lines += [
-            "    ssh_authorized_keys:",
-            f"      - {ssh_pubkey}",
-        ]
-
-    # Add a command to enable and start the qemu-guest-agent service on boot
-    lines += [
-        "runcmd:",
-        "  - [ systemctl, enable, --now, qemu-guest-agent ]",
-    ]
+def _mk_seed(name: str, username: str, ssh_pubkey: Optional[str], seed_format: str = "iso",
+             uri: Optional[str] = None, pool: Optional[str] = None) -> str:
+    ext = "iso" if seed_format == "iso" else "img"
+    files = nocloud.seed_files(name, username=username, ssh_pubkey=ssh_pubkey)
+    if pool is not None:
+        return storage.upload_volume(f"{name}-seed.{ext}", pool, nocloud.seed_image(files, seed_format), uri)["path"]
+    final = os.path.join(IMAGES_DIR, f"{name}-seed.{ext}")  # Final destination
+    # Return the path to the final seed image
+    return nocloud.write_seed(final, files, seed_format)
+
 
-    # Join all lines into a single string for the user-data file
-    user_data = "\n".join(lines) + "\n"
-    # Create meta-data file with a unique instance ID and the hostname
-    meta_data = f"instance-id: {uuid.uuid4()}\nlocal-hostname: {name}\n"
 
-    # Create a temporary directory to hold the files before making the ISO
-    with tempfile.TemporaryDirectory() as td:
-        ud = pathlib.Path(td, "user-data")  # Path for user-data file
-        md = pathlib.Path(td, "meta-data")  # Path for meta-data file
-        ud.write_text(user_data, encoding="utf-8")  # Write user-data
-        md.write_text(meta_data, encoding="utf-8")  # Write meta-data
-        iso = pathlib.Path(td, f"{name}-seed.iso")  # Path for the ISO file
-        # Use cloud-localds to create the seed ISO from user-data and meta-data
-        _run(["cloud-localds", str(iso), str(ud), str(md)])
-        final = os.path.join(IMAGES_DIR, f"{name}-seed.iso")  # Final destination
-        # Move the ISO to the images directory (requires sudo)
-        _run(["sudo", "mv", str(iso), final])
-    # Return the path to the final ISO file
-    return final
+# Create the VM's disk as a copy-on-write qcow2 overlay of a registered base image.
+# Returns {"path", "pool"} (pool None when the disk isn't a pool volume).
+# By default libvirt creates it as a volume of the chosen storage pool (storageVolCreateXML);
+# with KVM_ORCH_DISK_BACKEND=qemu-img we claim a pre-staged overlay or run qemu-img as before.
+def _mk_disk(name: str, disk_gb: int, image: Optional[str], uri: Optional[str], pool: Optional[str],
+             preallocation: str, cluster_size_kb: Optional[int]) -> dict:
+    if DISK_BACKEND != "qemu-img":
+        # Pool volumes with a backing store are always thin (the API rejects preallocation up front).
+        if preallocation != "off":
+            raise ValueError("preallocation needs KVM_ORCH_DISK_BACKEND=qemu-img")
+        return storage.create_disk(name, disk_gb, image=image, uri=uri, pool=pool,
+                                   cluster_size_kb=cluster_size_kb)
+    base = storage.image_path(image)
+    disk_path = os.path.join(IMAGES_DIR, f"{name}.qcow2")
+    options = []
+    if preallocation != "off":
+        options.append(f"preallocation={preallocation}")
+    if cluster_size_kb:
+        options.append(f"cluster_size={cluster_size_kb}k")
+    # Staged overlays are made with the defaults, so only plain disks can come from the staging pool
+    if options or not staging.claim(base, disk_gb, disk_path):
+        _run(["sudo", "qemu-img", "create", "-f", "qcow2", "-F", "qcow2", "-b", base]
+             + (["-o", ",".join(options)] if options else []) + [disk_path, f"{disk_gb}G"])
+    return {"path": disk_path, "pool": None}
 
 
 
 # Create a new VM with the given parameters
-# This function is called by the create_vm_endpoint in app/routers/vms.py
+# This function is called by provision_vm below (see app/routers/vms.py for the endpoint)
 # Parameters are validated by the CreateVm model in app/models.py
-def create_vm(*, name: str, vcpus: int, memory_mb: int, disk_gb: int, network: str, ssh_pubkey: Optional[str]):
-    # Path for the new VM's disk image
-    disk_path = os.path.join(IMAGES_DIR, f"{name}.qcow2")
-    # Create a new disk image as a copy-on-write overlay of the base image
-    _run(["sudo", "qemu-img", "create", "-f", "qcow2", "-F", "qcow2", "-b", BASE_IMG, disk_path, f"{disk_gb}G"])
-    # Create a cloud-init seed ISO for the VM
-    seed_iso = _mk_seed_iso(name, username="ubuntu", ssh_pubkey=ssh_pubkey)
+# `report(stage, progress)` is called as each step starts (used for job status; optional)
+def create_vm(*, name: str, vcpus: int, memory_mb: int, disk_gb: int, network: str, ssh_pubkey: Optional[str],
+              seed_format: str = "iso", os_variant: str = DEFAULT_OS_VARIANT, tags: Optional[list[str]] = None,
+              image: Optional[str] = None, pool: Optional[str] = None, preallocation: str = "off",
+              cluster_size_kb: Optional[int] = None, max_vcpus: Optional[int] = None,
+              max_memory_mb: Optional[int] = None,
+              uri: Optional[str] = None, report: Optional[Callable[[str, int], None]] = None):
+    report = report or (lambda stage, progress: None)
+    # A deleted VM of the same name may still have its files queued for removal; let that finish first.
+    if not reclaim.wait_for(name, uri):
+        raise RuntimeError(f"files of a deleted VM named '{name}' are still being removed; try again later")
+    # Files made so far; if a later step fails they are queued for removal (app/services/reclaim.py),
+    # so a retry with the same name doesn't trip over a leftover volume.
+    created = []
+    try:
+        # Create the disk image as a copy-on-write overlay of the base image
+        report("disk", 10)
+        disk = _mk_disk(name, disk_gb, image, uri, pool, preallocation, cluster_size_kb)
+        disk_path = disk["path"]
+        created.append(disk_path)
+        # Create a cloud-init seed image for the VM (ISO CD-ROM or vfat disk), next to the disk
+        report("seed", 30)
+        seed_path = _mk_seed(name, username="ubuntu", ssh_pubkey=ssh_pubkey, seed_format=seed_format,
+                             uri=uri, pool=disk["pool"])
+        created.append(seed_path)
+
+        # Define and start the domain: in-process from a cached XML template by default,
+        # or through the virt-install command when KVM_ORCH_CREATE_BACKEND=virt-install
+        report("define", 50)
+        if CREATE_BACKEND == "virt-install":
+            _virt_install(name=name, vcpus=vcpus, memory_mb=memory_mb, disk_path=disk_path, network=network,
+                          seed_path=seed_path, seed_format=seed_format, os_variant=os_variant,
+                          max_vcpus=max_vcpus, max_memory_mb=max_memory_mb, uri=uri)
+        else:
+            _define_native(name=name, vcpus=vcpus, memory_mb=memory_mb, disk_path=disk_path, network=network,
+                           seed_path=seed_path, seed_format=seed_format, os_variant=os_variant, tags=tags, uri=uri,
+                           max_vcpus=max_vcpus, max_memory_mb=max_memory_mb)
+    except Exception:
+        if created:
+            with connection(uri) as conn:
+                reclaim.enqueue(conn, created, vm=name, uri=uri)
+        raise
+    # The domain exists from here on, so its files are no longer ours to remove.
+    if CREATE_BACKEND == "virt-install" and tags:
+        set_vm_tags(name, tags, uri)
 
-    # Use virt-install to define and start the VM
+
+# Define and boot the domain through libvirt on a pooled connection (defineXML + createWithFlags).
+def _define_native(*, name, vcpus, memory_mb, disk_path, network, seed_path, seed_format, os_variant,
+                   tags=None, uri=None, max_vcpus=None, max_memory_mb=None):
+    xml = render_domain(name=name, vcpus=vcpus, memory_mb=memory_mb, disk_path=disk_path, network=network,
+                        seed_path=seed_path, seed_format=seed_format, os_variant=os_variant, tags=tags,
+                        max_vcpus=max_vcpus, max_memory_mb=max_memory_mb)
+    with connection(uri) as conn:
+        dom = conn.defineXML(xml)
+        try:
+            dom.createWithFlags(0)
+        except libvirt.libvirtError:
+            # Don't leave a defined-but-broken domain behind; the caller sees the original error.
+            dom.undefine()
+            raise
+
+
+# Fallback: use virt-install to define and start the VM
+def _virt_install(*, name, vcpus, memory_mb, disk_path, network, seed_path, seed_format, os_variant,
+                  max_vcpus=None, max_memory_mb=None, uri=None):
+    if seed_format == "iso":
+        seed_disk = f"path={seed_path},device=cdrom"
+    else:
+        seed_disk = f"path={seed_path},format=raw,device=disk,bus=virtio"
+    # --connect: the libvirt daemon of the VM's node (not necessarily this host's)
     # --import: use the existing disk image (no OS installer)
-    # --os-variant: helps virt-install optimize for Ubuntu 22.04
+    # --os-variant: helps virt-install optimize for the guest OS (e.g. Ubuntu 22.04)
     # --network: attach to the specified libvirt network
     # --graphics none: no graphical console (headless)
     # --noautoconsole: don't automatically open a console
     # --wait -1: wait until install is complete
-    _run([
+    cmd = [
         "sudo", "virt-install",
+        "--connect", uri or LIBVIRT_URI,
         "--name", name,
-        "--memory", str(memory_mb),
-        "--vcpus", str(vcpus),
+        "--memory", f"{memory_mb},maxmemory={max_memory_mb or memory_mb}",
+        "--vcpus", f"{vcpus},maxvcpus={max_vcpus or vcpus}",
         "--disk", f"path={disk_path},format=qcow2,cache=none",
-        "--disk", f"path={seed_iso},device=cdrom",
+        "--disk", seed_disk,
         "--import",  # use existing disk (cloud image) without an installer
-        "--os-variant", "ubuntu22.04",
+        "--os-variant", os_variant,
         "--network", f"network={network}",
         "--graphics", "none",
         "--noautoconsole",
         "--wait", "0" # <-- was "-1"; 0 = return immediately after start
-    ])
+    ]
+    try:
+        _run(cmd)
+    except Exception:
+        # virt-install may have defined the domain before failing (e.g. at start). Don't leave it
+        # behind pointing at the disk and seed the caller is about to remove; it sees the original error.
+        with connection(uri) as conn:
+            try:
+                dom = conn.lookupByName(name)
+            except libvirt.libvirtError:
+                dom = None
+            # Only if it is ours (uses our disk): never touch a VM that had the name already.
+            if dom is not None and disk_path in domain_facts(dom.XMLDesc(0))["disks"]:
+                if dom.isActive() == 1:
+                    dom.destroy()
+                dom.undefine()
+        raise
+
+
+# Full create pipeline run as a background job (see app/services/jobs.py):
+# disk -> seed image -> define/start -> wait for a DHCP lease (app/services/leases.py).
+# `job` receives stage/progress updates. The lease wait holds no worker: provision_vm returns a
+# jobs.Pending that the lease poller resolves with {"name", "node", "ip"} (ip None on timeout).
+def provision_vm(job, spec, ip_timeout: int = 120) -> dict:
+    # Pick a node (or use spec.node) and hold its capacity until the VM is defined
+    job.update(stage="scheduling", progress=5)
+    # (The qemu-img backend can only make files on this host, so it only places VMs on local nodes.)
+    with nodes.placement(spec.vcpus, spec.memory_mb, spec.disk_gb, node=spec.node,
+                         local_only=DISK_BACKEND == "qemu-img", vm=spec.name) as node:
+        uri = node["uri"]
+        create_vm(
+            name=spec.name,
+            vcpus=spec.vcpus,
+            memory_mb=spec.memory_mb,
+            disk_gb=spec.disk_gb,
+            network=spec.network,
+            ssh_pubkey=spec.ssh_pubkey,
+            seed_format=spec.seed_format,
+            os_variant=spec.os_variant,
+            tags=spec.tags,
+            image=spec.image,
+            pool=spec.pool,
+            preallocation=spec.preallocation,
+            cluster_size_kb=spec.cluster_size_kb,
+            max_vcpus=spec.max_vcpus,
+            max_memory_mb=spec.max_memory_mb,
+            uri=uri,
+            report=lambda stage, progress: job.update(stage=stage, progress=progress),
+        )
+
+    # Wait for a DHCP lease by MAC (more reliable than hostname), without keeping this job slot:
+    # guests that are slow to boot must not stall every other job.
+    job.update(stage="waiting_ip", progress=70)
+    macs = get_vm_macs(spec.name, uri)
+    pending = jobs.Pending()
+    notify_ip(macs, lambda ip: pending.resolve({"name": spec.name, "node": node["name"], "ip": ip}),
+              network=spec.network, timeout=ip_timeout, uri=uri)
+    return pending
+
+
+# Batch create pipeline run as one background job: every VM gets its own child job
+# (listed under "items" in the batch job) and up to `concurrency` of them are
+# provisioned at the same time. A failed VM is recorded on its item and the rest
+# carry on. Names in `taken` (being made by another job) and those `exists(name)` reports are skipped.
+def provision_batch(job, specs, concurrency: int, exists=None, taken: Optional[set] = None) -> dict:
+    taken = set(taken or ()) | {spec.name for spec in specs if exists is not None and exists(spec.name)}
+    children = [jobs.create("create_vm", target=spec.name) for spec in specs]
+    job.children = children
+    total = len(children)
+
+    def one(child, spec):
+        if spec.name in taken:
+            return jobs.execute(child, _fail, f"VM '{spec.name}' already exists")
+        return jobs.execute(child, provision_vm, spec)
+
+    # Children finish when their VM has an IP, after their worker has moved on (see provision_vm),
+    # so progress and the result come from their done callbacks.
+    pending, lock, done = jobs.Pending(), threading.Lock(), [0]
+
+    def child_done(child):
+        with lock:
+            done[0] += 1
+            count = done[0]
+        job.update(stage=f"creating ({count}/{total} done)", progress=count * 100 // total)
+        if count == total:
+            failed = [c.target for c in children if c.status == "failed"]
+            pending.resolve({"total": total, "succeeded": total - len(failed), "failed": failed})
+
+    job.update(stage="creating", progress=0)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"batch-{job.id[:8]}") as pool:
+        list(pool.map(lambda pair: one(*pair), zip(children, specs)))
+    for child in children:
+        child.add_done_callback(child_done)
+    return pending
+
+
+def _fail(job, message: str):
+    raise RuntimeError(message)
@@ -0,0 +1,6 @@
+# Benchmark suite for the KVM Orchestrator, run with `make bench` (or `python -m bench`).
+#
+# It fills libvirt's built-in test driver (test:///default, no KVM needed) with 10, 100 and
+# 1000 fake domains, then times the service functions and the HTTP endpoints (in-process,
+# through the ASGI app) at increasing concurrency. Results are printed as JSON so runs on
+# different commits can be diffed or compared with a small script.
@@ -0,0 +1,164 @@
+# python -m bench [--sizes 10,100,1000] [--concurrency 1,4,16] [--ops 200] [--only http.] [--out results.json]
+#
+# Runs every benchmark for every fleet size and concurrency level against the libvirt
+# test driver and prints one JSON document:
+#   {"meta": {...commit, versions...}, "results": [{"size", "bench", "concurrency", "p50_ms", ...}]}
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+URI = "test:///default"
+
+
+def _configure_env(uri: str) -> None:
+    # Must run before the app is imported: the services read their settings at import time.
+    os.environ["KVM_ORCH_LIBVIRT_URI"] = uri
+    os.environ.setdefault("KVM_ORCH_DOMAIN_TYPE", "test")
+    os.environ.setdefault("KVM_ORCH_STAGING_COUNT", "0")          # no qemu-img / sudo
+    os.environ.setdefault("KVM_ORCH_NODES_FILE", "/nonexistent/kvm-orch-bench-nodes.json")  # one node: `uri`
+    os.environ.setdefault("KVM_ORCH_STATS_INTERVAL", "5")
+
+
+def _meta(uri: str) -> dict:
+    import libvirt
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit or None,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "libvirt": libvirt.getVersion(),
+        "platform": platform.platform(),
+        "uri": uri,
+    }
+
+
+def service_benches(uri: str, names: list[str]) -> dict:
+    """Direct calls into app/services (no HTTP)."""
+    from app.services import inventory, libvirt_client, network_libvirt
+
+    def destroy_start(w, i, concurrency):
+        # Each worker cycles through its own slice of domains so workers never collide.
+        mine = names[w::concurrency]
+        name = mine[(i // concurrency) % len(mine)]
+        libvirt_client.vm_destroy(name, uri)
+        libvirt_client.vm_start(name, uri)
+
+    pick = lambda i: names[i % len(names)]
+    return {
+        "service.list_vms": lambda w, i, c: libvirt_client.list_vms(uri=uri),
+        "service.list_vms_details": lambda w, i, c: libvirt_client.list_vms(details=True, uri=uri),
+        "service.get_vm_info": lambda w, i, c: libvirt_client.get_vm_info(pick(i), uri),
+        "inventory.list_vms_details": lambda w, i, c: inventory.list_vms(details=True, uri=uri),
+        "inventory.get_vm_info": lambda w, i, c: inventory.get_vm_info(pick(i), uri),
+        "service.network_list": lambda w, i, c: network_libvirt.network_list(uri),
+        "service.destroy_start": destroy_start,
+    }
+
+
+def http_benches(app, names: list[str]) -> dict:
+    """Requests through the ASGI app (routing, validation, JSON encoding included)."""
+    from bench.asgi import request
+
+    async def get(path, query=""):
+        status, body = await request(app, "GET", path, query)
+        if status >= 400:
+            raise RuntimeError(f"{path} -> {status}")
+
+    async def destroy_start(w, i, concurrency):
+        mine = names[w::concurrency]
+        name = mine[(i // concurrency) % len(mine)]
+        for action in ("destroy", "start"):
+            status, _ = await request(app, "POST", f"/vms/{name}/{action}")
+            if status >= 400:
+                raise RuntimeError(f"{action} {name} -> {status}")
+
+    pick = lambda i: names[i % len(names)]
+    return {
+        "http.GET /vms/": lambda w, i, c: get("/vms/"),
+        "http.GET /vms/?details=true": lambda w, i, c: get("/vms/", "details=true"),
+        "http.GET /vms/?fields=name,state&limit=50": lambda w, i, c: get("/vms/", "fields=name,state&limit=50"),
+        "http.GET /vms/?format=ndjson": lambda w, i, c: get("/vms/", "format=ndjson"),
+        "http.GET /vms/{name}": lambda w, i, c: get(f"/vms/{pick(i)}"),
+        "http.GET /networks/": lambda w, i, c: get("/networks/"),
+        "http.GET /metrics": lambda w, i, c: get("/metrics"),
+        "http.POST /vms/{name}/destroy+start": destroy_start,
+    }
+
+
+async def run_size(uri: str, size: int, levels: list[int], ops: int, only: str) -> list[dict]:
+    from app.main import app
+    from app.services import inventory
+    from bench import fleet
+    from bench.runner import run_tasks, run_threads
+
+    fleet.cleanup(uri)
+    names = fleet.populate(uri, size)
+    results = []
+    loop = asyncio.get_running_loop()
+    try:
+        # Run inside the app's lifespan so the inventory, pools and collectors are live.
+        async with app.router.lifespan_context(app):
+            deadline = time.monotonic() + 60
+            while inventory.get(uri) is None and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+
+            for level in levels:
+                c = min(level, size)
+                for bench, op in service_benches(uri, names).items():
+                    if only and only not in bench:
+                        continue
+                    summary = await loop.run_in_executor(None, run_threads, lambda w, i: op(w, i, c), ops, c)
+                    results.append({"size": size, "bench": bench, "concurrency": c, **summary})
+                    print(f"  {size:5} {bench:40} c={c:<3} p50={summary['p50_ms']}ms "
+                          f"{summary['throughput_ops_s']} ops/s", file=sys.stderr)
+                for bench, op in http_benches(app, names).items():
+                    if only and only not in bench:
+                        continue
+                    summary = await run_tasks(lambda w, i: op(w, i, c), ops, c)
+                    results.append({"size": size, "bench": bench, "concurrency": c, **summary})
+                    print(f"  {size:5} {bench:40} c={c:<3} p50={summary['p50_ms']}ms "
+                          f"{summary['throughput_ops_s']} ops/s", file=sys.stderr)
+    finally:
+        fleet.cleanup(uri)
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench", description="KVM Orchestrator benchmarks")
+    parser.add_argument("--uri", default=URI, help="libvirt test-driver URI (default test:///default)")
+    parser.add_argument("--sizes", default="10,100,1000", help="comma-separated fleet sizes")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--ops", type=int, default=200, help="operations per benchmark and level")
+    parser.add_argument("--only", default="", help="run only benchmarks whose name contains this")
+    parser.add_argument("--out", help="write the JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    _configure_env(args.uri)
+    sizes = [int(s) for s in args.sizes.split(",")]
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    results = []
+    for size in sizes:
+        print(f"fleet of {size} domains", file=sys.stderr)
+        results += asyncio.run(run_size(args.uri, size, levels, args.ops, args.only))
+
+    report = json.dumps({"meta": _meta(args.uri), "results": results}, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(report + "\n")
+        print(f"wrote {args.out}", file=sys.stderr)
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
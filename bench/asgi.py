@@ -0,0 +1,53 @@
+# A minimal in-process ASGI client: calls the FastAPI app directly, without a server or
+# sockets, so the numbers measure our code and not the network stack. Only what the
+# benchmarks need (method, path, query string, JSON body) is supported.
+import asyncio
+import json
+from typing import Optional
+
+
+async def request(app, method: str, path: str, query: str = "", body: Optional[dict] = None) -> tuple[int, bytes]:
+    """Send one HTTP request to `app`; returns (status code, response body)."""
+    payload = json.dumps(body).encode() if body is not None else b""
+    headers = [(b"host", b"bench")]
+    if body is not None:
+        headers += [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())]
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 0),
+        "server": ("bench", 80),
+    }
+    sent_body = False
+    status = 0
+    chunks = []
+    finished = asyncio.Event()
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {"type": "http.request", "body": payload, "more_body": False}
+        # Streaming responses listen for a disconnect; only "disconnect" once the response is done.
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                finished.set()
+
+    await app(scope, receive, send)
+    return status, b"".join(chunks)
@@ -0,0 +1,73 @@
+# CLI startup budget, run with `make bench-cli` (or `python -m bench.cli_startup`).
+#
+# Scripts call the CLI in loops, so `import cli.__main__` has to stay cheap. This runs
+# `python -X importtime -c "import cli.__main__"` a few times in fresh interpreters and
+# checks two things:
+#   - the median cumulative import time of cli.__main__ is under --budget-ms;
+#   - none of the heavy modules that only some commands need (requests, urllib3, rich,
+#     http.client) were imported at startup.
+# Prints a JSON report and exits 1 if the budget is blown, so it can run in CI.
+# python -m bench.cli_startup [--budget-ms 100] [--runs 7]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules that must only be imported inside the commands that use them (see cli/client.py).
+LAZY_MODULES = ("requests", "urllib3", "rich", "http.client")
+# Imported eagerly on purpose: the command tree is built from typer decorators at import time.
+# Reported separately as the fixed part of the budget (about 45 of ~60 ms here, click included).
+EAGER_MODULES = ("typer",)
+
+
+def parse_importtime(stderr: str) -> dict[str, int]:
+    """{module: cumulative microseconds} from -X importtime output."""
+    result = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        try:
+            result[name.strip()] = int(cumulative)
+        except ValueError:
+            continue  # the header line
+    return result
+
+
+def measure(python: str, root: str) -> dict[str, int]:
+    proc = subprocess.run([python, "-X", "importtime", "-c", "import cli.__main__"],
+                          cwd=root, capture_output=True, text=True, check=True)
+    return parse_importtime(proc.stderr)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget-ms", type=float, default=100, help="max median import time of cli.__main__")
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--python", default=sys.executable)
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = [measure(args.python, root) for _ in range(args.runs)]
+    totals = [r.get("cli.__main__", 0) / 1000 for r in runs]
+    loaded = sorted({lazy for r in runs for m in r for lazy in LAZY_MODULES if m == lazy or m.startswith(lazy + ".")})
+    # The biggest cumulative costs, to show where time goes when the budget is blown.
+    slowest = sorted(runs[-1].items(), key=lambda kv: -kv[1])[:10]
+    median = statistics.median(totals)
+    report = {
+        "median_ms": round(median, 1),
+        "min_ms": round(min(totals), 1),
+        "budget_ms": args.budget_ms,
+        "eager_by_design_ms": {m: round(statistics.median(r.get(m, 0) for r in runs) / 1000, 1) for m in EAGER_MODULES},
+        "eager_heavy_modules": loaded,
+        "slowest_cumulative_ms": {name: round(us / 1000, 1) for name, us in slowest},
+        "ok": median <= args.budget_ms and not loaded,
+    }
+    print(json.dumps(report, indent=2))
+    return 0 if report["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
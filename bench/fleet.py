@@ -0,0 +1,53 @@
+# Fill the libvirt test driver with N throw-away domains, and remove them again.
+#
+# test:///default keeps its state per process and shares it between connections, so domains
+# defined here are seen by the connection pool, the inventory and the stats collector alike.
+import libvirt
+
+PREFIX = "bench-"
+
+DOMAIN_XML = """<domain type='test'>
+  <name>{name}</name>
+  <metadata>
+    <kvmo:tags xmlns:kvmo="https://github.com/bufanoc/kvm-orchestrator/tags"><kvmo:tag>{tag}</kvmo:tag></kvmo:tags>
+  </metadata>
+  <memory unit='MiB'>512</memory>
+  <vcpu>1</vcpu>
+  <os><type>hvm</type></os>
+  <devices>
+    <interface type='network'>
+      <mac address='52:54:00:{m1:02x}:{m2:02x}:{m3:02x}'/>
+      <source network='default'/>
+    </interface>
+  </devices>
+</domain>"""
+
+
+def names(count: int) -> list[str]:
+    return [f"{PREFIX}{i:04d}" for i in range(count)]
+
+
+def populate(uri: str, count: int) -> list[str]:
+    """Define and start `count` domains named bench-0000...; returns their names."""
+    conn = libvirt.open(uri)
+    try:
+        for i, name in enumerate(names(count)):
+            xml = DOMAIN_XML.format(name=name, tag="even" if i % 2 == 0 else "odd",
+                                    m1=0xbe, m2=(i >> 8) & 0xff, m3=i & 0xff)
+            conn.defineXML(xml).createWithFlags(0)
+    finally:
+        conn.close()
+    return names(count)
+
+
+def cleanup(uri: str) -> None:
+    """Destroy and undefine every bench-* domain."""
+    conn = libvirt.open(uri)
+    try:
+        for dom in conn.listAllDomains(0):
+            if dom.name().startswith(PREFIX):
+                if dom.isActive() == 1:
+                    dom.destroy()
+                dom.undefine()
+    finally:
+        conn.close()
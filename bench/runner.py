@@ -0,0 +1,67 @@
+# Timing helpers: run an operation N times at a given concurrency and summarise the latencies.
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    values = sorted(latencies)
+    ms = lambda s: round(s * 1000, 3)
+    return {
+        "ops": len(values),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput_ops_s": round(len(values) / elapsed, 1) if elapsed > 0 else None,
+        "mean_ms": ms(sum(values) / len(values)) if values else 0.0,
+        "p50_ms": ms(percentile(values, 0.50)),
+        "p95_ms": ms(percentile(values, 0.95)),
+        "p99_ms": ms(percentile(values, 0.99)),
+        "max_ms": ms(values[-1]) if values else 0.0,
+    }
+
+
+def run_threads(op, ops: int, concurrency: int) -> dict:
+    """
+    Call op(worker, i) `ops` times spread over `concurrency` threads.
+    An op that raises counts as an error (its latency is still recorded).
+    """
+    latencies, errors = [], [0]
+
+    def worker(w: int):
+        for i in range(w, ops, concurrency):
+            started = time.perf_counter()
+            try:
+                op(w, i)
+            except Exception:
+                errors[0] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+async def run_tasks(op, ops: int, concurrency: int) -> dict:
+    """Async version of run_threads(): `concurrency` tasks awaiting op(worker, i)."""
+    latencies, errors = [], [0]
+
+    async def worker(w: int):
+        for i in range(w, ops, concurrency):
+            started = time.perf_counter()
+            try:
+                await op(w, i)
+            except Exception:
+                errors[0] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    return summarize(latencies, errors[0], time.perf_counter() - started)
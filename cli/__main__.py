@@ -1,8 +1,15 @@
+# Heavy modules (requests and friends) are imported inside the commands that need them,
+# so `list` and `ip <name>` start fast; see cli/client.py.
+import json
 import sys
-from typing import Optional
+import time
+from typing import List, Optional
 
+# typer (and click through it) stays a top-level import: every command is declared with its
+# decorators, so it can't be deferred. It is most of the startup budget; bench/cli_startup.py reports it.
 import typer
-from .client import api, save_base_url
+from .client import api, save_base_url, iter_events, iter_ndjson, get_json, ApiError
+from .multi import GLOB_CHARS, resolve_targets, run_many, parallel_map, print_results, finish, error_text
 
 app = typer.Typer(help="KVM Orchestrator CLI")
 
@@ -15,61 +22,218 @@ def set_url(url: str = typer.Argument(..., help="Base API URL, e.g. http://127.0
 
 # ----- VM list -----
 @app.command("list")
-def list_vms():
+def list_vms(
+    state: Optional[str] = typer.Option(None, "--state", help="Only VMs in this state, e.g. running"),
+    prefix: Optional[str] = typer.Option(None, "--prefix", help="Only VMs whose name starts with this"),
+    tag: Optional[str] = typer.Option(None, "--tag", help="Only VMs with this tag"),
+):
     """List VMs."""
-    base, s = api()
-    r = s.get(f"{base}/vms/")
-    r.raise_for_status()
-    vms = r.json().get("vms", [])
-    if not vms:
+    # Ask only for the columns we print, filter on the server, and stream the rows
+    # (NDJSON) so big fleets start printing right away. Plain GET: lightweight path.
+    params = {"fields": "name,node,state,active", "format": "ndjson"}
+    params.update({k: v for k, v in (("state", state), ("prefix", prefix), ("tag", tag)) if v})
+    count = 0
+    for vm in _light_stream(iter_ndjson("/vms/", params)):
+        if "error" in vm:
+            typer.secho(f"node {vm['node']}: {vm['error']}", fg=typer.colors.RED, err=True)
+            continue
+        if count == 0:
+            # simple table
+            typer.echo(f"{'NAME':20} {'NODE':12} {'STATE':10} ACTIVE")
+        count += 1
+        typer.echo(f"{vm['name']:20} {vm.get('node', '-'):12} {vm['state']:10} {str(vm['active']).lower()}")
+    if count == 0:
         typer.echo("No VMs found.")
         raise typer.Exit(0)
-    # simple table
-    typer.echo(f"{'NAME':20} {'STATE':10} ACTIVE")
-    for vm in vms:
-        typer.echo(f"{vm['name']:20} {vm['state']:10} {str(vm['active']).lower()}")
+
+# ----- options shared by the multi-VM commands -----
+# Every command below takes any number of names and globs ('web-*'), plus --from-file, and runs
+# the requests --parallel at a time over one keep-alive session. Output is a table or JSON;
+# the exit code is 1 if any VM failed.
+NAMES = typer.Argument(None, help="VM names or globs, e.g. web-1 'db-*'")
+FROM_FILE = typer.Option(None, "--from-file", "-f", help="Read more VM names from a file, one per line ('-' = stdin)")
+PARALLEL = typer.Option(10, "--parallel", "-p", min=1, max=200, help="Requests in flight at once")
+OUTPUT = typer.Option("table", "--output", "-o", help="table or json")
+
+
+def _each(names, from_file, parallel, output, call, detail):
+    base, s = api(pool_size=parallel)
+    targets = resolve_targets(base, s, names, from_file)
+    results = run_many(lambda name: call(base, s, name), targets, parallel)
+    print_results(results, output, detail)
+    finish(results)
+
+
+def _message(r) -> str:
+    return r["message"]
+
+
+def _light_stream(items):
+    """Iterate a lightweight-path stream, turning ApiError into a message and exit code 1."""
+    try:
+        yield from items
+    except ApiError as e:
+        typer.secho(e.detail, fg=typer.colors.RED, err=True)
+        raise typer.Exit(1)
+
 
 # ----- VM IP -----
 @app.command("ip")
-def vm_ip(name: str = typer.Argument(..., help="VM name")):
-    """Get a VM's IP (guest-agent with DHCP fallback)."""
-    base, s = api()
-    r = s.get(f"{base}/vms/{name}/ip")
-    if r.status_code == 404:
-        typer.echo("No IP found.")
-        raise typer.Exit(1)
-    r.raise_for_status()
-    data = r.json()
-    typer.echo(f"{name}: {data['ip']} ({data.get('source','?')})")
+def vm_ip(names: Optional[List[str]] = NAMES, from_file: Optional[str] = FROM_FILE,
+          parallel: int = PARALLEL, output: str = OUTPUT):
+    """Get VMs' IPs (DHCP lease index, then guest agent / leases / ARP)."""
+    if names and len(names) == 1 and not from_file and not GLOB_CHARS & set(names[0]) and output == "table":
+        # One plain name: a single GET on the lightweight path, printed like before.
+        name = names[0]
+        try:
+            data = get_json(f"/vms/{name}/ip")
+        except ApiError as e:
+            typer.echo("No IP found." if e.status == 404 else e.detail)
+            raise typer.Exit(1)
+        typer.echo(f"{name}: {data['ip']} ({data.get('source', '?')})")
+        return
+
+    def call(base, s, name):
+        r = s.get(f"{base}/vms/{name}/ip")
+        r.raise_for_status()
+        return {"ip": r.json()["ip"], "source": r.json().get("source")}
+    _each(names, from_file, parallel, output, call, lambda r: f"{r['ip']} ({r.get('source') or '?'})")
+
+
+@app.command("wait-ip")
+def wait_ip(names: Optional[List[str]] = NAMES, from_file: Optional[str] = FROM_FILE,
+            timeout: int = typer.Option(120, "--timeout", "-t", help="Give up after this many seconds"),
+            parallel: int = typer.Option(50, "--parallel", "-p", min=1, max=200, help="VMs waited on at once"),
+            output: str = OUTPUT):
+    """Block until VMs have an IP address."""
+    deadline = time.monotonic() + timeout
+
+    def call(base, s, name):
+        # Long-poll: the server holds the request until an address appears (no polling here).
+        remaining = max(0, round(deadline - time.monotonic()))
+        r = s.get(f"{base}/vms/{name}/ip", params={"wait": remaining}, timeout=remaining + 30)
+        r.raise_for_status()
+        return {"ip": r.json()["ip"], "source": r.json().get("source"),
+                "seconds": round(timeout - (deadline - time.monotonic()), 1)}
+    _each(names, from_file, parallel, output, call,
+          lambda r: f"{r['ip']} ({r.get('source') or '?'}) after {r['seconds']}s")
+
 
 # ----- VM start/stop/destroy/delete -----
 @app.command("start")
-def start_vm(name: str):
-    base, s = api()
-    r = s.post(f"{base}/vms/{name}/start")
-    r.raise_for_status()
-    typer.echo(r.json()["message"])
+def start_vm(names: Optional[List[str]] = NAMES, from_file: Optional[str] = FROM_FILE,
+             parallel: int = PARALLEL, output: str = OUTPUT):
+    """Power on VMs."""
+    _each(names, from_file, parallel, output, lambda base, s, name: _post(s, f"{base}/vms/{name}/start"), _message)
 
 @app.command("shutdown")
-def shutdown_vm(name: str):
-    base, s = api()
-    r = s.post(f"{base}/vms/{name}/shutdown")
-    r.raise_for_status()
-    typer.echo(r.json()["message"])
+def shutdown_vm(names: Optional[List[str]] = NAMES, from_file: Optional[str] = FROM_FILE,
+                parallel: int = PARALLEL, output: str = OUTPUT):
+    """Gracefully shut down VMs (ACPI)."""
+    _each(names, from_file, parallel, output, lambda base, s, name: _post(s, f"{base}/vms/{name}/shutdown"), _message)
 
 @app.command("destroy")
-def destroy_vm(name: str):
-    base, s = api()
-    r = s.post(f"{base}/vms/{name}/destroy")
-    r.raise_for_status()
-    typer.echo(r.json()["message"])
+def destroy_vm(names: Optional[List[str]] = NAMES, from_file: Optional[str] = FROM_FILE,
+               parallel: int = PARALLEL, output: str = OUTPUT):
+    """Hard-stop VMs."""
+    _each(names, from_file, parallel, output, lambda base, s, name: _post(s, f"{base}/vms/{name}/destroy"), _message)
 
 @app.command("delete")
-def delete_vm(name: str):
-    base, s = api()
-    r = s.delete(f"{base}/vms/{name}")
+def delete_vm(names: Optional[List[str]] = NAMES, from_file: Optional[str] = FROM_FILE,
+              parallel: int = PARALLEL, output: str = OUTPUT):
+    """Undefine VMs and remove their storage."""
+    def call(base, s, name):
+        r = s.delete(f"{base}/vms/{name}")
+        r.raise_for_status()
+        return r.json()
+    _each(names, from_file, parallel, output, call, _message)
+
+
+def _post(s, url: str) -> dict:
+    r = s.post(url)
     r.raise_for_status()
-    typer.echo(r.json()["message"])
+    return r.json()
+
+
+# ----- watch -----
+@app.command("watch")
+def watch(names: Optional[List[str]] = NAMES, from_file: Optional[str] = FROM_FILE,
+          state: Optional[str] = typer.Option(None, "--state", "-s",
+              help="Block until every VM is in this state (running, shutoff, paused, ...)"),
+          timeout: Optional[int] = typer.Option(None, "--timeout", "-t", help="Give up after this many seconds"),
+          output: str = OUTPUT):
+    """Print VM events as they happen, or with --state wait until VMs reach a state."""
+    base, s = api(pool_size=4)
+    targets = resolve_targets(base, s, names, from_file) if (names or from_file) else None
+    deadline = time.monotonic() + timeout if timeout else None
+    params = {}
+    # Let the server filter by VM, unless the list would make the URL too long.
+    if targets and len(targets) <= 50:
+        params["vm"] = ",".join(targets)
+
+    if state is None:
+        # Tail mode: one line per event until Ctrl-C (or --timeout).
+        for event in iter_events(base, s, params, deadline):
+            if event["type"] == "connected" or (targets and event.get("vm") not in targets):
+                continue
+            if output == "json":
+                typer.echo(json.dumps(event))
+                continue
+            data = event.get("data", {})
+            what = data.get("event") or data.get("stage") or data.get("ip") or ""
+            stamp = time.strftime("%H:%M:%S", time.localtime(event.get("time", time.time())))
+            typer.echo(f"{stamp} {event['type']:10} {event.get('vm') or '-':20} {what}")
+        return
+
+    if not targets:
+        typer.secho("--state needs VM names, globs or --from-file.", fg=typer.colors.RED, err=True)
+        raise typer.Exit(2)
+    started = time.monotonic()
+    reached: dict = {}     # name -> seconds it took
+    gone: set = set()
+    last_seen: dict = {}   # name -> last state we read
+
+    def check(names_to_check):
+        # Read the current state of the VMs we still wait for (one request each, in parallel).
+        import requests
+
+        def one(name):
+            try:
+                r = s.get(f"{base}/vms/{name}")
+            except requests.RequestException:
+                return name, "?"  # try again on the next event
+            if r.status_code == 404:
+                return name, None
+            return name, r.json().get("state", "?") if r.ok else "?"
+        for name, current in parallel_map(one, names_to_check, 10):
+            if current is None:
+                gone.add(name)
+            else:
+                last_seen[name] = current
+                if current == state:
+                    reached[name] = round(time.monotonic() - started, 1)
+
+    params["type"] = "lifecycle,undefined"
+    for event in iter_events(base, s, params, deadline):
+        pending = [n for n in targets if n not in reached and n not in gone]
+        if event["type"] in ("connected", "reset"):
+            # (Re)connected, maybe after missing events: re-read everything still pending.
+            check(pending)
+        elif event.get("vm") in pending:
+            check([event["vm"]])
+        if all(n in reached or n in gone for n in targets):
+            break  # don't wait for another event once everything is settled
+
+    results = []
+    for name in targets:
+        if name in reached:
+            results.append({"name": name, "ok": True, "state": state, "seconds": reached[name]})
+        elif name in gone:
+            results.append({"name": name, "ok": False, "error": "VM not found (undefined?)"})
+        else:
+            results.append({"name": name, "ok": False, "error": f"timed out in state {last_seen.get(name, '?')}"})
+    print_results(results, output, lambda r: f"{r['state']} after {r['seconds']}s")
+    finish(results)
 
 # ----- VM create -----
 @app.command("create")
@@ -81,6 +245,13 @@ def create_vm(
     network: str = typer.Option("default", "--network", help="Libvirt network"),
     ssh_pubkey: Optional[str] = typer.Option(None, "--ssh-pubkey",
         help="Public key string or @/path/to/key.pub"),
+    seed_format: str = typer.Option("iso", "--seed-format", help="cloud-init seed: iso (CD-ROM) or vfat (raw disk)"),
+    image: Optional[str] = typer.Option(None, "--image", help="Base image name (see GET /storage/images)"),
+    pool: Optional[str] = typer.Option(None, "--pool", help="Storage pool for the disk (default: preferred or emptiest)"),
+    preallocation: str = typer.Option("off", "--preallocation", help="Disk preallocation: off, metadata or falloc (qemu-img disk backend only)"),
+    cluster_size: Optional[int] = typer.Option(None, "--cluster-size", help="qcow2 cluster size in KiB"),
+    max_vcpu: Optional[int] = typer.Option(None, "--max-vcpu", help="vCPUs it can be hot-plugged up to later"),
+    max_ram: Optional[int] = typer.Option(None, "--max-ram", help="Memory (MB) the balloon can grow to later"),
 ):
     """Create a VM and print its IP when ready (API returns as soon as domain starts)."""
     base, s = api()
@@ -99,17 +270,107 @@ def create_vm(
         "disk_gb": disk,
         "network": network,
         "ssh_pubkey": key,
+        "seed_format": seed_format,
+        "image": image,
+        "pool": pool,
+        "preallocation": preallocation,
+        "cluster_size_kb": cluster_size,
+        "max_vcpus": max_vcpu,
+        "max_memory_mb": max_ram,
     }
 
-    r = s.post(f"{base}/vms/", json=payload)
+    # wait=true: the API runs the create job inline and answers once the VM has an IP
+    r = s.post(f"{base}/vms/", json=payload, params={"wait": "true"})
     if r.status_code == 409:
         typer.secho(r.json().get("detail", "duplicate name"), fg=typer.colors.RED)
         raise typer.Exit(1)
     r.raise_for_status()
     data = r.json()
     typer.echo(data["message"])
+    if data.get("node"):
+        typer.echo(f"Node: {data['node']}")
     typer.echo(f"IP: {data.get('ip')}")
 
+# ----- VM clone -----
+@app.command("clone")
+def clone_vm(
+    source: str = typer.Argument(..., help="VM to clone (e.g. a prepared golden VM)"),
+    names: Optional[List[str]] = typer.Argument(None, help="Names for the clones"),
+    count: int = typer.Option(0, "--count", "-c", help="Also make this many clones named by --pattern"),
+    pattern: Optional[str] = typer.Option(None, "--pattern", help="Name pattern for --count (default '<source>-{n}')"),
+    fresh_seed: bool = typer.Option(True, "--fresh-seed/--no-seed",
+        help="New cloud-init seed per clone (hostname, machine-id)"),
+    ssh_pubkey: Optional[str] = typer.Option(None, "--ssh-pubkey", help="Extra public key or @/path/to/key.pub"),
+    tag: Optional[List[str]] = typer.Option(None, "--tag", help="Tags for the clones (default: the source's)"),
+    power_on: bool = typer.Option(True, "--start/--no-start", help="Start the clones once defined"),
+    output: str = OUTPUT,
+):
+    """Make linked clones of a VM (qcow2 overlays of its disks; takes seconds, not minutes)."""
+    base, s = api()
+    key = ssh_pubkey
+    if ssh_pubkey and ssh_pubkey.startswith("@"):
+        from pathlib import Path
+        key = Path(ssh_pubkey[1:]).read_text().strip()
+    payload = {"names": names or [], "count": count, "fresh_seed": fresh_seed, "ssh_pubkey": key,
+               "tags": tag or None, "power_on": power_on}
+    if count:
+        payload["name_pattern"] = pattern or source + "-{n}"
+    r = s.post(f"{base}/vms/{source}/clone", json=payload, params={"wait": "true"})
+    import requests
+    try:
+        r.raise_for_status()
+    except requests.HTTPError as e:
+        typer.secho(error_text(e), fg=typer.colors.RED, err=True)
+        raise typer.Exit(1)
+    clones = r.json()["result"]["clones"]
+    print_results(clones, output, lambda c: ", ".join(c["disks"]))
+    finish(clones)
+
+# ----- VM resize -----
+@app.command("resize")
+def resize_vm(
+    name: str = typer.Argument(..., help="VM name"),
+    vcpu: Optional[int] = typer.Option(None, "--vcpu", help="vCPU count (hot-plug up to the maximum)"),
+    ram: Optional[int] = typer.Option(None, "--ram", help="Memory (MB), moved with the balloon up to the maximum"),
+    max_vcpu: Optional[int] = typer.Option(None, "--max-vcpu", help="New vCPU maximum (from the next boot)"),
+    max_ram: Optional[int] = typer.Option(None, "--max-ram", help="New memory maximum in MB (from the next boot)"),
+    scope: str = typer.Option("both", "--scope", help="live (running VM only), config (next boot only) or both"),
+    auto_balloon: Optional[bool] = typer.Option(None, "--auto-balloon/--no-auto-balloon",
+        help="Let the balloon controller manage this VM's memory"),
+    balloon_min: Optional[int] = typer.Option(None, "--balloon-min", help="Smallest memory (MB) the controller may set"),
+    balloon_max: Optional[int] = typer.Option(None, "--balloon-max", help="Largest memory (MB) the controller may set"),
+    output: str = OUTPUT,
+):
+    """Change a VM's memory and vCPUs (live and/or in its definition); without options, show them."""
+    base, s = api()
+    payload = {k: v for k, v in {
+        "vcpus": vcpu, "memory_mb": ram, "max_vcpus": max_vcpu, "max_memory_mb": max_ram,
+        "auto_balloon": auto_balloon, "balloon_min_mb": balloon_min, "balloon_max_mb": balloon_max,
+    }.items() if v is not None}
+    if payload:
+        payload.update(live=scope in ("live", "both"), config=scope in ("config", "both"))
+        r = s.patch(f"{base}/vms/{name}/resources", json=payload)
+    else:
+        r = s.get(f"{base}/vms/{name}/resources")
+    import requests
+    try:
+        r.raise_for_status()
+    except requests.HTTPError as e:
+        typer.secho(error_text(e), fg=typer.colors.RED, err=True)
+        raise typer.Exit(1)
+    data = r.json()
+    if output == "json":
+        typer.echo(json.dumps(data, indent=2))
+        return
+    for label in ("live", "config"):
+        v = data[label]
+        typer.echo(f"{label:<7} " + ("shut off" if v is None else
+                   f"{v['memory_mb']}/{v['max_memory_mb']} MB  {v['vcpus']}/{v['max_vcpus']} vCPUs"))
+    policy = data.get("balloon")
+    if policy:
+        bounds = f"{policy['min_mb'] or 'floor'}-{policy['max_mb'] or 'max'} MB"
+        typer.echo(f"balloon {'auto' if policy['enabled'] else 'manual'} ({bounds})")
+
 def main():
     app()
 
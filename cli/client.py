@@ -1,24 +1,140 @@
-import os, json, requests
+# HTTP helpers for the CLI.
+#
+# Startup time matters: scripts call the CLI in loops. `requests` (and urllib3 under it)
+# costs ~200 ms to import, more than the rest of a simple command, so it is only imported
+# by commands that need a pooled session (multi-VM commands, create, watch). Simple GETs
+# (list, ip of one VM) go through http.client from the standard library instead.
+# Check the budget with `make bench-cli` (python -m bench.cli_startup).
+import os, json, time
 from pathlib import Path
+from urllib.parse import urlencode, urlsplit
 
 DEFAULT_URL = "http://127.0.0.1:8000"
 CONF_PATH = Path.home() / ".kvm_orchestrator" / "config.json"
 
+# One keep-alive session per process, shared by all threads of a multi-VM command.
+_session = None
+# Parsed config, read once per process.
+_config = None
+
+
+class ApiError(Exception):
+    """A request on the lightweight path failed (status 0 = the API couldn't be reached)."""
+
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
 def load_config() -> dict:
-    if CONF_PATH.exists():
-        try:
-            return json.loads(CONF_PATH.read_text())
-        except Exception:
-            pass
-    return {"base_url": os.environ.get("KVM_ORCH_URL", DEFAULT_URL)}
-
-def api():
-    cfg = load_config()
-    base = cfg.get("base_url", DEFAULT_URL).rstrip("/")
-    session = requests.Session()
-    # future: session.headers.update({"Authorization": f"Bearer {cfg['token']}"})
-    return base, session
+    global _config
+    if _config is None:
+        _config = {"base_url": os.environ.get("KVM_ORCH_URL", DEFAULT_URL)}
+        if CONF_PATH.exists():
+            try:
+                _config = json.loads(CONF_PATH.read_text())
+            except Exception:
+                pass
+    return _config
+
+def base_url() -> str:
+    return load_config().get("base_url", DEFAULT_URL).rstrip("/")
+
+def api(pool_size: int = 10):
+    """Base URL and the shared session. pool_size = connections kept open for parallel requests."""
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _session = requests.Session()
+        # requests keeps only 10 idle connections per host by default; --parallel 50 needs 50.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+        # future: _session.headers.update({"Authorization": f"Bearer {cfg['token']}"})
+    return base_url(), _session
 
 def save_base_url(url: str) -> None:
+    global _config
     CONF_PATH.parent.mkdir(parents=True, exist_ok=True)
     CONF_PATH.write_text(json.dumps({"base_url": url}, indent=2))
+    _config = None
+
+
+# ----- lightweight path (standard library only) -----
+def light_get(path: str, params: dict = None, timeout: float = 30):
+    """
+    GET base_url + path with http.client and return the open response (status < 400).
+    Raises ApiError with the API's "detail" message otherwise.
+    """
+    import http.client
+    url = urlsplit(base_url() + path)
+    conn_cls = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+    target = url.path + ("?" + urlencode(params) if params else "")
+    try:
+        conn = conn_cls(url.hostname, url.port, timeout=timeout)
+        conn.request("GET", target, headers={"Accept": "application/json, application/x-ndjson"})
+        response = conn.getresponse()
+    except OSError as e:
+        raise ApiError(0, f"can't reach the API at {base_url()}: {e}")
+    if response.status >= 400:
+        body = response.read()
+        try:
+            detail = json.loads(body).get("detail", body.decode())
+        except ValueError:
+            detail = body.decode(errors="replace") or f"HTTP {response.status}"
+        raise ApiError(response.status, str(detail))
+    return response
+
+def get_json(path: str, params: dict = None, timeout: float = 30):
+    with light_get(path, params, timeout) as response:
+        return json.loads(response.read())
+
+def iter_ndjson(path: str, params: dict = None, timeout: float = 30):
+    """Yield one parsed object per line of a streamed NDJSON response."""
+    with light_get(path, params, timeout) as response:
+        for line in response:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+# ----- event stream -----
+def iter_events(base: str, session, params: dict, deadline=None):
+    """
+    Yield events from the server's GET /events stream (Server-Sent Events) until `deadline`
+    (a time.monotonic() value, None = forever). A dropped or idle connection is reopened with
+    Last-Event-ID so no event is missed. After each (re)connect a {"type": "connected"} marker
+    is yielded, so callers can re-read current state before trusting the stream.
+    """
+    import requests
+    last_id = None
+    while deadline is None or time.monotonic() < deadline:
+        headers = {"Last-Event-ID": str(last_id)} if last_id is not None else {}
+        # The server sends a keep-alive comment every 15s; a short read timeout lets us check the deadline.
+        read_timeout = 30 if deadline is None else max(1, min(30, deadline - time.monotonic()))
+        try:
+            with session.get(f"{base}/events", params=params, headers=headers, stream=True,
+                             timeout=(5, read_timeout)) as r:
+                r.raise_for_status()
+                yield {"type": "connected"}
+                kind, data = None, None
+                for line in r.iter_lines(decode_unicode=True):
+                    if line.startswith("event:"):
+                        kind = line[6:].strip()
+                    elif line.startswith("data:"):
+                        data = line[5:].strip()
+                    elif line == "" and data is not None:
+                        event = json.loads(data)
+                        event.setdefault("type", kind)
+                        if "id" in event:
+                            last_id = event["id"]
+                        yield event
+                        if kind == "overflow":
+                            break  # we fell behind; reconnect and resume from last_id
+                        kind, data = None, None
+                    if deadline is not None and time.monotonic() >= deadline:
+                        return
+        except (requests.ConnectionError, requests.Timeout):
+            time.sleep(0.5)
@@ -0,0 +1,107 @@
+# Helpers for commands that act on many VMs at once (start web-1 web-2 'db-*' -f more.txt --parallel 20).
+# Kept free of heavy imports at module level (see cli/client.py): requests and the thread
+# pool are only loaded once a command actually runs.
+import json, sys
+from fnmatch import fnmatchcase
+
+import typer
+
+GLOB_CHARS = set("*?[")
+
+
+def read_names(path: str) -> list[str]:
+    """VM names from a file ('-' = stdin): one per line, blank lines and # comments skipped."""
+    text = sys.stdin.read() if path == "-" else open(path).read()
+    names = []
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if line:
+            names.append(line)
+    return names
+
+
+def resolve_targets(base: str, s, names, from_file) -> list[str]:
+    """
+    Expand names, globs ('web-*') and --from-file into a list of VM names, in the order given
+    and without duplicates. Globs are matched against one GET /vms/?fields=name.
+    """
+    wanted = list(names or []) + (read_names(from_file) if from_file else [])
+    if not wanted:
+        typer.secho("Give at least one VM name, glob or --from-file.", fg=typer.colors.RED, err=True)
+        raise typer.Exit(2)
+    existing = None
+    if any(GLOB_CHARS & set(n) for n in wanted):
+        r = s.get(f"{base}/vms/", params={"fields": "name"})
+        r.raise_for_status()
+        existing = sorted(vm["name"] for vm in r.json()["vms"])
+    targets = []
+    for item in wanted:
+        if GLOB_CHARS & set(item):
+            matched = [n for n in existing if fnmatchcase(n, item)]
+            if not matched:
+                typer.secho(f"'{item}' matches no VM", fg=typer.colors.YELLOW, err=True)
+            targets.extend(matched)
+        else:
+            targets.append(item)
+    targets = list(dict.fromkeys(targets))
+    if not targets:
+        raise typer.Exit(1)
+    return targets
+
+
+def error_text(e: Exception) -> str:
+    """The API's {"detail": ...} message if there is one, else the exception text."""
+    response = getattr(e, "response", None)
+    if response is not None:
+        try:
+            return str(response.json().get("detail", response.text))
+        except ValueError:
+            return f"HTTP {response.status_code}"
+    return str(e)
+
+
+def run_many(call, targets: list[str], parallel: int) -> list[dict]:
+    """
+    Run call(name) -> dict for every target, `parallel` at a time, and collect
+    {"name", "ok", ...call's result} or {"name", "ok": False, "error"} in target order.
+    """
+    import requests
+
+    def one(name):
+        try:
+            return {"name": name, "ok": True, **call(name)}
+        except (requests.RequestException, ValueError) as e:
+            return {"name": name, "ok": False, "error": error_text(e)}
+
+    return parallel_map(one, targets, parallel)
+
+
+def parallel_map(fn, items: list, parallel: int) -> list:
+    """[fn(item) for item in items], `parallel` at a time (no threads for a single item)."""
+    if len(items) == 1:
+        return [fn(items[0])]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(parallel, len(items))) as pool:
+        return list(pool.map(fn, items))
+
+
+def print_results(results: list[dict], output: str, detail) -> None:
+    """Print one row per VM (table) or the whole list (json). detail(result) -> text for the table."""
+    if output == "json":
+        typer.echo(json.dumps(results, indent=2))
+        return
+    width = max([20] + [len(r["name"]) + 1 for r in results])
+    typer.echo(f"{'NAME':{width}} {'STATUS':7} DETAIL")
+    for r in results:
+        status = "ok" if r["ok"] else "failed"
+        text = detail(r) if r["ok"] else r["error"]
+        typer.secho(f"{r['name']:{width}} {status:7} {text}", fg=None if r["ok"] else typer.colors.RED)
+    failed = sum(not r["ok"] for r in results)
+    if len(results) > 1:
+        typer.echo(f"{len(results) - failed}/{len(results)} ok")
+
+
+def finish(results: list[dict]) -> None:
+    """Exit 1 if any VM failed, so scripts can tell."""
+    if any(not r["ok"] for r in results):
+        raise typer.Exit(1)
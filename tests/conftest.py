@@ -0,0 +1,34 @@
+# Shared setup for the tests.
+#
+# The tests run against libvirt's test driver (test:///default): an in-memory hypervisor
+# with one running domain ("test") and a "default-pool" storage pool, so no KVM or
+# libvirtd is needed. Run them from the repository root with `make test`.
+#
+# Settings are read when the app modules are imported, so they are set here first.
+# The test modules import libvirt with pytest.importorskip: without libvirt-python they are skipped.
+import os
+
+import pytest
+
+TEST_URI = "test:///default"
+
+os.environ.setdefault("KVM_ORCH_LIBVIRT_URI", TEST_URI)
+os.environ.setdefault("KVM_ORCH_NODES_FILE", os.path.join(os.path.dirname(__file__), "no-such-nodes.json"))
+os.environ.setdefault("KVM_ORCH_INVENTORY", "0")
+
+
+@pytest.fixture
+def two_nodes(tmp_path, monkeypatch):
+    """A registry of two nodes, "node-a" and "node-b", both on test:///default, with no reservations."""
+    from app.services import nodes
+
+    path = tmp_path / "nodes.json"
+    path.write_text('{"nodes": [{"name": "node-a", "uri": "%s"}, {"name": "node-b", "uri": "%s"}]}'
+                    % (TEST_URI, TEST_URI))
+    monkeypatch.setattr(nodes, "NODES_FILE", str(path))
+    monkeypatch.setattr(nodes, "_reservations", {})
+    monkeypatch.setattr(nodes, "_cpu_samples", {})
+    nodes.load()
+    yield nodes.list_nodes()
+    with nodes._lock:
+        nodes._nodes.clear()
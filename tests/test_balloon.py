@@ -0,0 +1,71 @@
+# The auto-balloon policy (balloon.decide): pure arithmetic on one memory sample.
+import pytest
+
+pytest.importorskip("libvirt")
+
+from app.services import balloon  # noqa: E402
+from app.services.balloon import decide  # noqa: E402
+
+MIB = 1024          # KiB
+GIB = 1024 * MIB
+FLOOR, CEILING = 512 * MIB, 8 * GIB
+
+
+def sample(current, free_share):
+    return {"current": current, "free": None if free_share is None else int(current * free_share)}
+
+
+def ideal(current, free):
+    return int((current - free) / (1 - balloon.BALLOON_TARGET_FREE))
+
+
+def test_no_guest_stats_is_skipped():
+    assert decide(sample(4 * GIB, None), FLOOR, CEILING)["action"] == "skip"
+
+
+def test_comfortable_guest_is_held():
+    share = (balloon.BALLOON_LOW_FREE + balloon.BALLOON_HIGH_FREE) / 2
+    result = decide(sample(4 * GIB, share), FLOOR, CEILING)
+    assert result == {"action": "hold", "reason": f"{share:.0%} free", "target_kib": 4 * GIB}
+
+
+def test_short_on_memory_grows_to_the_target_share():
+    s = sample(4 * GIB, balloon.BALLOON_LOW_FREE / 2)
+    result = decide(s, FLOOR, CEILING)
+    assert result["action"] == "grow"
+    assert result["target_kib"] == min(ideal(s["current"], s["free"]), CEILING)
+
+
+def test_swapping_grows_at_least_one_step():
+    share = (balloon.BALLOON_LOW_FREE + balloon.BALLOON_HIGH_FREE) / 2
+    result = decide(sample(4 * GIB, share), FLOOR, CEILING, swapping=True)
+    assert result["action"] == "grow"
+    assert result["reason"] == "guest is swapping"
+    assert result["target_kib"] >= min(4 * GIB + balloon.BALLOON_STEP_MB * MIB, CEILING)
+
+
+def test_idle_memory_shrinks_by_at_most_one_step():
+    s = sample(4 * GIB, 0.9)
+    result = decide(s, FLOOR, CEILING)
+    assert result["action"] == "shrink"
+    assert result["target_kib"] == max(ideal(s["current"], s["free"]), s["current"] - balloon.BALLOON_STEP_MB * MIB, FLOOR)
+
+
+def test_bounds_win_over_the_guest():
+    assert decide(sample(256 * MIB, 0.9), FLOOR, CEILING) == {
+        "action": "grow", "reason": "below its floor", "target_kib": FLOOR}
+    assert decide(sample(16 * GIB, 0.0), FLOOR, CEILING) == {
+        "action": "shrink", "reason": "above its ceiling", "target_kib": CEILING}
+
+
+def test_at_the_ceiling_a_swapping_guest_is_held():
+    result = decide(sample(CEILING, 0.0), FLOOR, CEILING, swapping=True)
+    assert result["action"] == "hold"
+    assert result["reason"] == "guest is swapping, but already at its bound"
+
+
+def test_free_above_current_is_clamped():
+    # Counters sampled at different times: "free" can exceed "current"; treat it as all free.
+    result = decide({"current": 4 * GIB, "free": 5 * GIB}, FLOOR, CEILING)
+    assert result["action"] == "shrink"
+    assert result["target_kib"] >= FLOOR
@@ -0,0 +1,92 @@
+# Linked-clone XML helpers (app/services/clone.py): which disks get overlays, and the
+# source's domain XML rewritten into a clone's.
+import pytest
+
+pytest.importorskip("libvirt")
+
+from lxml import etree  # noqa: E402
+
+from app.services.clone import CloneError, clone_xml, source_disks  # noqa: E402
+from app.services.libvirt_client import disks_xml, domain_facts, tags_xml  # noqa: E402
+
+SOURCE_XML = f"""<domain type='kvm'>
+  <name>web</name>
+  <uuid>6f1c6a2e-1111-4c6b-9c1e-000000000001</uuid>
+  <metadata>{tags_xml(["web"])}{disks_xml(["/images/web-top.qcow2", "/images/web-seed.iso"])}</metadata>
+  <sysinfo type='smbios'><system><entry name='uuid'>6f1c6a2e-1111-4c6b-9c1e-000000000001</entry></system></sysinfo>
+  <os><type>hvm</type><nvram>/var/lib/libvirt/qemu/nvram/web_VARS.fd</nvram></os>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2'/>
+      <source file='/images/web-top.qcow2'/>
+      <backingStore type='file'><format type='qcow2'/><source file='/images/web.qcow2'/></backingStore>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+    <disk type='file' device='cdrom'>
+      <driver name='qemu' type='raw'/>
+      <source file='/images/web-seed.iso'/>
+      <target dev='sda' bus='sata'/>
+      <readonly/>
+    </disk>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='raw'/>
+      <source file='/images/shared-data.img'/>
+      <target dev='vdc' bus='virtio'/>
+      <shareable/>
+    </disk>
+    <interface type='network'><mac address='52:54:00:aa:bb:cc'/><source network='default'/></interface>
+    <interface type='network'><mac address='52:54:00:aa:bb:cd'/><source network='default'/></interface>
+  </devices>
+</domain>"""
+
+
+def test_source_disks_skips_the_seed_and_shared_disks():
+    disks, seed_format = source_disks(SOURCE_XML, "web")
+    assert disks == [{"dev": "vda", "path": "/images/web-top.qcow2", "format": "qcow2"}]
+    assert seed_format == "iso"
+
+
+def test_source_without_file_disks_cannot_be_cloned():
+    xml = SOURCE_XML.replace("<disk type='file' device='disk'>\n      <driver name='qemu' type='qcow2'/>",
+                             "<disk type='block' device='disk'>\n      <driver name='qemu' type='qcow2'/>")
+    with pytest.raises(CloneError, match="block disk"):
+        source_disks(xml, "web")
+
+
+def test_clone_xml():
+    used = {"52:54:00:aa:bb:cc"}
+    xml = clone_xml(SOURCE_XML, "web", "web-2", {"vda": "/images/web-2.qcow2"},
+                    seed_path="/images/web-2-seed.iso", used_macs=used)
+    root = etree.fromstring(xml.encode())
+    assert root.findtext("name") == "web-2"
+    assert root.findtext("uuid") != "6f1c6a2e-1111-4c6b-9c1e-000000000001"
+    assert root.find("sysinfo/system/entry[@name='uuid']") is None
+    assert root.find("os/nvram") is None
+
+    macs = [m.get("address") for m in root.findall("devices/interface/mac")]
+    assert len(set(macs)) == 2 and all(m.startswith("52:54:00:") for m in macs)
+    assert "52:54:00:aa:bb:cc" not in macs and set(macs) <= used
+
+    disks = root.findall("devices/disk")
+    assert [d.find("target").get("dev") for d in disks] == ["vda", "sda", "vdc"]  # seed stays in place
+    vda = disks[0]
+    assert vda.find("source").get("file") == "/images/web-2.qcow2"
+    assert vda.find("driver").get("type") == "qcow2"
+    assert vda.find("backingStore") is None
+    assert disks[1].find("source").get("file") == "/images/web-2-seed.iso"
+    assert disks[2].find("source").get("file") == "/images/shared-data.img"
+
+    facts = domain_facts(xml)
+    # The source's own list (it may be a clone itself) is replaced by the clone's files.
+    assert facts["owned"] == ["/images/web-2.qcow2", "/images/web-2-seed.iso"]
+    assert facts["disks"] == facts["owned"]
+    assert facts["tags"] == ["web"]
+
+
+def test_clone_xml_without_a_seed_and_with_new_tags():
+    xml = clone_xml(SOURCE_XML, "web", "web-3", {"vda": "/images/web-3.qcow2"}, tags=["canary"])
+    facts = domain_facts(xml)
+    assert facts["owned"] == ["/images/web-3.qcow2"]
+    assert facts["tags"] == ["canary"]
+    targets = [d.get("dev") for d in etree.fromstring(xml.encode()).findall("devices/disk/target")]
+    assert targets == ["vda", "vdc"]
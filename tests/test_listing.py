@@ -0,0 +1,47 @@
+# GET /vms listing helpers (app/services/listing.py): fields, cursors and paging across nodes.
+import pytest
+
+pytest.importorskip("libvirt")
+
+from app.models import VmSelector  # noqa: E402
+from app.services.listing import (  # noqa: E402
+    SUMMARY_FIELDS, decode_cursor, encode_cursor, list_page, parse_fields,
+)
+
+ONLY_TEST = VmSelector(names=["test"])
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor("node-a", "web/01 é")
+    assert decode_cursor(cursor) == ("node-a", "web/01 é")
+    assert not set(cursor) & set("+/")  # URL-safe
+
+
+@pytest.mark.parametrize("cursor", ["", "not base64!", encode_cursor("a", "b")[:-4], "WzFd"])
+def test_foreign_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError, match="invalid cursor"):
+        decode_cursor(cursor)
+
+
+def test_parse_fields():
+    assert parse_fields(None) == SUMMARY_FIELDS
+    assert parse_fields(" name, state ,") == ("name", "state")
+    with pytest.raises(ValueError, match="unknown field"):
+        parse_fields("name,password")
+
+
+def test_pages_follow_the_node_order(two_nodes):
+    # Both nodes are test:///default, so each lists the driver's domain "test".
+    fields = ("name", "node")
+    page, cursor, errors = list_page(fields, ONLY_TEST, limit=1)
+    assert page == [{"name": "test", "node": "node-a"}] and errors == {}
+    assert decode_cursor(cursor) == ("node-a", "test")
+    page, cursor, _ = list_page(fields, ONLY_TEST, limit=1, cursor=cursor)
+    assert page == [{"name": "test", "node": "node-b"}]
+    assert cursor is None  # nothing after it: the last page
+
+
+def test_name_is_dropped_unless_asked_for(two_nodes):
+    page, cursor, _ = list_page(("node",), ONLY_TEST, limit=1)
+    assert page == [{"node": "node-a"}]
+    assert decode_cursor(cursor) == ("node-a", "test")
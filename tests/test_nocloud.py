@@ -0,0 +1,88 @@
+# NoCloud seed files and the in-process ISO9660/Joliet and FAT12 writers (app/services/nocloud.py).
+# The images are read back here: the ISO with pycdlib (skipped without it), the FAT image
+# with a small reader for the flat root directory the writer produces.
+import io
+
+import pytest
+
+pytest.importorskip("libvirt")
+
+from app.services import nocloud  # noqa: E402
+
+FILES = nocloud.seed_files("web-01", "ubuntu", "ssh-ed25519 AAAAC3Nz test@example", instance_id="iid-web-01")
+
+
+def test_seed_files():
+    assert FILES["meta-data"] == b"instance-id: iid-web-01\nlocal-hostname: web-01\n"
+    user_data = FILES["user-data"].decode()
+    assert user_data.startswith("#cloud-config\n")
+    assert "hostname: web-01" in user_data and "- name: ubuntu" in user_data
+    assert "      - ssh-ed25519 AAAAC3Nz test@example\n" in user_data
+    assert "ssh_authorized_keys" not in nocloud.seed_files("web-01", "ubuntu", None)["user-data"].decode()
+
+
+def test_clone_seed_files_get_a_new_instance():
+    files = nocloud.clone_seed_files("web-02", "ssh-ed25519 AAAA extra")
+    assert b"local-hostname: web-02" in files["meta-data"]
+    assert b"instance-id: iid-web-01" not in files["meta-data"]
+    assert b"new-machine-id" in files["user-data"]
+    assert b"\n  - ssh-ed25519 AAAA extra\n" in files["user-data"]
+
+
+def test_iso_seed_reads_back():
+    pycdlib = pytest.importorskip("pycdlib")
+    iso = pycdlib.PyCdlib()
+    iso.open_fp(io.BytesIO(nocloud.seed_image(FILES, "iso")))
+    try:
+        assert iso.pvd.volume_identifier.rstrip() == b"cidata"
+        for name, data in FILES.items():
+            out = io.BytesIO()
+            iso.get_file_from_iso_fp(out, joliet_path=f"/{name};1")  # the kernel hides the ";1"
+            assert out.getvalue() == data
+    finally:
+        iso.close()
+
+
+def read_fat(image: bytes) -> tuple[bytes, dict[str, bytes]]:
+    """(volume label, {long name: contents}) of a flat FAT12 image made by write_vfat."""
+    spf = int.from_bytes(image[22:24], "little")
+    root_at = (1 + 2 * spf) * nocloud.FAT_SECTOR
+    label, files, lfn = image[43:54], {}, []
+    for off in range(root_at, root_at + nocloud.FAT_ROOT_ENTRIES * 32, 32):
+        entry = image[off:off + 32]
+        if entry[0] == 0:
+            break
+        if entry[11] == 0x0F:
+            lfn.insert(0, entry[1:11] + entry[14:26] + entry[28:32])
+            continue
+        if entry[11] & 0x08:
+            continue  # the volume label entry
+        name = b"".join(lfn).decode("utf-16-le").split("\x00")[0]
+        cluster, size = int.from_bytes(entry[26:28], "little"), int.from_bytes(entry[28:32], "little")
+        start = (nocloud.FAT_DATA_START + cluster - 2) * nocloud.FAT_SECTOR
+        files[name], lfn = image[start:start + size], []
+    return label, files
+
+
+def test_vfat_seed_reads_back():
+    image = nocloud.seed_image(FILES, "vfat")
+    assert len(image) == nocloud.FAT_TOTAL_SECTORS * nocloud.FAT_SECTOR
+    assert image[510:512] == b"\x55\xaa" and image[54:62] == b"FAT12   "
+    label, files = read_fat(image)
+    assert label == b"CIDATA     "
+    assert files == FILES
+
+
+def test_vfat_seed_size_limit():
+    room = (nocloud.FAT_TOTAL_SECTORS - nocloud.FAT_DATA_START) * nocloud.FAT_SECTOR
+    assert read_fat(nocloud.seed_image({"user-data": b"x" * room}, "vfat"))[1] == {"user-data": b"x" * room}
+    with pytest.raises(ValueError, match="too large"):
+        nocloud.seed_image({"user-data": b"x" * (room + 1)}, "vfat")
+
+
+def test_write_seed_to_a_file(tmp_path):
+    path = tmp_path / "web-01-seed.iso"
+    assert nocloud.write_seed(str(path), FILES, "iso") == str(path)
+    image = path.read_bytes()
+    assert len(image) == len(nocloud.seed_image(FILES, "iso"))
+    assert image[16 * nocloud.SECTOR + 1:16 * nocloud.SECTOR + 6] == b"CD001"
@@ -0,0 +1,104 @@
+# Node registry and placement scheduler (app/services/nodes.py), with two nodes that both
+# point at test:///default. They share one test host, so each sees the same free memory;
+# reservations are kept per node, which is what spreads parallel creates.
+import json
+
+import pytest
+
+pytest.importorskip("libvirt")
+
+from app.services import nodes  # noqa: E402
+from conftest import TEST_URI  # noqa: E402
+
+
+# ----- registry -----
+def test_load_reads_the_nodes_file(two_nodes):
+    assert [n["name"] for n in two_nodes] == ["node-a", "node-b"]
+    assert nodes.get_node("node-b") == {"name": "node-b", "uri": TEST_URI}
+    assert nodes.uri_for(None) == TEST_URI
+    assert nodes.is_local(two_nodes[0])
+    with pytest.raises(nodes.UnknownNode):
+        nodes.get_node("node-c")
+
+
+def test_load_without_a_file_uses_the_local_node(tmp_path, monkeypatch):
+    monkeypatch.setattr(nodes, "NODES_FILE", str(tmp_path / "missing.json"))
+    try:
+        assert nodes.load() == [{"name": nodes.DEFAULT_NODE, "uri": nodes.LIBVIRT_URI}]
+    finally:
+        with nodes._lock:
+            nodes._nodes.clear()
+
+
+def test_remove_node_rewrites_the_file(two_nodes):
+    nodes.remove_node("node-b")
+    assert [n["name"] for n in nodes.list_nodes()] == ["node-a"]
+    with open(nodes.NODES_FILE) as f:
+        assert [n["name"] for n in json.load(f)["nodes"]] == ["node-a"]
+    with pytest.raises(nodes.UnknownNode):
+        nodes.remove_node("node-b")
+
+
+# ----- capacity and schedule() -----
+def test_capacity_of_the_test_host(two_nodes):
+    cap = nodes.capacity(two_nodes[0])
+    assert cap["node"] == "node-a"
+    assert cap["cpus"] > 0 and cap["memory_mb"] > 0
+    assert cap["vms_running"] >= 1  # the test driver's "test" domain
+    assert cap["reserved"] == {"vcpus": 0, "memory_mb": 0, "disk_gb": 0}
+
+
+def test_schedule_scores_every_node(two_nodes):
+    node, candidates = nodes.schedule(1, 64, 0)
+    assert node["name"] in ("node-a", "node-b")
+    assert sorted(c["node"] for c in candidates) == ["node-a", "node-b"]
+    assert all(c["score"] is not None for c in candidates)
+
+
+def test_schedule_without_room_raises(two_nodes):
+    with pytest.raises(nodes.NoCapacity):
+        nodes.schedule(1, 10 ** 9, 0)
+
+
+# ----- placement() -----
+@pytest.fixture
+def half_a_node(two_nodes, monkeypatch):
+    """MiB of memory for a VM that fits once per node, but not twice."""
+    monkeypatch.setattr(nodes, "HOST_RESERVED_MB", 0)
+    return nodes.capacity(two_nodes[0])["free_memory_mb"] // 2 + 1
+
+
+def test_parallel_placements_spread_over_the_nodes(half_a_node):
+    with nodes.placement(1, half_a_node, 0, vm="vm-1") as first:
+        with nodes.placement(1, half_a_node, 0, vm="vm-2") as second:
+            assert {first["name"], second["name"]} == {"node-a", "node-b"}
+            with pytest.raises(nodes.NoCapacity):
+                with nodes.placement(1, half_a_node, 0, vm="vm-3"):
+                    pass
+
+
+def test_reservation_outlives_the_placement_until_the_ttl(half_a_node, monkeypatch):
+    monkeypatch.setattr(nodes, "RESERVATION_TTL", 60)
+    with nodes.placement(1, half_a_node, 0, vm="vm-1") as chosen:
+        pass
+    # The VM is defined but not running yet: its memory still counts against the node.
+    assert nodes._reserved(chosen["name"])["memory_mb"] == half_a_node
+    for r in nodes._reservations.values():
+        r["until"] = 0  # TTL over
+    assert nodes._reserved(chosen["name"])["memory_mb"] == 0
+
+
+def test_failed_placement_releases_at_once(half_a_node):
+    with pytest.raises(RuntimeError):
+        with nodes.placement(1, half_a_node, 0, vm="vm-1"):
+            raise RuntimeError("virt-install failed")
+    assert nodes._reservations == {}
+
+
+def test_pinned_placement(two_nodes):
+    with nodes.placement(1, 64, 0, node="node-b") as chosen:
+        assert chosen["name"] == "node-b"
+        assert nodes._reserved("node-b")["memory_mb"] == 64
+    with pytest.raises(nodes.UnknownNode):
+        with nodes.placement(1, 64, 0, node="node-c"):
+            pass
@@ -0,0 +1,66 @@
+# ConnectionPool (app/services/libvirt_client.py): checkout/return, the size limit, and
+# replacing connections libvirt reported as closed.
+import pytest
+
+libvirt = pytest.importorskip("libvirt")
+
+from app.services.libvirt_client import ConnectionPool, connection, get_pool  # noqa: E402
+from conftest import TEST_URI  # noqa: E402
+
+
+@pytest.fixture
+def pool():
+    p = ConnectionPool(TEST_URI, size=2, timeout=0.2)
+    yield p
+    p.close()
+
+
+def test_acquire_release_reuses_the_connection(pool):
+    conn = pool.acquire()
+    assert conn.getInfo()[2] > 0  # a working connection (CPU count of the test host)
+    assert pool.stats()["idle"] == 0
+    pool.release(conn)
+    assert pool.stats()["idle"] == 1
+    again = pool.acquire()
+    assert again is conn
+    pool.release(again)
+
+
+def test_acquire_blocks_when_every_connection_is_out(pool):
+    first, second = pool.acquire(), pool.acquire()
+    with pytest.raises(RuntimeError, match="Timed out"):
+        pool.acquire()
+    pool.release(first)
+    third = pool.acquire()  # the returned slot can be used again
+    pool.release(second)
+    pool.release(third)
+
+
+def test_dead_idle_connection_is_replaced(pool):
+    conn = pool.acquire()
+    pool.release(conn)
+    # What libvirt's close callback does when the daemon drops the connection.
+    pool._on_close(conn, libvirt.VIR_CONNECT_CLOSE_REASON_EOF, None)
+    fresh = pool.acquire()
+    assert fresh is not conn
+    assert fresh.getInfo()[2] > 0
+    pool.release(fresh)
+    assert pool.stats()["idle"] == 1
+
+
+def test_connection_that_dies_while_checked_out_is_not_returned(pool):
+    conn = pool.acquire()
+    pool._on_close(conn, libvirt.VIR_CONNECT_CLOSE_REASON_EOF, None)
+    pool.release(conn)
+    assert pool.stats()["idle"] == 0
+    # Its slot is free again.
+    conns = [pool.acquire(), pool.acquire()]
+    for c in conns:
+        pool.release(c)
+
+
+def test_connection_context_manager_returns_to_the_shared_pool():
+    with connection(TEST_URI) as conn:
+        names = [d.name() for d in conn.listAllDomains()]
+    assert "test" in names
+    assert get_pool(TEST_URI).stats()["idle"] >= 1
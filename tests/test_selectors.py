@@ -0,0 +1,52 @@
+# VmSelector matching (app/services/selectors.py).
+import pytest
+
+pytest.importorskip("libvirt")
+
+from app.models import VmSelector  # noqa: E402
+from app.services.selectors import is_empty, matches, select_vms  # noqa: E402
+from conftest import TEST_URI  # noqa: E402
+
+WEB = {"name": "web-01", "state": "running", "active": True}
+DB = {"name": "db-01", "state": "shutoff", "active": False}
+
+
+def test_empty_selector_matches_nothing():
+    assert is_empty(VmSelector())
+    assert not is_empty(VmSelector(active=False))
+    assert not is_empty(VmSelector(all=True))
+    assert select_vms(VmSelector(), uri=TEST_URI) == []
+
+
+@pytest.mark.parametrize("selector, web, db", [
+    (VmSelector(all=True), True, True),
+    (VmSelector(names=["db-01"]), False, True),
+    (VmSelector(prefix="web-"), True, False),
+    (VmSelector(glob="*-01"), True, True),
+    (VmSelector(regex=r"web-\d+"), True, False),
+    (VmSelector(regex="web"), False, False),   # the regex must match the whole name
+    (VmSelector(state="shutoff"), False, True),
+    (VmSelector(active=True), True, False),
+    (VmSelector(prefix="web-", state="shutoff"), False, False),   # every filter must match
+])
+def test_matches(selector, web, db):
+    assert matches(selector, WEB) is web
+    assert matches(selector, DB) is db
+
+
+def test_tag_filter():
+    selector = VmSelector(tag="prod")
+    assert matches(selector, WEB, ["prod", "web"])
+    assert not matches(selector, WEB, ["staging"])
+    assert not matches(selector, WEB)
+
+
+def test_invalid_regex_is_rejected():
+    with pytest.raises(ValueError):
+        VmSelector(regex="web-(")
+
+
+def test_select_vms_on_the_test_driver():
+    assert [vm["name"] for vm in select_vms(VmSelector(glob="t*"), uri=TEST_URI)] == ["test"]
+    assert select_vms(VmSelector(state="shutoff", names=["test"]), uri=TEST_URI) == []
+    assert select_vms(VmSelector(tag="no-such-tag"), uri=TEST_URI) == []